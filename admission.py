@@ -0,0 +1,246 @@
+"""
+    EXPRES Fiber Agitator Admission Control module
+
+    Keeps a misbehaving client from starving the sequencer of serial
+    bandwidth. Each request is checked against token buckets, one per
+    client address and optionally one per method, before it is dispatched;
+    a request over its limit is turned away at once with the time after
+    which it would be accepted, rather than queued.
+
+    Calls that go to the controller then pass a gate that lets only a few
+    of them wait on the serial port at once, with a bounded queue behind
+    it. A call that finds the queue full, or waits in it too long, is shed.
+    Control methods (start, stop, stop_agitation and the like) skip both the
+    buckets and the gate, so at most a few reads are ever queued ahead of
+    them on the serial port.
+"""
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+
+__DEFAULT_MAX_ACTIVE__ = 2 # controller calls waiting on the serial port at once
+__DEFAULT_MAX_QUEUE__ = 4 # controller calls waiting for the gate
+__DEFAULT_QUEUE_TIMEOUT__ = 2.0 # seconds a call may wait for the gate
+__MAX_CLIENTS__ = 256 # client buckets kept; the longest idle are dropped
+
+# Calls that change the agitator; never limited or queued behind reads
+CONTROL_METHODS = frozenset((
+    'start', 'stop', 'start_agitation', 'stop_agitation', 'start_all',
+    'stop_all', 'request_stop', 'set_voltage', 'set_voltage1', 'set_voltage2',
+    'resync',
+))
+# Control calls that stop the motors; these must run however late they are
+STOP_METHODS = frozenset(('stop', 'stop_all', 'stop_agitation', 'request_stop'))
+
+
+class Overloaded(Exception):
+    """A request was shed; retry_after is the seconds to wait before retrying"""
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """Allows rate requests per second on average and bursts of up to burst"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst=None):
+        if not rate > 0 or (burst is not None and not burst > 0):
+            raise ValueError(f'Rate and burst must be positive, not {rate} and {burst}')
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, count=1):
+        """
+        Seconds until count tokens are available (0 if they are now); a
+        batch larger than the burst only needs a full bucket
+        """
+        return max(0.0, (min(count, self.burst) - self.tokens) / self.rate)
+
+
+def is_control(method):
+    """True for control methods, including those prefixed with a controller name"""
+    return method.rpartition('.')[2] in CONTROL_METHODS
+
+
+def is_stop(method):
+    """True for methods that stop the motors, prefixed or not"""
+    return method.rpartition('.')[2] in STOP_METHODS
+
+
+class AdmissionControl(object):
+    """Token-bucket limits and a bounded gate for controller calls
+
+    Inputs
+    ------
+    client_rate, client_burst : float
+        Requests per second allowed from each client address, and the
+        burst above that; None for no per-client limit. Rates and bursts
+        must be positive.
+    method_limits : dict
+        {method: (rate, burst)} shared by every client; methods are
+        matched without a controller prefix
+    max_active : int
+        Controller calls allowed to wait on the serial port at once
+    max_queue : int
+        Controller calls allowed to wait for the gate
+    queue_timeout : float
+        Seconds a call may wait for the gate before it is shed
+
+    Public Methods
+    --------------
+    admit(client, methods):
+        Charge a request to the buckets, or raise Overloaded
+    gate(method):
+        Context manager holding a gate slot around a controller call
+    shed_connection(client):
+        Count a connection turned away because too many were waiting
+    stats():
+        Count admitted and shed requests by reason
+    """
+
+    def __init__(self, client_rate=None, client_burst=None, method_limits=None,
+                 max_active=__DEFAULT_MAX_ACTIVE__, max_queue=__DEFAULT_MAX_QUEUE__,
+                 queue_timeout=__DEFAULT_QUEUE_TIMEOUT__):
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.method_limits = dict(method_limits or {})
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._lock = Lock()
+        self._clients = {} # client address: TokenBucket, least recently used first
+        self._methods = {name: TokenBucket(*limit) for name, limit in self.method_limits.items()}
+        if client_rate is not None:
+            TokenBucket(client_rate, client_burst) # Reject a bad limit now, not at the first request
+        self._gate = Condition()
+        self._active = 0
+        self._queued = 0
+        self._counts = {'admitted': 0, 'control': 0, 'client_rate': 0,
+                        'method_rate': 0, 'queue_full': 0, 'queue_timeout': 0,
+                        'connections': 0}
+        self._shed_by_client = {}
+
+    def admit(self, client, methods):
+        """
+        Take one token per call from the client's bucket and from the
+        bucket of each limited method, all or nothing. A request made up
+        only of control methods is always admitted.
+
+        Raises
+        ------
+        Overloaded
+            If a bucket is empty; retry_after says when it will not be
+        """
+        names = [method.rpartition('.')[2] for method in methods]
+        if names and all(name in CONTROL_METHODS for name in names):
+            with self._lock:
+                self._counts['control'] += 1
+            return
+        now = time.monotonic()
+        charges = {}
+        for name in names:
+            if name in self._methods:
+                charges[name] = charges.get(name, 0) + 1
+        with self._lock:
+            bucket = self._client_bucket(client, now)
+            waits = []
+            if bucket is not None:
+                bucket.refill(now)
+                waits.append(('client_rate', bucket.wait(len(names) or 1)))
+            for name, count in charges.items():
+                self._methods[name].refill(now)
+                waits.append(('method_rate', self._methods[name].wait(count)))
+            reason, wait = max(waits, key=lambda item: item[1], default=(None, 0.0))
+            if wait > 0:
+                self._shed(reason, client)
+                raise Overloaded(f'Rate limit exceeded ({reason.replace("_", " ")}) '
+                                 f'for {client}', wait)
+            if bucket is not None:
+                bucket.tokens -= len(names) or 1
+            for name, count in charges.items():
+                self._methods[name].tokens -= count
+            self._counts['admitted'] += 1
+
+    @contextmanager
+    def gate(self, method):
+        """
+        Hold a gate slot while a controller call runs; control methods
+        pass straight through
+
+        Raises
+        ------
+        Overloaded
+            If the queue is full or the slot does not free up in time
+        """
+        if is_control(method):
+            yield
+            return
+        self._enter()
+        try:
+            yield
+        finally:
+            self._leave()
+
+    def shed_connection(self, client):
+        """Count a connection turned away before it reached a worker"""
+        with self._lock:
+            self._shed('connections', client)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['shed_by_client'] = dict(self._shed_by_client)
+        with self._gate:
+            stats.update(active=self._active, queued=self._queued)
+        return stats
+
+    def _client_bucket(self, client, now):
+        if self.client_rate is None:
+            return None
+        bucket = self._clients.pop(client, None)
+        if bucket is None:
+            bucket = TokenBucket(self.client_rate, self.client_burst)
+            while len(self._clients) >= __MAX_CLIENTS__:
+                del self._clients[next(iter(self._clients))]
+        self._clients[client] = bucket
+        return bucket
+
+    def _shed(self, reason, client):
+        self._counts[reason] += 1
+        self._shed_by_client[client] = self._shed_by_client.get(client, 0) + 1
+        while len(self._shed_by_client) > __MAX_CLIENTS__:
+            del self._shed_by_client[next(iter(self._shed_by_client))]
+
+    def _enter(self):
+        with self._gate:
+            if self._active >= self.max_active:
+                if self._queued >= self.max_queue:
+                    with self._lock:
+                        self._counts['queue_full'] += 1
+                    raise Overloaded('Too many controller calls queued', self.queue_timeout)
+                self._queued += 1
+                try:
+                    if not self._gate.wait_for(lambda: self._active < self.max_active,
+                                               self.queue_timeout):
+                        with self._lock:
+                            self._counts['queue_timeout'] += 1
+                        raise Overloaded('Timed out waiting for the serial port',
+                                         self.queue_timeout)
+                finally:
+                    self._queued -= 1
+            self._active += 1
+
+    def _leave(self):
+        with self._gate:
+            self._active -= 1
+            self._gate.notify()
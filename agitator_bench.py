@@ -0,0 +1,499 @@
+"""
+    EXPRES Fiber Agitator Benchmark module
+
+    Runs an AgitatorServer against a simulated Roboclaw (see roboclaw_sim)
+    in this process and measures it from the client side. Each benchmark
+    prints a JSON report, tagged with the git commit and configuration, so
+    results can be compared across commits.
+
+    To run, execute from the containing folder:
+    python agitator_bench.py <benchmark> [options] [-o report.json]
+
+    The load benchmark drives the server with concurrent AgitatorProxy
+    clients: --sequencers clients run start/stop cycles with encoder reads
+    the way the observing sequencer does, and the remaining clients poll
+    status like monitoring dashboards. It reports throughput, latency
+    percentiles per operation and the latency of stop() calls.
+
+    The startup benchmark launches agitator_server.py as a fresh process
+    several times and reports how long it takes until the first health()
+    call and the first agitator call (status) succeed.
+
+    The replay benchmark records a short agitator session against the
+    simulator with the serial capture tap, then replays the capture at the
+    recorded pace and as fast as possible, so serial-path regressions can
+    be measured without hardware. Pass --capture to replay an existing
+    capture of the same session instead.
+
+    Pass --io-process to run the status, metrics and load benchmarks with
+    the server's serial I/O in a separate process (see agitator_process).
+
+    The baud benchmark starts a simulated controller at 38400 baud, moves
+    it to each packet serial rate in turn and reports how long the move
+    took and the latency of reading every telemetry register at that rate.
+
+    The flood benchmark runs the sequencer's start/stop cycle while
+    --clients misbehaving clients call an uncached read as fast as they
+    can (waiting out Retry-After when refused), once without limits and
+    once with per-client rate limits, and reports the sequencer's latency
+    and how much of the flood was shed (see admission).
+"""
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import platform
+import subprocess
+import xmlrpc.client
+from threading import Thread
+
+from agitator_client import AgitatorProxy, percentiles
+
+
+__DEFAULT_COMPORT__ = 'sim://bench'
+__DEFAULT_HOST__ = '127.0.0.1'
+__BAUD_SECONDS__ = 2.0 # longest time spent polling at each rate
+__FLOOD_LIMITS__ = {'client_rate': 20.0, 'client_burst': 10.0} # limited run of the flood benchmark
+
+# The values a monitoring dashboard typically polls, one call each
+STATUS_CALLS = ('get_freq', 'read_enc', 'get_battery_voltage',
+                'get_current1', 'get_current2', 'get_voltage1', 'get_voltage2')
+
+
+def start_server(comport=__DEFAULT_COMPORT__, io_process=False, **kwargs):
+    """Start an AgitatorServer on a free local port in a background thread"""
+    from agitator_server import AgitatorServer
+    server = AgitatorServer(__DEFAULT_HOST__, 0, comport=comport,
+                            allow_none=True, logRequests=False,
+                            io_process=io_process, **kwargs)
+    thread = Thread(target=server.serve_forever, name='agitator-bench-server')
+    thread.start()
+    return server, thread
+
+
+def stop_server(server, thread):
+    server.stop(wait=True)
+    thread.join()
+
+
+def proxy_for(server, **kwargs):
+    return AgitatorProxy(__DEFAULT_HOST__, server.server_address[1],
+                         allow_none=True, **kwargs)
+
+
+def bench_status(iterations=200, comport=__DEFAULT_COMPORT__, **options):
+    """
+    Compare one request per polled value against the same calls batched
+    with system.multicall and against a single status() call
+    """
+    server, thread = start_server(comport, options.get('io_process', False))
+    try:
+        proxy = proxy_for(server)
+        proxy.status() # Make sure telemetry has been read at least once
+
+        def per_call():
+            return [getattr(proxy, name)() for name in STATUS_CALLS]
+
+        def multicall():
+            from xmlrpc.client import MultiCall
+            batch = MultiCall(proxy)
+            for name in STATUS_CALLS:
+                getattr(batch, name)()
+            return list(batch())
+
+        results = {}
+        for label, func in (('per_call', per_call),
+                            ('multicall', multicall),
+                            ('status', proxy.status)):
+            samples = []
+            for _ in range(iterations):
+                start = time.perf_counter()
+                func()
+                samples.append(time.perf_counter() - start)
+            results[label] = percentiles(samples)
+
+        base = results['per_call']['mean_ms']
+        for label in ('multicall', 'status'):
+            results[label]['speedup'] = base / results[label]['mean_ms']
+        return results
+    finally:
+        stop_server(server, thread)
+
+
+def _time_calls(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_metrics(iterations=200, comport=__DEFAULT_COMPORT__, **options):
+    """
+    Measure the per-request cost of metrics collection and the cost of one
+    scrape of the metrics endpoint
+    """
+    from urllib.request import urlopen
+
+    results = {}
+    for label, metrics_port in (('rpc_without_metrics', None),
+                                ('rpc_with_metrics', 0)):
+        server, thread = start_server(comport, options.get('io_process', False),
+                                      metrics_port=metrics_port)
+        try:
+            proxy = proxy_for(server)
+            proxy.status()
+            results[label] = percentiles(_time_calls(proxy.get_freq, iterations))
+            if metrics_port is not None:
+                url = 'http://{}:{}/metrics'.format(
+                    __DEFAULT_HOST__, server.metrics_server.server_address[1])
+                results['scrape'] = percentiles(_time_calls(
+                    lambda: urlopen(url).read(), iterations))
+                start = server.metrics_server.scrape_time
+                server.metrics_server.render()
+                results['scrape']['render_ms'] = 1000 * (server.metrics_server.scrape_time - start)
+        finally:
+            stop_server(server, thread)
+
+    results['overhead_per_request_ms'] = (results['rpc_with_metrics']['mean_ms'] -
+                                          results['rpc_without_metrics']['mean_ms'])
+    return results
+
+
+# Weighted operations for each client role in the load benchmark
+MIXES = {
+    'sequencer': (('cycle', 1),),
+    'monitor': (('status', 6), ('read_enc', 2), ('get_freq', 1),
+                ('get_battery_voltage', 1)),
+}
+
+
+def _sequencer_cycle(proxy, rng, record):
+    """One exposure: start, a few encoder and status reads, then stop"""
+    start = time.perf_counter()
+    proxy.start(rng.uniform(30.0, 120.0))
+    record('start', time.perf_counter() - start)
+    for _ in range(rng.randint(1, 5)):
+        for op in ('read_enc', 'status'):
+            start = time.perf_counter()
+            getattr(proxy, op)()
+            record(op, time.perf_counter() - start)
+    start = time.perf_counter()
+    proxy.stop()
+    record('stop', time.perf_counter() - start)
+
+
+def _load_client(proxy, mix, seed, deadline, samples, errors):
+    rng = random.Random(seed)
+    ops, weights = zip(*MIXES[mix])
+
+    def record(op, elapsed):
+        samples.setdefault(op, []).append(elapsed)
+
+    while time.perf_counter() < deadline:
+        op = rng.choices(ops, weights)[0]
+        try:
+            if op == 'cycle':
+                _sequencer_cycle(proxy, rng, record)
+            else:
+                start = time.perf_counter()
+                getattr(proxy, op)()
+                record(op, time.perf_counter() - start)
+        except Exception as err:
+            errors.append('{}: {}'.format(op, err))
+
+
+def bench_load(clients=8, sequencers=1, duration=10.0, seed=0,
+               comport=__DEFAULT_COMPORT__, **options):
+    """
+    Run clients concurrent proxies for duration seconds; the first
+    sequencers of them cycle start/stop while the rest poll status
+    """
+    server, thread = start_server(comport, options.get('io_process', False))
+    try:
+        proxy_for(server).status()
+        deadline = time.perf_counter() + duration
+        per_client = [{} for _ in range(clients)]
+        errors = []
+        threads = []
+        for index in range(clients):
+            mix = 'sequencer' if index < sequencers else 'monitor'
+            threads.append(Thread(target=_load_client,
+                                  args=(proxy_for(server), mix, seed + index,
+                                        deadline, per_client[index], errors)))
+        start = time.perf_counter()
+        for client in threads:
+            client.start()
+        for client in threads:
+            client.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_server(server, thread)
+
+    by_op = {}
+    for samples in per_client:
+        for op, values in samples.items():
+            by_op.setdefault(op, []).extend(values)
+    every = [value for values in by_op.values() for value in values]
+    return {'throughput_ops': len(every) / elapsed,
+            'elapsed_s': elapsed,
+            'errors': len(errors),
+            'first_errors': errors[:5],
+            'overall': percentiles(every),
+            'stop_latency': percentiles(by_op.get('stop', [])),
+            'operations': {op: percentiles(values) for op, values in sorted(by_op.items())},
+            'shutdown_s': server.shutdown_time}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind((__DEFAULT_HOST__, 0))
+        return sock.getsockname()[1]
+
+
+def _first_success(proxy, method, deadline):
+    """Call method until it succeeds; returns the time it first did"""
+    while True:
+        try:
+            getattr(proxy, method)()
+            return time.perf_counter()
+        except Exception:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.002)
+
+
+def bench_startup(runs=5, comport=__DEFAULT_COMPORT__, **options):
+    """
+    Start the server as a new process runs times and time the cold start
+    to the first successful health() call and the first status() call
+    """
+    import os
+    here = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable, '-c', 'import time; start = time.perf_counter(); '
+               'import agitator_server; print(time.perf_counter() - start)']
+    imports = [float(subprocess.run(command, cwd=here, capture_output=True, text=True,
+                                    check=True).stdout) for _ in range(runs)]
+
+    health, ready = [], []
+    for _ in range(runs):
+        port = _free_port()
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, 'agitator_server.py',
+                                    '--host', __DEFAULT_HOST__, '-p', str(port),
+                                    '-c', comport],
+                                   cwd=here, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        try:
+            proxy = AgitatorProxy(__DEFAULT_HOST__, port, retries=0, timeout=30)
+            deadline = start + 60.0
+            health.append(_first_success(proxy, 'health', deadline) - start)
+            ready.append(_first_success(proxy, 'status', deadline) - start)
+            proxy('close')()
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+    return {'import': percentiles(imports),
+            'first_health': percentiles(health),
+            'first_status': percentiles(ready)}
+
+
+def _replay_session(comport, capture=None, reads=20):
+    """The scripted session recorded and replayed by bench_replay"""
+    from expres_agitator import Agitator
+    start = time.perf_counter()
+    agitator = Agitator(comport, capture=capture)
+    agitator.status()
+    agitator.start_agitation(60.0)
+    for _ in range(reads):
+        agitator.read_enc()
+    agitator.stop_agitation()
+    port = agitator._rc._comport
+    agitator.close()
+    return time.perf_counter() - start, port
+
+
+def bench_replay(capture=None, comport=__DEFAULT_COMPORT__, **options):
+    """
+    Time a scripted session live on the simulator, then replayed from its
+    capture at the recorded speed and with no delays
+    """
+    import os
+    import tempfile
+    from serial_capture import read_capture
+
+    results = {}
+    cleanup = capture is None
+    if capture is None:
+        handle, capture = tempfile.mkstemp(suffix='.rcap')
+        os.close(handle)
+        results['live_s'], _ = _replay_session(comport, capture)
+    try:
+        metadata, frames = read_capture(capture)
+        results['frames'] = len(frames)
+        results['capture_bytes'] = os.path.getsize(capture)
+        for label, speed in (('replay_recorded_speed', 1), ('replay_no_delay', 0)):
+            elapsed, port = _replay_session(f'replay://{capture}?speed={speed}')
+            results[label] = {'seconds': elapsed, 'mismatches': port.mismatches,
+                              'finished': port.finished}
+    finally:
+        if cleanup:
+            os.remove(capture)
+    return results
+
+
+def bench_baud(iterations=200, comport=__DEFAULT_COMPORT__, rates=None, **options):
+    """
+    Move a fresh simulated controller from 38400 baud to each rate and time
+    full telemetry polls there, stopping after iterations polls or
+    __BAUD_SECONDS__ per rate
+    """
+    import roboclaw_sim
+    from roboclaw_baud import BAUD_RATES
+    from expres_agitator import Agitator
+
+    results = {}
+    for rate in rates or sorted(BAUD_RATES):
+        if not comport.startswith('sim://'):
+            raise ValueError('The baud benchmark changes the controller rate; '
+                             'run it against the simulator')
+        roboclaw_sim.reset()
+        start = time.perf_counter()
+        agitator = Agitator(comport, baud=rate)
+        opened = time.perf_counter() - start
+        try:
+            agitator.telemetry.poll()
+            samples = []
+            deadline = time.perf_counter() + __BAUD_SECONDS__
+            while len(samples) < iterations and time.perf_counter() < deadline:
+                start = time.perf_counter()
+                agitator.telemetry.poll()
+                samples.append(time.perf_counter() - start)
+            results[str(rate)] = {'rate': agitator._rc.rate,
+                                  'open_s': opened,
+                                  'poll': percentiles(samples),
+                                  'polls_per_s': len(samples) / sum(samples)}
+        finally:
+            agitator.close()
+    base = results.get('38400')
+    if base is not None:
+        for result in results.values():
+            result['speedup'] = base['poll']['mean_ms'] / result['poll']['mean_ms']
+    return results
+
+
+def _flood_client(proxy, deadline, counts):
+    while time.perf_counter() < deadline:
+        try:
+            proxy.get_max_voltage()
+            counts['answered'] += 1
+        except xmlrpc.client.ProtocolError as err:
+            counts['refused'] += 1
+            time.sleep(float(err.headers.get('Retry-After', 1)))
+        except xmlrpc.client.Fault:
+            counts['shed'] += 1
+
+
+def bench_flood(clients=8, duration=10.0, comport=__DEFAULT_COMPORT__, **options):
+    """
+    Time the sequencer's start/stop cycle while clients flood the server
+    with controller reads, without and then with rate limits
+    """
+    results = {}
+    for name, limits in (('unlimited', {}), ('limited', __FLOOD_LIMITS__)):
+        server, thread = start_server(comport, options.get('io_process', False), **limits)
+        try:
+            proxy_for(server).status()
+            deadline = time.perf_counter() + duration
+            counts = [{'answered': 0, 'refused': 0, 'shed': 0} for _ in range(clients)]
+            flood = [Thread(target=_flood_client, args=(proxy_for(server), deadline, each))
+                     for each in counts]
+            for client in flood:
+                client.start()
+            sequencer = proxy_for(server)
+            cycles = []
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                sequencer.start(60.0)
+                sequencer.stop()
+                cycles.append(time.perf_counter() - start)
+            for client in flood:
+                client.join()
+            admission = sequencer.admission_stats()
+        finally:
+            stop_server(server, thread)
+        results[name] = {'limits': limits,
+                         'cycle': percentiles(cycles),
+                         'flood': {key: sum(each[key] for each in counts)
+                                   for key in counts[0]},
+                         'admission': {key: value for key, value in admission.items()
+                                       if key != 'shed_by_client'}}
+    return results
+
+
+BENCHMARKS = {
+    'status': bench_status,
+    'metrics': bench_metrics,
+    'load': bench_load,
+    'startup': bench_startup,
+    'replay': bench_replay,
+    'baud': bench_baud,
+    'flood': bench_flood,
+}
+
+
+def environment():
+    """Describe where and on what code a report was produced"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+
+if __name__ == '__main__':
+    import logging
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Benchmark the agitator server against a simulated controller')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS) + ['all'])
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('-c', '--comport', default=__DEFAULT_COMPORT__)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--sequencers', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--runs', type=int, default=5,
+                        help='server processes started by the startup benchmark')
+    parser.add_argument('--capture', default=None,
+                        help='serial capture to replay instead of recording one')
+    parser.add_argument('--io-process', action='store_true',
+                        help='run the server with its serial I/O in a separate process')
+    parser.add_argument('--rates', type=int, nargs='+', default=None,
+                        help='baud rates for the baud benchmark (default: all)')
+    parser.add_argument('-o', '--output', help='also write the report to this file')
+    args = parser.parse_args()
+
+    logging.getLogger('expres_agitator').disabled = True
+    options = vars(args)
+    names = sorted(BENCHMARKS) if args.benchmark == 'all' else [args.benchmark]
+    report = {'environment': environment(),
+              'config': {key: value for key, value in options.items()
+                         if key not in ('benchmark', 'output')},
+              'results': {name: BENCHMARKS[name](**options) for name in names}}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
@@ -1,16 +1,314 @@
-from xmlrpc.client import ServerProxy
+"""
+    EXPRES Fiber Agitator Client module
+
+    Provides XMLRPC clients for the AgitatorServer. Both clients keep their
+    HTTP/1.1 connections open between calls, apply a timeout to every call,
+    retry read-only calls that fail on the network and keep client-side
+    latency statistics. Calls that change the agitator are only repeated
+    with request_ids, which tags each call with a unique request ID so the
+    server runs it once however often it arrives.
+
+    AgitatorProxy is a blocking ServerProxy and should be used from one
+    thread at a time; AsyncAgitatorProxy offers the same method surface as
+    coroutines and can run several calls at once over a small connection
+    pool.
+"""
+import time
+import uuid
+import socket
+import asyncio
+import statistics
+import http.client
+import xmlrpc.client
+from collections import deque
+from xmlrpc.client import ServerProxy, Transport
 
 __DEFAULT_HOST__ = 'expres2.lowell.edu'
 __DEFAULT_PORT__ = 5001
+__DEFAULT_TIMEOUT__ = 10.0
+__DEFAULT_RETRIES__ = 2
+__DEFAULT_MAX_CONNECTIONS__ = 4
+__RETRY_DELAY__ = 0.05 # seconds, doubled on each further retry
+__STATS_WINDOW__ = 1000 # most recent calls kept per method
+
+# Calls that only read state and are therefore safe to repeat
+READ_ONLY_METHODS = frozenset((
+    'status', 'get_freq', 'read_enc', 'get_battery_voltage', 'get_current1',
+    'get_current2', 'get_voltage1', 'get_voltage2', 'get_max_voltage',
+    'get_min_voltage', 'get_max_current1', 'get_max_current2',
+    'system.listMethods', 'system.methodHelp', 'system.methodSignature',
+))
+
+# Network failures after which a read-only call is retried
+RETRYABLE_ERRORS = (OSError, http.client.HTTPException)
+
+
+def percentiles(samples):
+    """Summarize a list of latencies in seconds as milliseconds"""
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+
+    def pick(fraction):
+        return 1000 * samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    return {'count': len(samples),
+            'mean_ms': 1000 * statistics.fmean(samples),
+            'p50_ms': pick(0.50),
+            'p99_ms': pick(0.99),
+            'p999_ms': pick(0.999),
+            'max_ms': 1000 * samples[-1]}
+
+
+class LatencyStats(object):
+    """Per-method call latencies, retries and errors seen by a client"""
+
+    def __init__(self, window=__STATS_WINDOW__):
+        self.window = window
+        self.samples = {}
+        self.calls = {}
+        self.retries = {}
+        self.errors = {}
+
+    def record(self, method, elapsed, retries, failed):
+        if method not in self.samples:
+            self.samples[method] = deque(maxlen=self.window)
+            self.calls[method] = self.retries[method] = self.errors[method] = 0
+        self.samples[method].append(elapsed)
+        self.calls[method] += 1
+        self.retries[method] += retries
+        self.errors[method] += failed
+
+    def summary(self):
+        summary = {}
+        for method, samples in self.samples.items():
+            summary[method] = percentiles(samples)
+            summary[method].update(calls=self.calls[method],
+                                   retries=self.retries[method],
+                                   errors=self.errors[method])
+        return summary
+
+
+def _tag_request(method, params, retries, request_ids):
+    """
+    Return the params to send and how often the call may be retried: reads
+    always, other calls only when tagged with a request ID
+    """
+    # A controller prefix, as in blue.status, does not change what a method does
+    if method in READ_ONLY_METHODS or method.partition('.')[2] in READ_ONLY_METHODS:
+        return params, retries
+    if request_ids and method != 'system.multicall':
+        return params + ({'_request_id': uuid.uuid4().hex},), retries
+    return params, 0
+
+
+class _Method(object):
+    """Callable remote method name; supports dotted names like system.multicall"""
+
+    def __init__(self, send, name):
+        self._send = send
+        self._name = name
+
+    def __getattr__(self, name):
+        return _Method(self._send, '{}.{}'.format(self._name, name))
+
+    def __call__(self, *args):
+        return self._send(self._name, args)
+
+
+class KeepAliveTransport(Transport):
+    """Transport that applies a timeout and disables Nagle on its connection"""
+
+    def __init__(self, timeout=__DEFAULT_TIMEOUT__, **kwargs):
+        super().__init__(**kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self.timeout
+        if conn.sock is None:
+            conn.connect()
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
 
 class AgitatorProxy(ServerProxy):
     """
         Wrapper for ServerProxy that allow instantiation with only the host
-        name and port value.
+        name and port value. The connection is kept open between calls,
+        read-only calls are retried up to retries times on network errors,
+        and latency_stats() summarizes every call made so far. With
+        request_ids, other calls carry a request ID and are retried too.
+        None is marshalled by default, as the server allows it.
     """
-    def __init__(self, host, port, **kwargs):
+    def __init__(self, host, port, timeout=__DEFAULT_TIMEOUT__,
+                 retries=__DEFAULT_RETRIES__, request_ids=False, allow_none=True, **kwargs):
         self.url = 'http://{}:{}'.format(host, port)
-        super().__init__(self.url, **kwargs)
+        kwargs.setdefault('transport', KeepAliveTransport(
+            timeout=timeout, use_builtin_types=kwargs.get('use_builtin_types', False)))
+        super().__init__(self.url, allow_none=allow_none, **kwargs)
+        self._retries = retries
+        self._request_ids = request_ids
+        self._stats = LatencyStats()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _Method(self._call, name)
+
+    def _call(self, method, params):
+        params, retries = _tag_request(method, params, self._retries, self._request_ids)
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                result = self._ServerProxy__request(method, params)
+            except RETRYABLE_ERRORS:
+                self._ServerProxy__transport.close()
+                if attempt >= retries:
+                    self._stats.record(method, time.perf_counter() - start, attempt, True)
+                    raise
+                time.sleep(__RETRY_DELAY__ * 2 ** attempt)
+                attempt += 1
+            except xmlrpc.client.Fault:
+                self._stats.record(method, time.perf_counter() - start, attempt, True)
+                raise
+            else:
+                self._stats.record(method, time.perf_counter() - start, attempt, False)
+                return result
+
+    def latency_stats(self):
+        """Return latency percentiles, retries and errors per method"""
+        return self._stats.summary()
+
+
+class AsyncAgitatorProxy(object):
+    """
+    asyncio client with the same methods as AgitatorProxy, called as
+    coroutines (await proxy.status()). Up to max_connections calls run at
+    once, each on a persistent HTTP/1.1 connection.
+
+    Inputs
+    ------
+    host, port : str, int
+        Address of the AgitatorServer
+    timeout : float
+        Seconds allowed for each call
+    retries : int
+        Retries of read-only calls after a network error
+    request_ids : bool
+        Tag other calls with a request ID and retry them too
+    """
+
+    def __init__(self, host, port, timeout=__DEFAULT_TIMEOUT__,
+                 retries=__DEFAULT_RETRIES__,
+                 max_connections=__DEFAULT_MAX_CONNECTIONS__, allow_none=True,
+                 request_ids=False):
+        self.host = host
+        self.port = port
+        self.url = 'http://{}:{}'.format(host, port)
+        self._timeout = timeout
+        self._retries = retries
+        self._request_ids = request_ids
+        self._allow_none = allow_none
+        self._idle = []
+        self._slots = None
+        self._max_connections = max_connections
+        self._stats = LatencyStats()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _Method(self._call, name)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close every idle connection"""
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    def latency_stats(self):
+        """Return latency percentiles, retries and errors per method"""
+        return self._stats.summary()
+
+    async def _call(self, method, params):
+        params, retries = _tag_request(method, params, self._retries, self._request_ids)
+        body = xmlrpc.client.dumps(params, method,
+                                   allow_none=self._allow_none).encode('utf-8')
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                result = await asyncio.wait_for(self._request(body), self._timeout)
+            except (RETRYABLE_ERRORS + (asyncio.TimeoutError, asyncio.IncompleteReadError)):
+                if attempt >= retries:
+                    self._stats.record(method, time.perf_counter() - start, attempt, True)
+                    raise
+                await asyncio.sleep(__RETRY_DELAY__ * 2 ** attempt)
+                attempt += 1
+            except xmlrpc.client.Fault:
+                self._stats.record(method, time.perf_counter() - start, attempt, True)
+                raise
+            else:
+                self._stats.record(method, time.perf_counter() - start, attempt, False)
+                return result
+
+    async def _request(self, body):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_connections)
+        async with self._slots:
+            reused = bool(self._idle)
+            reader, writer = self._idle.pop() if reused else \
+                await asyncio.open_connection(self.host, self.port)
+            try:
+                result, keep_alive = await self._exchange(reader, writer, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+                # The server closed the idle connection; try a fresh one
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                result, keep_alive = await self._exchange(reader, writer, body)
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+            return result
+
+    async def _exchange(self, reader, writer, body):
+        writer.write(('POST /RPC2 HTTP/1.1\r\n'
+                      'Host: {}:{}\r\n'
+                      'User-Agent: AsyncAgitatorProxy\r\n'
+                      'Content-Type: text/xml\r\n'
+                      'Content-Length: {}\r\n\r\n').format(
+                          self.host, self.port, len(body)).encode('ascii') + body)
+        await writer.drain()
+
+        status = (await reader.readuntil(b'\r\n')).decode('latin-1').split(None, 2)
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        data = await reader.readexactly(int(headers.get('content-length', 0)))
+        if len(status) < 2 or status[1] != '200':
+            raise xmlrpc.client.ProtocolError(self.url, int(status[1]) if len(status) > 1 else 0,
+                                              ' '.join(status[2:]).strip(), headers)
+        keep_alive = (status[0] == 'HTTP/1.1' and
+                      headers.get('connection', '').lower() != 'close')
+        return xmlrpc.client.loads(data, use_builtin_types=True)[0][0], keep_alive
+
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
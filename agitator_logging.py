@@ -0,0 +1,172 @@
+"""
+    EXPRES Fiber Agitator Logging module
+
+    Sets up the shared 'expres_agitator' logger so that logging never
+    blocks the control or RPC threads: records are put on a queue by a
+    QueueHandler and written to the console and a daily rotating log file
+    by a QueueListener thread. Rotated files are gzipped on a separate
+    background thread so a rollover does not hold up the listener either.
+
+    setup_logging() is idempotent; every Agitator calls it, and only the
+    first call (or the first one after shutdown_logging()) installs the
+    pipeline. A child process (see agitator_process) calls
+    forward_logging() instead, so its records are written by the parent's
+    pipeline rather than a second handler on the same file.
+"""
+import os
+import gzip
+import queue
+import atexit
+import shutil
+import logging
+import logging.handlers
+from threading import Lock, Thread
+
+
+__LOGGER_NAME__ = 'expres_agitator'
+__DEFAULT_LOG_PATH__ = 'C:/Users/admin/agitator_logs/agitator.log'
+__FALLBACK_LOG_PATH__ = 'agitator.log'
+__LOG_PATH_ENV__ = 'EXPRES_AGITATOR_LOG' # Overrides the default log path
+__BACKUP_COUNT__ = 10
+__FORMAT__ = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_lock = Lock()
+_listener = None
+_queue_handler = None
+
+
+def default_log_path():
+    """
+    The log file used when none is configured: $EXPRES_AGITATOR_LOG, else
+    the observatory log folder if it exists, else agitator.log in the
+    working directory
+    """
+    path = os.environ.get(__LOG_PATH_ENV__)
+    if path:
+        return path
+    if os.path.isdir(os.path.dirname(__DEFAULT_LOG_PATH__)):
+        return __DEFAULT_LOG_PATH__
+    return __FALLBACK_LOG_PATH__
+
+
+def _gzip_rotated(path):
+    try:
+        with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+    except OSError as err:
+        logging.getLogger(__LOGGER_NAME__).warning(f'Could not compress {path}: {err}')
+
+
+class CompressingRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    TimedRotatingFileHandler that renames the finished file at rollover and
+    gzips it on a background thread. The .gz files still count towards
+    backupCount.
+    """
+
+    def rotate(self, source, dest):
+        if not os.path.exists(source):
+            return
+        if os.path.exists(dest):
+            os.remove(dest)
+        os.rename(source, dest)
+        Thread(target=_gzip_rotated, args=(dest,), name='agitator-log-gzip',
+               daemon=False).start()
+
+
+def setup_logging(path=None, level=logging.DEBUG, console_level=logging.INFO):
+    """
+    Install the queue-based pipeline on the 'expres_agitator' logger and
+    return the logger. Calls after the first return it unchanged.
+
+    Inputs
+    ------
+    path : str
+        Log file; see default_log_path() for the default
+    level : int
+        Lowest level written to the file
+    console_level : int
+        Lowest level written to the console
+    """
+    global _listener, _queue_handler
+    logger = logging.getLogger(__LOGGER_NAME__)
+    with _lock:
+        if _queue_handler is not None:
+            return logger
+
+        path = path or default_log_path()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        formatter = logging.Formatter(__FORMAT__)
+
+        fh = CompressingRotatingFileHandler(path, when='D', interval=1, utc=True,
+                                            backupCount=__BACKUP_COUNT__)
+        fh.setLevel(level)
+        fh.setFormatter(formatter)
+
+        ch = logging.StreamHandler()
+        ch.setLevel(console_level)
+        ch.setFormatter(formatter)
+
+        records = queue.SimpleQueue()
+        _queue_handler = logging.handlers.QueueHandler(records)
+        _listener = logging.handlers.QueueListener(records, fh, ch,
+                                                   respect_handler_level=True)
+        _listener.start()
+
+        logger.setLevel(min(level, console_level))
+        logger.addHandler(_queue_handler)
+    return logger
+
+
+def shutdown_logging():
+    """Write out any queued records and close the log handlers"""
+    global _listener, _queue_handler
+    with _lock:
+        if _queue_handler is None:
+            return
+        logging.getLogger(__LOGGER_NAME__).removeHandler(_queue_handler)
+        if _listener is not None:
+            _listener.stop() # Drains the queue before returning
+            for handler in _listener.handlers:
+                handler.close()
+        _listener = _queue_handler = None
+
+
+class _Redispatch(logging.Handler):
+    """Hands records from another process to this process's loggers"""
+
+    def handle(self, record):
+        logging.getLogger(record.name).handle(record)
+        return True
+
+
+def forward_logging(records, level=logging.DEBUG):
+    """
+    In a child process, send the 'expres_agitator' records to records (a
+    multiprocessing queue read by receive_logging() in the parent) instead
+    of writing them here. setup_logging() then leaves the logger as it is.
+    """
+    global _queue_handler
+    logger = logging.getLogger(__LOGGER_NAME__)
+    with _lock:
+        if _queue_handler is None:
+            _queue_handler = logging.handlers.QueueHandler(records)
+            logger.setLevel(level)
+            logger.addHandler(_queue_handler)
+    return logger
+
+
+def receive_logging(records):
+    """
+    Start a listener thread in the parent that logs the records a child
+    sends with forward_logging(); stop() it once the child has exited
+    """
+    listener = logging.handlers.QueueListener(records, _Redispatch())
+    listener.start()
+    return listener
+
+
+atexit.register(shutdown_logging)
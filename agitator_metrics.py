@@ -0,0 +1,189 @@
+"""
+    EXPRES Fiber Agitator Metrics module
+
+    Provides a small in-process metrics registry (counters and histograms)
+    and an HTTP endpoint that renders it, together with gauges read from
+    cached telemetry, in the Prometheus text exposition format. Rendering
+    only reads values already in memory, so a scrape never causes serial
+    I/O.
+"""
+import time
+from bisect import bisect_left
+from threading import Lock, Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Bucket upper bounds in seconds, from a fast cached RPC to a full
+# timeout-and-retry cycle on the serial line
+__DEFAULT_BUCKETS__ = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}'
+
+
+class Histogram(object):
+    """Cumulative-bucket histogram of observed values"""
+
+    def __init__(self, buckets=__DEFAULT_BUCKETS__):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels + (('le', bound),)), total))
+        lines.append('{}_sum{} {}'.format(name, _format_labels(labels), self.sum))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels), self.count))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    Thread-safe collection of labelled counters and histograms
+
+    Public Methods
+    --------------
+    inc(name, value=1, **labels):
+        Add to a counter
+    observe(name, value, **labels):
+        Record a value in a histogram
+    render():
+        Return all metrics as Prometheus text lines
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, text):
+        """Set the HELP text for a metric"""
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        """Return the current value of a counter"""
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters),
+                                  ('histogram', self._histograms)):
+                seen = set()
+                for (name, labels), value in sorted(metrics.items(),
+                                                    key=lambda item: item[0]):
+                    if name not in seen:
+                        seen.add(name)
+                        if name in self._help:
+                            lines.append(f'# HELP {name} {self._help[name]}')
+                        lines.append(f'# TYPE {name} {kind}')
+                    if kind == 'counter':
+                        lines.append(f'{name}{_format_labels(labels)} {value}')
+                    else:
+                        lines.extend(value.render(name, labels))
+        return lines
+
+
+def render_gauges(gauges):
+    """
+    Render a {name: (help, value)} dictionary of gauges as text lines. The
+    value may also be a list of (labels, value) pairs, one per series.
+    """
+    lines = []
+    for name, (text, value) in gauges.items():
+        series = value if isinstance(value, list) else [({}, value)]
+        series = [(labels, value) for labels, value in series if value is not None]
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in series:
+            lines.append(f'{name}{_format_labels(tuple(sorted(labels.items())))} {float(value)}')
+    return lines
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    HTTP server answering GET /metrics with the text returned by collect(),
+    a callable that must only read in-memory state
+
+    Inputs
+    ------
+    host, port : str, int
+        Address to listen on
+    collect : callable
+        Returns the list of exposition lines for one scrape
+    """
+    daemon_threads = True
+
+    def __init__(self, host, port, collect):
+        super().__init__((host, port), MetricsHandler)
+        self.collect = collect
+        self.scrapes = 0
+        self.scrape_time = 0.0 # Total seconds spent rendering scrapes
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever, name='agitator-metrics',
+                              daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def render(self):
+        start = time.perf_counter()
+        lines = self.collect()
+        lines.append('# TYPE agitator_metrics_scrapes_total counter')
+        lines.append(f'agitator_metrics_scrapes_total {self.scrapes}')
+        lines.append('# TYPE agitator_metrics_scrape_seconds_total counter')
+        lines.append(f'agitator_metrics_scrape_seconds_total {self.scrape_time}')
+        self.scrapes += 1
+        self.scrape_time += time.perf_counter() - start
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes are frequent; don't write them to stderr
@@ -0,0 +1,518 @@
+"""
+    EXPRES Fiber Agitator I/O Process module
+
+    Runs the Roboclaw I/O, telemetry polling and agitation threads for one
+    serial port in a separate process, so that XML parsing and other work
+    in the server process never holds the GIL while a motor command is due.
+
+    Commands travel over a multiprocessing Pipe as small (id, agitator,
+    method, args) tuples and are run on a few threads in the child, so a
+    stop() waiting for its agitation thread does not hold up other calls.
+    Telemetry and agitation state are published by the child into a
+    multiprocessing.shared_memory segment, one fixed block of float64 slots
+    per agitator guarded by a sequence counter, so the server (and any other
+    local tool that attaches to the segment by name) reads status without a
+    round trip to the child.
+
+    RemoteAgitator stands in for an Agitator in the server: status(), the
+    cached readers and the link, setpoint and link usage statistics scraped
+    for /metrics are answered from shared memory, and every other public
+    method is forwarded to the child.
+
+    The server's health() lists the segment of each port. To watch one
+    from another local process, execute from the containing folder:
+    python agitator_process.py <segment> [<number of agitators>]
+"""
+import math
+import time
+import struct
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event, Lock, Thread
+
+
+__COMMAND_THREADS__ = 4
+__PUBLISH_INTERVAL__ = 0.2 # seconds between state publications besides each poll
+__WATCH_INTERVAL__ = 0.05 # seconds between checks for new telemetry by listeners
+__READ_TIMEOUT__ = 1.0 # seconds a reader waits out a publication in progress
+__START_TIMEOUT__ = 60.0
+
+# Terms of a velocity PID tuple, and the numeric keys of the link and
+# setpoint statistics, each published in a slot of its own
+_PID_TERMS = ('p', 'i', 'd', 'qpps')
+_LINK_STATS = ('up', 'losses', 'reconnects', 'attempts', 'failed_fast',
+               'last_recovery_s', 'max_recovery_s', 'downtime_s', 'down_for_s')
+_SETPOINT_STATS = ('sent', 'suppressed', 'failed')
+_USAGE_STATS = ('budget_bytes_per_s', 'demand_bytes_per_s', 'planned_bytes_per_s',
+                'measured_bytes_per_s', 'link_bytes_per_s', 'link_utilization', 'scale')
+
+# Values published per agitator, in slot order. Missing values are NaN.
+FIELDS = (('seq', 'time', 'battery_voltage', 'current1', 'current2',
+           'enc1', 'enc1_status', 'enc2', 'enc2_status', 'speed1', 'speed2',
+           'temperature', 'error', 'config')
+          + tuple(f'velocity_pid{motor}_{term}' for motor in (1, 2) for term in _PID_TERMS)
+          + ('freq', 'voltage1', 'voltage2', 'agitating', 'crc_errors')
+          + tuple(f'link_{name}' for name in _LINK_STATS)
+          + tuple(f'setpoints_{name}' for name in _SETPOINT_STATS)
+          + ('usage_active',) + tuple(f'usage_{name}' for name in _USAGE_STATS))
+_INTEGERS = ({'seq', 'enc1', 'enc1_status', 'enc2', 'enc2_status', 'speed1',
+              'speed2', 'error', 'config', 'crc_errors', 'velocity_pid1_qpps',
+              'velocity_pid2_qpps', 'link_losses', 'link_reconnects',
+              'link_attempts', 'link_failed_fast'}
+             | {f'setpoints_{name}' for name in _SETPOINT_STATS})
+# Published for the server's metrics, but not part of status()
+_COUNTERS = (('crc_errors',) + tuple(f'link_{name}' for name in _LINK_STATS)
+             + tuple(f'setpoints_{name}' for name in _SETPOINT_STATS)
+             + ('usage_active',) + tuple(f'usage_{name}' for name in _USAGE_STATS))
+_COUNTER = struct.Struct('<Q')
+_VALUES = struct.Struct(f'<{len(FIELDS)}d')
+BLOCK_SIZE = _COUNTER.size + _VALUES.size
+
+
+class TelemetryBlock(object):
+    """One agitator's slots in the shared memory segment
+
+    A writer makes the sequence counter odd, writes the values and makes
+    it even again; a reader retries until it sees the same even counter
+    before and after copying the values, so it never returns a torn mix of
+    two publications. Only one process (the I/O process) writes. A reader
+    gives up after __READ_TIMEOUT__, so a writer that died midway does not
+    leave it spinning; alive, if given, tells whether the writer still runs.
+    """
+
+    def __init__(self, buf, offset, alive=None):
+        self._buf = buf
+        self._offset = offset
+        self._alive = alive
+        self._lock = Lock() # Writers within the I/O process
+
+    def publish(self, values):
+        values = dict(values)
+        for motor in (1, 2):
+            pid = values.pop(f'velocity_pid{motor}', None)
+            if pid is not None:
+                values.update(zip((f'velocity_pid{motor}_{term}' for term in _PID_TERMS), pid))
+        row = tuple(float('nan') if values.get(name) is None else float(values[name])
+                    for name in FIELDS)
+        with self._lock:
+            (count,) = _COUNTER.unpack_from(self._buf, self._offset)
+            _COUNTER.pack_into(self._buf, self._offset, count + 1)
+            _VALUES.pack_into(self._buf, self._offset + _COUNTER.size, *row)
+            _COUNTER.pack_into(self._buf, self._offset, count + 2)
+
+    def read(self):
+        """Return the latest published values as a dict (empty before the first)"""
+        give_up = None
+        while True:
+            (before,) = _COUNTER.unpack_from(self._buf, self._offset)
+            if before % 2 == 0:
+                row = _VALUES.unpack_from(self._buf, self._offset + _COUNTER.size)
+                (after,) = _COUNTER.unpack_from(self._buf, self._offset)
+                if before == after:
+                    break
+            now = time.monotonic()
+            if give_up is None:
+                give_up = now + __READ_TIMEOUT__
+            elif now > give_up:
+                if self._alive is not None and not self._alive():
+                    raise RuntimeError('I/O process exited while publishing telemetry')
+                raise TimeoutError(f'Telemetry publication still in progress '
+                                   f'after {__READ_TIMEOUT__}s')
+            time.sleep(0)
+        if before == 0:
+            return {}
+        values = {}
+        for name, value in zip(FIELDS, row):
+            if not math.isnan(value):
+                values[name] = int(value) if name in _INTEGERS else value
+        values['agitating'] = bool(values.get('agitating'))
+        for motor in (1, 2):
+            terms = [values.pop(f'velocity_pid{motor}_{term}', None) for term in _PID_TERMS]
+            if None not in terms:
+                values[f'velocity_pid{motor}'] = tuple(terms)
+        return values
+
+
+def _state(agitator):
+    """The values published for an agitator in the I/O process"""
+    values = agitator.telemetry.snapshot()
+    values.update(freq=agitator.freq, voltage1=agitator.voltage1,
+                  voltage2=agitator.voltage2, agitating=agitator.agitating,
+                  crc_errors=agitator.crc_errors)
+    link = agitator.link_stats()
+    values.update((f'link_{name}', link.get(name)) for name in _LINK_STATS)
+    setpoints = agitator.setpoint_stats()
+    values.update((f'setpoints_{name}', setpoints[name]) for name in _SETPOINT_STATS)
+    usage = agitator.telemetry.usage()
+    values['usage_active'] = usage['mode'] == 'agitating'
+    values.update((f'usage_{name}', usage[name]) for name in _USAGE_STATS)
+    return values
+
+
+def _serve(conn, records, segment, comport, controllers, options):
+    """Entry point of the I/O process"""
+    from agitator_logging import forward_logging
+    logger = forward_logging(records)
+    shm = shared_memory.SharedMemory(name=segment)
+    agitators = {}
+    bus = None
+    try:
+        from expres_agitator import Agitator, open_bus
+        addrs = [addr for _, addr in controllers]
+        bus = open_bus(comport, addrs[0], options.get('capture'),
+                       options.get('baud'), addrs)
+        blocks = {}
+        for index, (name, addr) in enumerate(controllers):
+            agitator = Agitator(addr=addr, bus=bus, profile=options.get('profile'))
+            agitators[name] = agitator
+            blocks[name] = TelemetryBlock(shm.buf, index * BLOCK_SIZE)
+            agitator.telemetry.add_listener(
+                lambda _, agitator=agitator, block=blocks[name]: block.publish(_state(agitator)))
+            blocks[name].publish(_state(agitator))
+            agitator.telemetry.start()
+    except Exception as err:
+        conn.send(('failed', f'{type(err).__name__}: {err}'))
+        for agitator in agitators.values():
+            agitator.close()
+        if bus is not None:
+            bus.close()
+        shm.close()
+        return
+    conn.send(('ready', None))
+
+    sending = Lock()
+    closed = Event()
+
+    def publish_all():
+        for name, agitator in agitators.items():
+            blocks[name].publish(_state(agitator))
+
+    def publisher():
+        # Catches changes made by agitation threads between telemetry polls
+        while not closed.wait(__PUBLISH_INTERVAL__):
+            publish_all()
+
+    def run(call_id, name, method, args, kwargs):
+        try:
+            result = ('ok', getattr(agitators[name], method)(*args, **kwargs))
+        except Exception as err:
+            result = ('error', f'{type(err).__name__}: {err}')
+        publish_all()
+        with sending:
+            conn.send((call_id,) + result)
+
+    Thread(target=publisher, name='agitator-publish', daemon=True).start()
+    pool = ThreadPoolExecutor(max_workers=__COMMAND_THREADS__,
+                              thread_name_prefix='agitator-command')
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError: # The server went away; stop the motors anyway
+                break
+            if message is None:
+                break
+            pool.submit(run, *message)
+    finally:
+        pool.shutdown(wait=True)
+        closed.set()
+        try:
+            for agitator in agitators.values():
+                agitator.close()
+            bus.close()
+        finally:
+            logger.info(f'I/O process for {comport} stopped')
+            shm.close()
+
+
+class AgitatorProcess(object):
+    """Agitators for the controllers on one serial port, run in a child process
+
+    Inputs
+    ------
+    comport : str
+        The serial port
+    controllers : list
+        (name, addr) of each controller on the port
+    profile : ControllerProfile
+        Configuration to reconcile each controller against
+    capture : str
+        Record the port's serial traffic to this file
+    baud : int
+        Baud rate to move the controllers to
+
+    Public Methods
+    --------------
+    agitator(name):
+        Return the RemoteAgitator for a controller
+    call(name, method, *args, **kwargs):
+        Run an Agitator method in the child and wait for its result
+    close():
+        Stop the agitators, close the port and end the child process
+    """
+
+    def __init__(self, comport, controllers, profile=None, capture=None, baud=None):
+        self.comport = comport
+        self.controllers = list(controllers)
+        self.logger = logging.getLogger('expres_agitator')
+        # spawn on every platform: forking a threaded server is not safe
+        context = multiprocessing.get_context('spawn')
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=BLOCK_SIZE * len(self.controllers))
+        self.shm.buf[:] = bytes(self.shm.size)
+        from agitator_logging import receive_logging
+        records = context.Queue()
+        self._log_listener = receive_logging(records)
+        self._conn, child = context.Pipe()
+        self._process = context.Process(
+            target=_serve, name=f'agitator-io-{comport}', daemon=True,
+            args=(child, records, self.shm.name, comport, self.controllers,
+                  {'profile': profile, 'capture': capture, 'baud': baud}))
+
+        self._pending = {}
+        self._ids = 0
+        self._lock = Lock()
+        self._closed = False
+        try:
+            self._process.start()
+            child.close()
+            if not self._conn.poll(__START_TIMEOUT__):
+                raise RuntimeError(f'I/O process for {comport} did not start')
+            try:
+                status, error = self._conn.recv()
+            except EOFError:
+                raise RuntimeError(f'I/O process for {comport} exited while starting')
+            if status != 'ready':
+                raise RuntimeError(error)
+        except BaseException:
+            self._cleanup()
+            raise
+        self._receiver = Thread(target=self._receive, name='agitator-io-replies',
+                                daemon=True)
+        self._receiver.start()
+        self._agitators = {name: RemoteAgitator(self, name, TelemetryBlock(
+                               self.shm.buf, index * BLOCK_SIZE, self._process.is_alive))
+                           for index, (name, _) in enumerate(self.controllers)}
+
+    @property
+    def segment(self):
+        """Name other local processes attach to the telemetry segment with"""
+        return self.shm.name
+
+    def agitator(self, name):
+        return self._agitators[name]
+
+    def call(self, name, method, *args, **kwargs):
+        """Run agitators[name].method(*args, **kwargs) in the child"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f'I/O process for {self.comport} is closed')
+            self._ids += 1
+            self._pending[self._ids] = future
+            self._conn.send((self._ids, name, method, args, kwargs))
+        return future.result()
+
+    def close(self):
+        """Stop the agitators in the child, close its port and wait for it"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+        self._process.join()
+        self._receiver.join()
+        self._cleanup()
+
+    def _receive(self):
+        while True:
+            try:
+                call_id, status, value = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self._pending.pop(call_id)
+            if status == 'ok':
+                future.set_result(value)
+            else:
+                future.set_exception(Exception(value))
+        with self._lock:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError(f'I/O process for {self.comport} exited'))
+
+    def _cleanup(self):
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._conn.close()
+        self._log_listener.stop()
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(segment, count=1):
+    """
+    Attach to the telemetry segment of a running AgitatorProcess from
+    another local process. Returns (shm, blocks); close shm when done, but
+    never unlink it.
+    """
+    shm = shared_memory.SharedMemory(name=segment)
+    # Before Python 3.13 the resource tracker would remove the segment when
+    # this process exits, even though the I/O process still owns it
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm, [TelemetryBlock(shm.buf, index * BLOCK_SIZE) for index in range(count)]
+
+
+class SharedTelemetry(object):
+    """The parts of TelemetryPoller the server uses, read from shared memory"""
+
+    def __init__(self, process, name, block):
+        self._process = process
+        self._name = name
+        self._block = block
+        self._listeners = []
+        self._lock = Lock()
+        self._watcher = None
+
+    def snapshot(self):
+        values = self._block.read()
+        for name in ('freq', 'voltage1', 'voltage2', 'agitating') + _COUNTERS:
+            values.pop(name, None)
+        return values
+
+    def usage(self):
+        """
+        The planned and measured link load, from shared memory; the reads
+        per register class are left to the agitator's telemetry_usage()
+        """
+        values = self._block.read()
+        usage = {name: values.get(f'usage_{name}', 0.0) for name in _USAGE_STATS}
+        usage['mode'] = 'agitating' if values.get('usage_active') else 'idle'
+        return usage
+
+    def start(self):
+        pass # The I/O process polls on its own
+
+    def stop(self):
+        pass
+
+    def add_listener(self, callback):
+        """Call callback(snapshot) for each new poll, checked every __WATCH_INTERVAL__"""
+        with self._lock:
+            self._listeners = self._listeners + [callback]
+            if self._watcher is None:
+                self._watcher = Thread(target=self._watch, name='agitator-telemetry-watch',
+                                       daemon=True)
+                self._watcher.start()
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners = [cb for cb in self._listeners if cb != callback]
+
+    def _watch(self):
+        seq = None
+        while not self._process._closed:
+            snapshot = self.snapshot()
+            if snapshot.get('seq') != seq:
+                seq = snapshot.get('seq')
+                for callback in self._listeners:
+                    try:
+                        callback(snapshot)
+                    except Exception as err:
+                        logging.getLogger('expres_agitator').warning(
+                            f'Telemetry listener {callback} failed: {err}')
+            time.sleep(__WATCH_INTERVAL__)
+
+
+class RemoteAgitator(object):
+    """Stand-in for an Agitator running in an AgitatorProcess
+
+    status(), the commanded state, the link and setpoint statistics and the
+    telemetry snapshot come from shared memory; other public methods run in
+    the I/O process. The agitator itself is closed by closing its
+    AgitatorProcess.
+    """
+
+    def __init__(self, process, name, block):
+        self._process = process
+        self._name = name
+        self._block = block
+        self.telemetry = SharedTelemetry(process, name, block)
+        self._last_error = (0, None) # (link attempts, last error) when last fetched
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            return self._process.call(self._name, method, *args, **kwargs)
+        call.__name__ = method
+        return call
+
+    def status(self):
+        values = self._block.read()
+        if not values.get('seq'):
+            return self._process.call(self._name, 'status')
+        for name in _COUNTERS:
+            values.pop(name, None)
+        values['age'] = time.time() - values['time']
+        return values
+
+    def link_stats(self):
+        values = self._block.read()
+        stats = {name: values.get(f'link_{name}') for name in _LINK_STATS
+                 if name != 'down_for_s'}
+        stats['up'] = bool(stats['up'])
+        if 'link_down_for_s' in values:
+            stats['down_for_s'] = values['link_down_for_s']
+        # The error text has no slot; fetch it only after a new failed attempt
+        attempts, last_error = self._last_error
+        if stats['attempts'] and stats['attempts'] != attempts:
+            last_error = self._process.call(self._name, 'link_stats')['last_error']
+            self._last_error = (stats['attempts'], last_error)
+        stats['last_error'] = last_error
+        return stats
+
+    def setpoint_stats(self):
+        values = self._block.read()
+        return {name: values.get(f'setpoints_{name}', 0) for name in _SETPOINT_STATS}
+
+    @property
+    def agitating(self):
+        return self._block.read().get('agitating', False)
+
+    @property
+    def freq(self):
+        return self._block.read().get('freq', 0)
+
+    @property
+    def crc_errors(self):
+        return self._block.read().get('crc_errors', 0)
+
+    def join(self, timeout=None):
+        pass # stop() in the I/O process waits for the agitation thread
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    import sys
+
+    shm, blocks = attach(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+    try:
+        while True:
+            print(' | '.join(str(block.read()) for block in blocks))
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        blocks = None # Release the views of the buffer before closing it
+        shm.close()
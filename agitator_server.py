@@ -2,70 +2,1099 @@
     EXPRES Fiber Agitator Server module
 
     Provides an XMLRPC server that will send/receive messages
-    to/from an Agitator object.
+    to/from an Agitator object. Requests are handled concurrently by a
+    bounded pool of worker threads; read-only status methods are answered
+    from cached telemetry so they never wait behind serial I/O. Pollers
+    should prefer the status() method, or batch calls with system.multicall,
+    over one request per value.
+
+    Several agitators can be served at once, one per Roboclaw controller.
+    Controllers on separate serial ports run their I/O in parallel, and
+    those multi-dropped on one port share it fairly. Calls without a prefix
+    go to the first (default) agitator; prefix a method with the controller
+    name, e.g. 'blue.start', to reach another, or use start_all, stop_all
+    and status_all to drive them together. stop() returns the exposure
+    summary (delivered rotations and telemetry statistics), which
+    exposure_summary() and exposure_summary_all also return afterwards.
+
+    Any call may end with a struct of call options. With
+    {'_request_id': ID} the server runs the call once per ID and answers
+    repeats (a client retrying after a timeout) with the first result, so
+    mutating calls such as start can be retried safely. Identical reads
+    that reach the controller while one is already in flight share its
+    result instead of each making the trip.
+
+    Calls can also be given a time limit, so that work queued behind load
+    or a serial stall is dropped rather than run late: '_deadline' is the
+    latest wall-clock time (time.time() on the client, so clocks must be
+    synchronized) and '_max_age' the most seconds after the server received
+    the call that it may start. Expired calls fail with DeadlineExceeded
+    before they reach the controller, and so do any of their controller
+    commands still queued for the serial port when it passes. Only the
+    stop methods (stop, stop_all, stop_agitation and request_stop) ignore
+    both limits, so a late stop still stops the motors while a late start
+    does not start them. start and start_all accept '_exposure_start', the
+    wall-clock time the shutter opened; exp_time and timeout (by default
+    the rest of the window) are then shortened by the time already gone,
+    and the call is dropped if the exposure is over.
+    deadline_stats() counts what was dropped and shortened, and by how much.
+
+    Load is shed instead of queued without bound (see admission). Requests
+    over a per-client or per-method rate limit, and connections arriving
+    while max_pending are already waiting for a worker, are answered with
+    HTTP 503 and a Retry-After header. Calls that go to the controller
+    pass a small gate with a bounded queue, and those shed there fail with
+    fault code 503. Control methods such as start and stop are never
+    limited, skip the gate and are run by workers of their own, never
+    turned away or queued behind other requests, so they are not stuck
+    behind a flood of reads. admission_stats() counts what was shed and why.
 """
+import io
+import os
+import re
+import math
+import time
+import xmlrpc.client
+import socket
+import logging
+import selectors
+import tracing
+from collections import deque
+from threading import Event, Lock, Thread, local
+from concurrent.futures import ThreadPoolExecutor
 from xmlrpc.server import SimpleXMLRPCServer as RPCServer
-from expres_agitator import Agitator
+from xmlrpc.server import SimpleXMLRPCRequestHandler, resolve_dotted_attribute
+from expres_agitator import Agitator, AgitatorGroup, open_bus
+from controller_profile import ControllerProfile
+from agitator_logging import setup_logging
+from request_cache import RequestCache, SingleFlight
+from exposure_stats import RunningStats
+from roboclaw_io import DeadlineExceeded, deadline as io_deadline
+from admission import AdmissionControl, Overloaded, is_control, is_stop
 
 
 __DEFAULT_HOST__ = 'expres2.lowell.edu'
 __DEFAULT_PORT__ = 5001
 __DEFAULT_COMPORT__ = 'COM12'
+__DEFAULT_ADDR__ = 0x80
+__DEFAULT_NAME__ = 'agitator'
+__DEFAULT_MAX_WORKERS__ = 8
+__KEEPALIVE_TIMEOUT__ = 5.0 # seconds an idle keep-alive connection is kept open
+__REQUEST_TIMEOUT__ = 5.0 # seconds a worker waits for the rest of a request
+__BRING_UP_RETRY__ = 5.0 # seconds between attempts to open the controllers
+__STARTUP_WAIT__ = 30.0 # seconds a call waits for the first bring-up attempt
+__DEFAULT_MAX_PENDING__ = 32 # connections that may wait for a worker
+__CONTROL_WORKERS__ = 2 # workers kept for control calls such as stop
+__READ_AHEAD__ = 8192 # bytes of a request read by the serve loop to find its method
+
+
+def _cached_read_enc(snapshot):
+    if 'enc1' not in snapshot or 'enc2' not in snapshot:
+        return None
+    return {'result': {'enc1': (1, snapshot['enc1'], snapshot['enc1_status']),
+                       'enc2': (1, snapshot['enc2'], snapshot['enc2_status'])}}
+
+
+def _cached_battery_voltage(snapshot):
+    # A bad reading falls through to Agitator.get_battery_voltage, which
+    # substitutes its nominal voltage
+    voltage = snapshot.get('battery_voltage')
+    return voltage if voltage is not None and voltage > 0.0 else None
+
+
+# Read-only RPC methods that are answered from the telemetry snapshot.
+# Each reader returns None when the snapshot does not hold the value yet,
+# in which case the call falls through to the Agitator itself.
+CACHED_METHODS = {
+    'read_enc': _cached_read_enc,
+    'get_battery_voltage': _cached_battery_voltage,
+    'get_current1': lambda snapshot: snapshot.get('current1'),
+    'get_current2': lambda snapshot: snapshot.get('current2'),
+}
+
+
+# Reads that may go to the controller; identical ones in flight together
+# share one result
+COALESCED_METHODS = frozenset((
+    'status', 'read_enc', 'get_battery_voltage', 'get_current1',
+    'get_current2', 'get_max_voltage', 'get_min_voltage', 'get_max_current1',
+    'get_max_current2',
+))
+
+# Agitator methods that go to the controller, and so pass the admission
+# gate; the others are answered from memory. status() only reaches the
+# controller before the first telemetry poll.
+SERIAL_METHODS = frozenset((
+    'apply_profile', 'read_enc', 'zero_enc', 'get_battery_voltage',
+    'get_current1', 'get_current2', 'get_max_voltage', 'set_max_voltage',
+    'get_min_voltage', 'set_min_voltage', 'get_max_current1',
+    'set_max_current1', 'get_max_current2', 'set_max_current2',
+))
+
+# Keys of the options struct a client may append to any call
+CALL_OPTIONS = frozenset(('_request_id', '_deadline', '_max_age', '_exposure_start'))
+
+# Calls taking (exp_time, timeout) that can be fitted to the shutter window
+WINDOWED_METHODS = frozenset(('start', 'start_all'))
+
+
+# The body length of an HTTP request, and the method of a single XML-RPC call
+_CONTENT_LENGTH = re.compile(rb'\r\ncontent-length:[ \t]*(\d+)', re.IGNORECASE)
+_METHOD_NAME = re.compile(rb'<methodName>\s*([\w.]+)\s*</methodName>')
+
+
+def request_complete(data):
+    """True once data holds a whole HTTP request (headers and body)"""
+    end = data.find(b'\r\n\r\n')
+    if end < 0:
+        return False
+    length = _CONTENT_LENGTH.search(data, 0, end + 2)
+    return len(data) >= end + 4 + (int(length.group(1)) if length else 0)
+
+
+class _Buffered(io.RawIOBase):
+    """Reads the bytes the serve loop already took from a socket, then the socket"""
+
+    def __init__(self, data, raw):
+        self._data = memoryview(data)
+        self._raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not self._data:
+            return self._raw.readinto(buf)
+        count = min(len(buf), len(self._data))
+        buf[:count] = self._data[:count]
+        self._data = self._data[count:]
+        return count
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+def called_methods(data):
+    """The method names of an XML-RPC request body, looking into multicalls"""
+    params, method = xmlrpc.client.loads(data)
+    if method == 'system.multicall' and params and isinstance(params[0], list):
+        return [call.get('methodName', '') for call in params[0] if isinstance(call, dict)]
+    return [method]
+
+
+def split_options(params):
+    """Separate a trailing call options struct from the call parameters"""
+    if (params and isinstance(params[-1], dict) and params[-1]
+            and set(params[-1]) <= CALL_OPTIONS):
+        return params[:-1], params[-1]
+    return params, {}
+
+
+class AgitatorRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    Request handler that keeps HTTP/1.1 connections open between calls so
+    clients do not pay for TCP setup on every request. A worker answers the
+    requests that have arrived and then returns; the server watches the
+    open connection for the next one, so an idle connection never holds a
+    worker. Connections idle for __KEEPALIVE_TIMEOUT__ seconds are closed.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = __REQUEST_TIMEOUT__
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        data = self.server.buffered()
+        if data:
+            self.rfile = io.BufferedReader(_Buffered(data, self.rfile.detach()))
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._input_waiting():
+            self.handle_one_request()
+
+    def _input_waiting(self):
+        """True if the next request has already arrived, without waiting for it"""
+        self.connection.settimeout(0.0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def do_POST(self):
+        self.server.received() # Times the call for its '_max_age' option
+        super().do_POST()
+
+    def decode_request_content(self, data):
+        """Turn away requests over their rate limit before dispatching them"""
+        data = super().decode_request_content(data)
+        if data is None:
+            return None
+        try:
+            self.server.admit(self.client_address[0], data)
+        except Overloaded as err:
+            # Close the connection too, so a refused client does not hold
+            # a worker while it waits to retry
+            self.send_response(503)
+            self.send_header('Retry-After', str(max(1, math.ceil(err.retry_after))))
+            self.send_header('Content-Length', '0')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            return None # Response has been sent
+        return data
+
+    def do_GET(self):
+        """Answer GET /health for load balancers and service monitors"""
+        if self.path.split('?')[0] != '/health':
+            self.report_404()
+            return
+        ready = self.server.ready
+        body = (b'ok\n' if ready else b'starting\n')
+        self.send_response(200 if ready else 503)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_error(self, format, *args):
+        # Idle keep-alive timeouts are routine; keep them off stderr, which
+        # does not exist when running as a service
+        logging.getLogger('expres_agitator').debug(format % args)
 
 
 class AgitatorServer(RPCServer):
     """
         Extension of builtin Python XMLRPC Server that registers an instance
         of the Agitator class (with the given COM port) at the given host and
-        port.
+        port. Up to max_workers requests are handled at once; all controller
+        I/O is still serialized through the Roboclaw bus of each serial
+        port. If controllers ({name: (comport, addr)}) is given, an Agitator
+        is created for each of them and comport is ignored; the first one is
+        the default agitator. Each controller is reconciled against profile
+        (a ControllerProfile), writing only the settings that differ. If
+        stream_port is given, an AgitatorSocketServer sharing the default
+        Agitator is started there so clients can subscribe to telemetry. If
+        metrics_port is given, RPC and serial statistics are collected and
+        served over HTTP at /metrics. trace_start() and trace_stop() record
+        tracing spans and return them as Chrome trace-event JSON. If capture is a file path, the serial
+        traffic of each port is recorded to it (numbered per port when
+        there are several); see serial_capture. If baud is given, the
+        controllers on each port are moved to that baud rate when it is
+        opened; see roboclaw_baud. With io_process, the I/O and agitation
+        of each port run in a child process and status is read from shared
+        memory (see agitator_process); serial statistics are then not
+        collected for /metrics. client_rate and client_burst limit the
+        requests per second from each client address, and method_limits
+        ({method: (rate, burst)}) the calls to a method from all clients;
+        at most max_pending connections wait for a worker (see admission).
+
+        The socket is bound and answers health() (and GET /health) as soon
+        as the server is constructed; the controllers are brought up on a
+        background thread, retrying until they respond. Other calls wait
+        for bring-up, or fail at once with the reason it has not finished.
     """
     def __init__(self, host=__DEFAULT_HOST__, port=__DEFAULT_PORT__,
-                 comport=__DEFAULT_COMPORT__, **kwargs):
+                 comport=__DEFAULT_COMPORT__,
+                 max_workers=__DEFAULT_MAX_WORKERS__, stream_port=None,
+                 metrics_port=None, controllers=None, profile=None,
+                 capture=None, baud=None, io_process=False, client_rate=None,
+                 client_burst=None, method_limits=None,
+                 max_pending=__DEFAULT_MAX_PENDING__, **kwargs):
+        self._created = time.perf_counter()
+        kwargs.setdefault('requestHandler', AgitatorRequestHandler)
         super().__init__((host, port), **kwargs)
-        self.agitator = Agitator(comport)
-        self.agitator.logger.info('Opening agitator server on http://{}:{}'.format(host, port))
-        self.register_instance(self.agitator)
+        self.logger = setup_logging()
+        if not controllers:
+            controllers = {__DEFAULT_NAME__: (comport, __DEFAULT_ADDR__)}
+        self._controllers = dict(controllers)
+        self._profile = profile
+        self._capture = capture
+        self._baud = baud
+        self._io_process = io_process
+        self._host = host
+        self._stream_port = stream_port
 
-    def serve_forever(self):
-        self.agitator.logger.info('Starting agitator server')
+        # Filled in by the bring-up thread once every controller responds.
+        # One bus (and I/O thread) per serial port, shared by every
+        # controller multi-dropped on it
+        self.buses = {}
+        self.agitators = {}
+        self.agitator = None
+        self.group = None
+        self.stream_server = None
+        self.startup_time = None # Seconds from construction to ready
+        self.startup_error = None
+        self.startup_attempts = 0
+        self._ready = Event()
+        self._attempted = Event() # Set once the first bring-up attempt ends
+
+        self.logger.info('Opening agitator server on http://{}:{} for {}'.format(
+            host, port, ', '.join(self._controllers)))
+        self.register_function(self.health, 'health')
+        self.register_function(self.trace_start, 'trace_start')
+        self.register_function(self.trace_stop, 'trace_stop')
+        self.register_function(self.request_stats, 'request_stats')
+        self.register_function(self.deadline_stats, 'deadline_stats')
+        self.register_function(self.admission_stats, 'admission_stats')
+        self.register_multicall_functions()
+
+        # Outcomes of calls made with a request ID, and reads in flight
+        self.requests = RequestCache()
+        self.flights = SingleFlight()
+
+        # Monotonic time each handler thread's current request arrived, and
+        # the calls dropped or shortened for being late
+        self._arrival = local()
+        self._late_lock = Lock()
+        self._late = {'dispatch': 0, 'controller': 0, 'window': 0, 'shortened': 0}
+        self._lateness = RunningStats() # seconds past the deadline of dropped calls
+        self._shortening = RunningStats() # seconds taken off shortened exposures
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix='agitator-rpc')
+        # Control calls skip the queue for the pool above
+        self._control_pool = ThreadPoolExecutor(max_workers=__CONTROL_WORKERS__,
+                                                thread_name_prefix='agitator-control')
+
+        # Rate limits, and bounds on the work waiting for a worker or for
+        # the serial port
+        self.admission = AdmissionControl(client_rate, client_burst, method_limits)
+        self.max_pending = max_pending
+        self._pending = 0 # connections with a request waiting for a worker
+        self._pending_lock = Lock()
+        self._connections = set() # sockets held by a worker, closed on shutdown
+        self._parked = {} # idle keep-alive socket: (client address, idle since)
+        self._returned = deque() # sockets handed back by workers to be parked
+        self._selector = None # the serve loop's, watching parked connections
+
+        # Optional Prometheus endpoint; RPC and serial stats are only
+        # recorded when it is enabled
+        self.metrics = None
+        self.metrics_server = None
+        if metrics_port is not None:
+            from agitator_metrics import MetricsRegistry, MetricsServer
+            self.metrics = MetricsRegistry()
+            self.metrics.describe('agitator_rpc_seconds', 'RPC handling time per method')
+            self.metrics.describe('agitator_rpc_errors_total', 'RPC calls that raised a fault')
+            self.metrics.describe('agitator_serial_seconds', 'Serial round trip per Roboclaw command')
+            self.metrics.describe('agitator_serial_retries_total', 'Serial command retries')
+            self.metrics.describe('agitator_serial_failures_total', 'Serial commands that failed after all retries')
+            self.metrics_server = MetricsServer(host, metrics_port,
+                                                self.collect_metrics)
+            self.metrics_server.start()
+
+        # Writing to the wakeup socket breaks serve_forever out of select()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._closed = Event()
+        self._stopping = Event()
         self.kill = False
-        while not self.kill:
-            self.handle_request()
+        self.shutdown_time = None # Seconds from stop() to a fully closed server
+        self._stop_requested = None
+
+        self._bring_up_thread = Thread(target=self._bring_up,
+                                       name='agitator-bring-up', daemon=True)
+        self._bring_up_thread.start()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        """Block until every controller is up; returns False on timeout"""
+        return self._ready.wait(timeout)
+
+    def health(self):
+        """Report whether the server is up, answered without touching the controllers"""
+        if self.kill:
+            state = 'stopping'
+        elif self._ready.is_set():
+            state = 'ready'
+        elif self.startup_error is not None:
+            state = 'error'
+        else:
+            state = 'starting'
+        return {'state': state,
+                'ready': self._ready.is_set(),
+                'error': self.startup_error,
+                'attempts': self.startup_attempts,
+                'startup_time': self.startup_time,
+                'uptime': time.perf_counter() - self._created,
+                'controllers': list(self._controllers),
+                'segments': {port: bus.segment for port, bus in self.buses.items()
+                             if hasattr(bus, 'segment')}}
+
+    def _bring_up(self):
+        """Open every controller, retrying until they respond or the server stops"""
+        while not self._stopping.is_set():
+            self.startup_attempts += 1
+            try:
+                self._open_agitators()
+            except Exception as err:
+                self.startup_error = f'{type(err).__name__}: {err}'
+                self.logger.error(f'Agitator bring-up failed (attempt {self.startup_attempts}): '
+                                  f'{self.startup_error}; retrying in {__BRING_UP_RETRY__}s')
+                self._attempted.set()
+                self._stopping.wait(__BRING_UP_RETRY__)
+                continue
+            self.startup_error = None
+            self.startup_time = time.perf_counter() - self._created
+            self.logger.info(f'Agitator ready {self.startup_time:.3f}s after startup')
+            self._ready.set()
+            self._attempted.set()
+            return
+
+    def _capture_path(self, index, count):
+        if not self._capture or count == 1:
+            return self._capture
+        root, ext = os.path.splitext(self._capture)
+        return f'{root}.{index}{ext}'
+
+    def _open_agitators(self):
+        buses = {}
+        agitators = {}
+        try:
+            ports = list(dict.fromkeys(port for port, _ in self._controllers.values()))
+            for name, (port_name, addr) in self._controllers.items():
+                if self._io_process:
+                    if port_name not in buses:
+                        from agitator_process import AgitatorProcess
+                        buses[port_name] = AgitatorProcess(
+                            port_name,
+                            [(each, controller[1]) for each, controller in
+                             self._controllers.items() if controller[0] == port_name],
+                            self._profile, self._capture_path(
+                                ports.index(port_name), len(ports)), self._baud)
+                    agitators[name] = buses[port_name].agitator(name)
+                    continue
+                if port_name not in buses:
+                    addrs = [each for port, each in self._controllers.values()
+                             if port == port_name]
+                    buses[port_name] = open_bus(port_name, addr, self._capture_path(
+                        ports.index(port_name), len(ports)), self._baud, addrs)
+                agitators[name] = Agitator(addr=addr, bus=buses[port_name],
+                                           profile=self._profile)
 
-    def stop(self):
-        self.agitator.logger.info('Stopping agitator server')
+            agitator = next(iter(agitators.values()))
+            group = AgitatorGroup(agitators)
+            for each in agitators.values():
+                if self.metrics is not None and not self._io_process:
+                    each._rc.stats = self.metrics
+                each.telemetry.start()
+
+            # Optional side port streaming telemetry to subscribers; a port
+            # that cannot be bound fails the bring-up like a missing controller
+            if self._stream_port is not None:
+                from socket_server import AgitatorSocketServer
+                stream_server = AgitatorSocketServer(self._host, self._stream_port,
+                                                     agitator)
+                self._stream_thread = stream_server.start()
+                self.stream_server = stream_server
+        except Exception:
+            self._close_agitators(agitators, buses)
+            raise
+
+        self.buses, self.agitators = buses, agitators
+        self.agitator, self.group = agitator, group
+        self.register_instance(agitator)
+        self.register_function(group.start, 'start_all')
+        self.register_function(group.stop, 'stop_all')
+        self.register_function(group.status, 'status_all')
+        self.register_function(group.exposure_summary, 'exposure_summary_all')
+
+    def process_request(self, request, client_address):
+        """Watch a new connection until its first request arrives"""
+        self._park(request, client_address)
+
+    def _park(self, request, client_address):
+        self._parked[request] = [client_address, time.monotonic(), bytearray()]
+        self._selector.register(request, selectors.EVENT_READ)
+
+    def _unpark(self, request):
+        self._selector.unregister(request)
+        return self._parked.pop(request)
+
+    def _readable(self, request):
+        """
+        Read what has arrived on a parked connection. Once a whole request
+        is in (or __READ_AHEAD__ bytes of it) the connection goes to a
+        worker along with the bytes read; a control call goes to its own
+        workers, ahead of any queued requests and never shed.
+        """
+        parked = self._parked[request]
+        try:
+            chunk = request.recv(__READ_AHEAD__)
+        except OSError:
+            chunk = b''
+        if not chunk: # Closed by the client
+            self._unpark(request)
+            self.shutdown_request(request)
+            return
+        data = parked[2]
+        if not data: # The client has until the idle timeout to finish the request
+            parked[1] = time.monotonic()
+        data += chunk
+        if not request_complete(data) and len(data) < __READ_AHEAD__:
+            return
+        client_address = self._unpark(request)[0]
+        match = _METHOD_NAME.search(data)
+        if match is not None and is_control(match.group(1).decode('ascii')):
+            self._control_pool.submit(self._process_request_worker, request,
+                                      client_address, bytes(data), time.monotonic(), False)
+        else:
+            self._dispatch_connection(request, client_address, bytes(data))
+
+    def _resume(self, request, client_address):
+        """Give a kept-alive connection back to the serve loop; any thread"""
+        self._returned.append((request, client_address))
+        try:
+            self._wakeup_send.send(b'\0')
+        except OSError: # Shutting down; _shutdown closes what is left
+            pass
+
+    def _park_returned(self):
+        try:
+            self._wakeup_recv.recv(4096)
+        except OSError:
+            pass
+        while self._returned:
+            request, client_address = self._returned.popleft()
+            if self.kill:
+                self.shutdown_request(request)
+            else:
+                self._park(request, client_address)
+
+    def _close_idle(self, now):
+        """Close connections idle too long; returns seconds until the next is due"""
+        due = None
+        for request, (_, since, _) in list(self._parked.items()):
+            left = since + __KEEPALIVE_TIMEOUT__ - now
+            if left <= 0:
+                self._unpark(request)
+                self.shutdown_request(request)
+            elif due is None or left < due:
+                due = left
+        return due
+
+    def _dispatch_connection(self, request, client_address, data):
+        """
+        Hand a connection and the request read from it to the worker pool,
+        or turn it away if too many are already waiting
+        """
+        with self._pending_lock:
+            shed = self._pending >= self.max_pending
+            if not shed:
+                self._pending += 1
+        if shed:
+            self.admission.shed_connection(client_address[0])
+            try:
+                request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n'
+                                b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self._pool.submit(self._process_request_worker, request, client_address,
+                          data, time.monotonic())
+
+    def _process_request_worker(self, request, client_address, data=b'',
+                                accepted=None, pending=True):
+        with self._pending_lock:
+            if pending:
+                self._pending -= 1
+            self._connections.add(request)
+        # The request may have waited for a worker
+        self._arrival.accepted = accepted
+        self._arrival.buffered = data
+        keep_alive = False
+        try:
+            if not self.kill:
+                handler = self.finish_request(request, client_address)
+                keep_alive = not handler.close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self._pending_lock:
+                self._connections.discard(request)
+            if keep_alive and not self.kill:
+                self._resume(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        """Answer the requests waiting on a connection; returns the handler"""
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def admit(self, client, data):
+        """
+        Charge a request to the rate limits of its client and methods;
+        raises Overloaded if it is over one. Bodies that do not parse are
+        left for the dispatcher to fault.
+        """
+        try:
+            methods = called_methods(data)
+        except Exception:
+            return
+        self.admission.admit(client, methods)
+
+    def admission_stats(self):
+        """
+        Count requests admitted and shed, by reason and by client, and
+        report the connections and controller calls now waiting
+        """
+        stats = self.admission.stats()
+        stats.update(pending=self._pending, max_pending=self.max_pending)
+        return stats
+
+    def buffered(self):
+        """Called by the request handler for the bytes the serve loop read"""
+        data = getattr(self._arrival, 'buffered', b'')
+        self._arrival.buffered = b''
+        return data
+
+    def received(self):
+        """Called by the request handler as each request arrives"""
+        accepted = getattr(self._arrival, 'accepted', None)
+        self._arrival.accepted = None
+        self._arrival.time = accepted or time.monotonic()
+
+    def _dispatch(self, method, params):
+        params, options = split_options(params)
+        arrival = getattr(self._arrival, 'time', None) or time.monotonic()
+        with tracing.span(method, cat='rpc'):
+            if self.metrics is None:
+                return self._shed(method, params, options, arrival)
+            start = time.perf_counter()
+            try:
+                return self._shed(method, params, options, arrival)
+            except Exception:
+                self.metrics.inc('agitator_rpc_errors_total', method=method)
+                raise
+            finally:
+                self.metrics.observe('agitator_rpc_seconds',
+                                     time.perf_counter() - start, method=method)
+
+    def _shed(self, method, params, options, arrival):
+        """Report calls shed at the controller gate with fault code 503"""
+        try:
+            return self._run(method, params, options, arrival)
+        except Overloaded as err:
+            raise xmlrpc.client.Fault(503, f'{err}; retry after {err.retry_after:.1f}s')
+
+    def _run(self, method, params, options, arrival):
+        """Run a call once per request ID, and coalesce identical reads"""
+        def call():
+            return self._call(method, params, options, arrival)
+        request_id = options.get('_request_id')
+        if request_id is not None:
+            return self.requests.run(str(request_id), method, params, call)
+        if not params and not options and method.rpartition('.')[2] in COALESCED_METHODS:
+            return self.flights.run(method, call)
+        return call()
+
+    def deadline_stats(self):
+        """
+        Count the calls dropped for being late, by where they were caught
+        (on dispatch, while queued for the serial port, or after their
+        exposure ended), and the exposures shortened to fit their window;
+        late_s and shortened_s summarize by how many seconds
+        """
+        with self._late_lock:
+            return dict(self._late, late_s=self._lateness.summary(),
+                        shortened_s=self._shortening.summary())
+
+    def _count_late(self, stage, seconds):
+        with self._late_lock:
+            self._late[stage] += 1
+            (self._shortening if stage == 'shortened' else self._lateness).add(seconds)
+
+    def _expires(self, options, arrival):
+        """The monotonic deadline set by the call options, or None"""
+        limits = []
+        if options.get('_deadline') is not None:
+            limits.append(time.monotonic() + float(options['_deadline']) - time.time())
+        if options.get('_max_age') is not None:
+            limits.append(arrival + float(options['_max_age']))
+        return min(limits) if limits else None
+
+    def _fit_window(self, method, params, options):
+        """
+        Shorten the exp_time and timeout of a start call by the time since
+        the exposure started; a missing timeout becomes the rest of the window
+        """
+        if options.get('_exposure_start') is None or method not in WINDOWED_METHODS:
+            return params
+        if not params:
+            raise ValueError(f'{method} needs exp_time to fit it to the exposure window')
+        elapsed = max(0.0, time.time() - float(options['_exposure_start']))
+        exp_time = params[0] - elapsed
+        # Without a timeout the agitator would run on past the window's end
+        timeout = params[1] - elapsed if len(params) > 1 and params[1] is not None else exp_time
+        remaining = min(exp_time, timeout)
+        if remaining <= 0:
+            self._count_late('window', -remaining)
+            raise DeadlineExceeded(f'{method} arrived {elapsed:.3f}s into a {params[0]}s '
+                                   f'exposure window that has closed')
+        if elapsed:
+            self._count_late('shortened', elapsed)
+            self.logger.info(f'{method} shortened by {elapsed:.3f}s to fit the exposure window')
+        return (exp_time, timeout) + tuple(params[2:])
+
+    def request_stats(self):
+        """
+        Count calls run, replayed or joined by request ID, and reads
+        coalesced onto one already in flight
+        """
+        return {'request_ids': self.requests.stats(),
+                'single_flight': self.flights.stats()}
+
+    def trace_start(self, max_events=None):
+        """Start recording tracing spans, discarding earlier ones"""
+        tracing.enable(max_events or tracing.__DEFAULT_MAX_EVENTS__)
+        return True
+
+    def trace_stop(self):
+        """Stop recording and return the spans as Chrome trace-event JSON"""
+        return tracing.export_chrome(tracer=tracing.disable())
+
+    def _call(self, method, params, options=None, arrival=None):
+        if not self._ready.is_set() and method not in self.funcs:
+            self._attempted.wait(__STARTUP_WAIT__)
+            if not self._ready.is_set():
+                raise Exception('Agitator is not ready: {}'.format(
+                    self.startup_error or 'still starting up'))
+        agitator = self.agitator
+        name, _, rest = method.partition('.')
+        if rest and name in self.agitators:
+            agitator, method = self.agitators[name], rest
+        if not options:
+            return self._call_agitator(agitator, method, params)
+
+        expires = None
+        if not is_stop(method): # A late stop must still stop the motors
+            expires = self._expires(options, arrival or time.monotonic())
+        if expires is not None and time.monotonic() > expires:
+            late = time.monotonic() - expires
+            self._count_late('dispatch', late)
+            raise DeadlineExceeded(f'{method} expired {late:.3f}s before it could run')
+        params = self._fit_window(method, params, options)
+        try:
+            with io_deadline(expires):
+                return self._call_agitator(agitator, method, params)
+        except DeadlineExceeded:
+            if expires is not None:
+                self._count_late('controller', time.monotonic() - expires)
+            raise
+
+    def _call_agitator(self, agitator, method, params):
+        reader = CACHED_METHODS.get(method)
+        if reader is not None and not params:
+            value = reader(agitator.telemetry.snapshot())
+            if value is not None:
+                return value
+        if agitator is self.agitator and method in self.funcs: # Served by the server itself
+            return super()._dispatch(method, params)
+        if method in SERIAL_METHODS or (method == 'status' and not agitator.telemetry.snapshot()):
+            with self.admission.gate(method):
+                return self._call_method(agitator, method, params)
+        return self._call_method(agitator, method, params)
+
+    def _call_method(self, agitator, method, params):
+        if agitator is self.agitator:
+            return super()._dispatch(method, params)
+        if method.startswith('_'):
+            raise Exception(f'method "{method}" is not supported')
+        try:
+            func = resolve_dotted_attribute(agitator, method)
+        except AttributeError:
+            raise Exception(f'method "{method}" is not supported')
+        return func(*params)
+
+    def collect_metrics(self):
+        """
+        Return the exposition lines for one scrape, built only from cached
+        telemetry and in-memory counters. Gauges are labelled with the
+        controller name when more than one agitator is served.
+        """
+        gauges = {}
+        for name, agitator in self.agitators.items():
+            labels = {'controller': name} if len(self.agitators) > 1 else {}
+            snapshot = agitator.telemetry.snapshot()
+            link = agitator.link_stats()
+            for metric, text, value in (
+                    ('agitator_agitating', '1 while an agitation thread is running', agitator.agitating),
+                    ('agitator_frequency_hz', 'Commanded agitation frequency', agitator.freq),
+                    ('agitator_motor1_current_amps', 'Motor 1 current', snapshot.get('current1')),
+                    ('agitator_motor2_current_amps', 'Motor 2 current', snapshot.get('current2')),
+                    ('agitator_battery_volts', 'Main battery voltage', snapshot.get('battery_voltage')),
+                    ('agitator_temperature_celsius', 'Controller temperature', snapshot.get('temperature')),
+                    ('agitator_telemetry_age_seconds', 'Age of the cached telemetry',
+                        time.time() - snapshot['time'] if snapshot else None),
+                    ('agitator_serial_crc_errors_total', 'Replies with a bad CRC', agitator.crc_errors),
+                    ('agitator_telemetry_link_utilization', 'Fraction of the serial link used by telemetry polls',
+                        agitator.telemetry.usage()['link_utilization']),
+                    ('agitator_setpoints_suppressed_total', 'Motor commands skipped as already in effect',
+                        agitator.setpoint_stats()['suppressed']),
+                    ('agitator_serial_link_up', '1 while the serial port is open and working', link['up']),
+                    ('agitator_serial_reconnects_total', 'Times a lost serial port was reopened',
+                        link['reconnects']),
+                    ('agitator_serial_last_recovery_seconds', 'Time from the last port loss to its reopening',
+                        link['last_recovery_s'])):
+                gauges.setdefault(metric, (text, []))[1].append((labels, value))
+        requests, flights = self.requests.stats(), self.flights.stats()
+        for metric, text, value in (
+                ('agitator_rpc_replayed_total', 'Calls answered from the request ID cache',
+                    requests['replayed'] + requests['joined']),
+                ('agitator_rpc_coalesced_total', 'Reads that shared the result of one in flight',
+                    flights['coalesced'])):
+            gauges[metric] = (text, [({}, value)])
+        late = self.deadline_stats()
+        gauges['agitator_rpc_late_total'] = (
+            'Calls dropped (or exposures shortened) for arriving late',
+            [({'stage': stage}, late[stage])
+             for stage in ('dispatch', 'controller', 'window', 'shortened')])
+        admission = self.admission_stats()
+        gauges['agitator_rpc_shed_total'] = (
+            'Requests and connections turned away under load',
+            [({'reason': reason}, admission[reason])
+             for reason in ('client_rate', 'method_rate', 'queue_full',
+                            'queue_timeout', 'connections')])
+        gauges['agitator_rpc_pending_connections'] = (
+            'Connections waiting for a worker', [({}, admission['pending'])])
+        gauges['agitator_rpc_gate_queued'] = (
+            'Controller calls waiting for the serial port gate', [({}, admission['queued'])])
+        from agitator_metrics import render_gauges
+        lines = self.metrics.render()
+        lines.extend(render_gauges(gauges))
+        return lines
+
+    def serve_forever(self):
+        """
+        Wait on the listening socket, the wakeup channel and every idle
+        keep-alive connection together, so that stop() takes effect
+        immediately and a connection only reaches a worker once it has a
+        request to answer, then shut down cleanly
+        """
+        self.logger.info('Starting agitator server')
+        try:
+            with selectors.DefaultSelector() as selector:
+                self._selector = selector
+                selector.register(self, selectors.EVENT_READ)
+                selector.register(self._wakeup_recv, selectors.EVENT_READ)
+                due = None
+                while not self.kill:
+                    for key, _ in selector.select(due):
+                        if self.kill:
+                            break
+                        if key.fileobj is self:
+                            self._handle_request_noblock()
+                        elif key.fileobj is self._wakeup_recv:
+                            self._park_returned()
+                        else:
+                            self._readable(key.fileobj)
+                    due = self._close_idle(time.monotonic())
+        finally:
+            self._shutdown()
+
+    def stop(self, wait=False, timeout=None):
+        """
+        Request shutdown from any thread. If wait is True, block until the
+        motors are stopped, in-flight requests are drained and the serial
+        port is closed; returns False if that did not happen within timeout.
+        """
+        if not self.kill:
+            self.logger.info('Stopping agitator server')
+            self._stop_requested = time.perf_counter()
+            self.kill = True
+            self._stopping.set()
+            try:
+                self._wakeup_send.send(b'\0')
+            except OSError: # Already shut down
+                pass
+        if wait:
+            return self._closed.wait(timeout)
+        return True
+
+    def _shutdown(self):
+        """
+        Stop the motors first, then close the client connections, drain
+        in-flight requests and close the serial ports
+        """
+        if self._closed.is_set():
+            return
+        if self._stop_requested is None:
+            self._stop_requested = time.perf_counter()
         self.kill = True
+        self._stopping.set()
+        try:
+            self.server_close() # No new connections
+            self._bring_up_thread.join()
+            self._stop_motors()
+            self._close_connections()
+            if self.stream_server is not None:
+                self.stream_server.stop()
+                self._stream_thread.join()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+            self._pool.shutdown(wait=True)
+            self._control_pool.shutdown(wait=True)
+            while self._returned: # Handed back after the serve loop stopped
+                self.shutdown_request(self._returned.popleft()[0])
+            self._close_agitators(self.agitators, self.buses)
+        finally:
+            self._wakeup_recv.close()
+            self._wakeup_send.close()
+            self.shutdown_time = time.perf_counter() - self._stop_requested
+            self.logger.info(f'Agitator server stopped {self.shutdown_time:.3f}s after shutdown request')
+            self._closed.set()
+
+    def _stop_motors(self):
+        """End every agitation thread's run and command the motors to stop"""
+        for name, agitator in self.agitators.items():
+            try:
+                agitator.request_stop()
+                agitator.stop_agitation(verbose=False)
+            except Exception as err:
+                self.logger.error(f'Could not stop agitator {name} on shutdown: {err}')
+
+    def _close_connections(self):
+        """
+        Close every idle keep-alive connection, and shut down those a worker
+        holds so handlers still waiting on a client return at once
+        """
+        for request in list(self._parked):
+            del self._parked[request]
+            self.shutdown_request(request)
+        with self._pending_lock:
+            connections = list(self._connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError: # Already closed by the client
+                pass
+
+    @staticmethod
+    def _close_agitators(agitators, buses):
+        """
+        Stop and close every agitator, then the serial ports (or I/O
+        processes) they share
+        """
+        try:
+            for agitator in agitators.values():
+                agitator.close()
+        finally:
+            for bus in buses.values():
+                bus.close()
+
+
+def parse_controller(text):
+    """Parse a NAME=COMPORT[:ADDR] controller option into (name, (comport, addr))"""
+    name, sep, comport = text.partition('=')
+    if not sep or not name or not comport:
+        raise ValueError(f'Controller must be given as NAME=COMPORT[:ADDR], not {text!r}')
+    addr = __DEFAULT_ADDR__
+    head, sep, tail = comport.rpartition(':')
+    if sep:
+        try:
+            addr = int(tail, 0)
+        except ValueError:
+            pass # A colon that is part of the port name itself
+        else:
+            comport = head
+    return name, (comport, addr)
+
+
+def parse_method_limit(text):
+    """Parse a METHOD=RATE[:BURST] option into (method, (rate, burst))"""
+    method, sep, limit = text.partition('=')
+    rate, _, burst = limit.partition(':')
+    try:
+        if not sep or not method:
+            raise ValueError
+        rate, burst = float(rate), float(burst) if burst else None
+    except ValueError:
+        raise ValueError(f'Method limit must be given as METHOD=RATE[:BURST], not {text!r}')
+    if not rate > 0 or (burst is not None and not burst > 0):
+        raise ValueError(f'Method limit rate and burst must be positive, not {text!r}')
+    return method, (rate, burst)
 
 
 if __name__ == '__main__':
     import sys
     from argparse import ArgumentParser
-    import serial
-    import serial.tools.list_ports
 
     parser = ArgumentParser(description='Start a server for the agitator')
     parser.add_argument('--host', default=__DEFAULT_HOST__)
     parser.add_argument('-p', '--port', type=int, default=__DEFAULT_PORT__)
     parser.add_argument('-c', '--comport', default=__DEFAULT_COMPORT__)
+    parser.add_argument('-s', '--stream-port', type=int, default=None,
+                        help='side port for the socket server and telemetry stream')
+    parser.add_argument('-m', '--metrics-port', type=int, default=None,
+                        help='port for the Prometheus metrics endpoint')
+    parser.add_argument('--controller', action='append', default=[],
+                        metavar='NAME=COMPORT[:ADDR]',
+                        help='serve an agitator on this controller; repeat for more. '
+                             'The first one is the default for unprefixed calls')
+    parser.add_argument('--profile', default=None,
+                        help='JSON controller profile to reconcile each controller against')
+    parser.add_argument('--log', default=None,
+                        help='log file (default: $EXPRES_AGITATOR_LOG or agitator.log)')
+    parser.add_argument('--capture', default=None,
+                        help='record all serial traffic to this capture file')
+    parser.add_argument('--baud', type=int, default=None,
+                        help='move the controllers to this packet serial baud rate')
+    parser.add_argument('--io-process', action='store_true',
+                        help='run serial I/O and agitation in a separate process per port')
+    parser.add_argument('--client-rate', type=float, default=None,
+                        help='requests per second allowed from each client address')
+    parser.add_argument('--client-burst', type=float, default=None,
+                        help='requests a client may make at once above its rate')
+    parser.add_argument('--method-limit', action='append', default=[],
+                        metavar='METHOD=RATE[:BURST]',
+                        help='calls per second allowed to a method from all clients; repeat for more')
+    parser.add_argument('--max-pending', type=int, default=__DEFAULT_MAX_PENDING__,
+                        help='connections that may wait for a worker before more are refused')
+    parser.add_argument('--trace', default=None,
+                        help='record tracing spans and write them to this Chrome trace file on exit')
     args = parser.parse_args()
+    setup_logging(args.log)
+    if args.trace:
+        tracing.enable()
+    profile = ControllerProfile.load(args.profile) if args.profile else None
+    try:
+        controllers = dict(parse_controller(text) for text in args.controller)
+        method_limits = dict(parse_method_limit(text) for text in args.method_limit)
+    except ValueError as err:
+        parser.error(str(err))
+    for option, value in (('--client-rate', args.client_rate), ('--client-burst', args.client_burst)):
+        if value is not None and not value > 0:
+            parser.error(f'{option} must be positive, not {value}')
     
-    for _ in range(3):
-        try:
-            server = AgitatorServer(args.host, args.port,
-                                    comport=args.comport,
-                                    allow_none=True,
-                                    logRequests=False)
-            break
-        except Exception as err:
-            print('Error while connecting to agitator: {}'.format(err))
-            args.comport = input('Please enter new COM Port: ')
-    else:
-        print('Maximum three connection tries exceeded. Exiting...')
-        sys.exit(0)
+    server = AgitatorServer(args.host, args.port,
+                            comport=args.comport,
+                            stream_port=args.stream_port,
+                            metrics_port=args.metrics_port,
+                            controllers=controllers,
+                            profile=profile,
+                            capture=args.capture,
+                            baud=args.baud,
+                            io_process=args.io_process,
+                            client_rate=args.client_rate,
+                            client_burst=args.client_burst,
+                            method_limits=method_limits,
+                            max_pending=args.max_pending,
+                            allow_none=True,
+                            logRequests=False)
 
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print('Keyboard Interrupt received. Closing server and exiting...')
         server.stop()
-        sys.exit(0)
\ No newline at end of file
+    print('Server shut down in {:.3f}s'.format(server.shutdown_time))
+    if args.trace:
+        tracing.export_chrome(args.trace)
+    sys.exit(0)
\ No newline at end of file
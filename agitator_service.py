@@ -59,13 +59,13 @@ class PySvc(win32serviceutil.ServiceFramework):
         servicemanager.LogMsg(servicemanager.EVENTLOG_INFORMATION_TYPE,
                               servicemanager.PYS_SERVICE_STOPPING,
                               (self._svc_name_,' Shutting Down EXPRES Agitator'))
-        # Stop the server
-        self.server.stop()
+        # Stop the server and wait for it to stop the motors and close the port
+        self.server.stop(wait=True, timeout=30.0)
         
         self.ReportServiceStatus(win32service.SERVICE_STOPPED) 
         servicemanager.LogMsg(servicemanager.EVENTLOG_INFORMATION_TYPE,
                               servicemanager.PYS_SERVICE_STOPPED,
-                              (self._svc_name_,' EXPRES Agitator Stopped'))
+                              (self._svc_name_,' EXPRES Agitator Stopped in {}s'.format(self.server.shutdown_time)))
                               
         # fire the stop event  
         win32event.SetEvent(self.hWaitStop)
@@ -0,0 +1,243 @@
+"""
+    EXPRES Fiber Agitator Controller Profile module
+
+    Describes the configuration a Roboclaw should hold for the agitator
+    (velocity PIDs, QPPS, acceleration, voltage and current limits, encoder
+    modes and default accelerations) and reconciles a controller against
+    it: the live settings are read in one serial transaction and only the
+    ones that differ are written, optionally followed by a single WriteNVM.
+    Restarting against an already configured controller therefore costs a
+    few reads and no writes, and the flash is only written when something
+    actually changed.
+"""
+import json
+import time
+import logging
+
+
+__DEFAULT_QPPS__ = 9600
+__DEFAULT_ACCEL__ = 1800
+
+# Raw controller units per user unit for each kind of setting
+__PID_SCALE__ = 65536 # 16.16 fixed point gains
+__VOLT_SCALE__ = 10 # tenths of a volt
+__AMP_SCALE__ = 100 # tens of milliamps
+
+
+class ControllerProfile(object):
+    """Desired Roboclaw configuration for one agitator controller
+
+    Inputs
+    ------
+    velocity_pid1, velocity_pid2 : tuple
+        (p, i, d) velocity gains for each motor
+    qpps : int
+        Encoder counts per second at full speed, written with the PIDs
+    accel : int
+        Acceleration used by the agitator's SpeedAccel commands
+    default_accel1, default_accel2 : int
+        Acceleration the controller uses for plain Speed commands
+    min_voltage, max_voltage : float
+        Main battery cutoffs in volts
+    max_current1, max_current2 : float
+        Motor current limits in amps
+    encoder_mode1, encoder_mode2 : int
+        Encoder mode bytes
+    counts_per_rotation1, counts_per_rotation2 : float
+        Encoder counts per agitator rotation, used to count delivered
+        rotations; not a controller setting
+
+    Any setting left as None is not managed and keeps whatever value the
+    controller holds.
+
+    Public Methods
+    --------------
+    desired():
+        Return the managed settings in raw controller units
+    from_dict(values), load(path):
+        Build a profile from a dictionary or a JSON file
+    """
+
+    def __init__(self, velocity_pid1=(1.0, 0.0, 0.0), velocity_pid2=(1.0, 0.0, 0.0),
+                 qpps=__DEFAULT_QPPS__, accel=__DEFAULT_ACCEL__,
+                 default_accel1=None, default_accel2=None,
+                 min_voltage=None, max_voltage=None,
+                 max_current1=None, max_current2=None,
+                 encoder_mode1=None, encoder_mode2=None,
+                 counts_per_rotation1=None, counts_per_rotation2=None):
+        self.velocity_pid1 = velocity_pid1
+        self.velocity_pid2 = velocity_pid2
+        self.qpps = qpps
+        self.accel = accel
+        self.default_accel1 = default_accel1
+        self.default_accel2 = default_accel2
+        self.min_voltage = min_voltage
+        self.max_voltage = max_voltage
+        self.max_current1 = max_current1
+        self.max_current2 = max_current2
+        self.encoder_mode1 = encoder_mode1
+        self.encoder_mode2 = encoder_mode2
+        self.counts_per_rotation1 = counts_per_rotation1
+        self.counts_per_rotation2 = counts_per_rotation2
+
+    @classmethod
+    def from_dict(cls, values):
+        values = dict(values)
+        for key in ('velocity_pid1', 'velocity_pid2'):
+            if values.get(key) is not None:
+                values[key] = tuple(values[key])
+        return cls(**values)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def desired(self):
+        """Return {setting: raw value} for every managed setting"""
+        desired = {}
+        for motor, pid in ((1, self.velocity_pid1), (2, self.velocity_pid2)):
+            if pid is not None:
+                desired[f'velocity_pid{motor}'] = tuple(
+                    round(gain * __PID_SCALE__) for gain in pid) + (int(self.qpps),)
+        if self.min_voltage is not None or self.max_voltage is not None:
+            desired['main_voltages'] = (
+                None if self.min_voltage is None else round(self.min_voltage * __VOLT_SCALE__),
+                None if self.max_voltage is None else round(self.max_voltage * __VOLT_SCALE__))
+        for motor, current in ((1, self.max_current1), (2, self.max_current2)):
+            if current is not None:
+                desired[f'max_current{motor}'] = round(current * __AMP_SCALE__)
+        for motor, mode in ((1, self.encoder_mode1), (2, self.encoder_mode2)):
+            if mode is not None:
+                desired[f'encoder_mode{motor}'] = int(mode)
+        for motor, accel in ((1, self.default_accel1), (2, self.default_accel2)):
+            if accel is not None:
+                desired[f'default_accel{motor}'] = int(accel)
+        return desired
+
+
+def read_config(rc, names=None):
+    """
+    Read the named settings (default: all a profile can manage) in raw
+    units. Runs on the I/O thread; settings whose read failed, and the
+    write-only default accelerations, are left out.
+    """
+    def wanted(*keys):
+        return names is None or any(key in names for key in keys)
+
+    config = {}
+    for motor, read in ((1, rc.ReadM1VelocityPID), (2, rc.ReadM2VelocityPID)):
+        if wanted(f'velocity_pid{motor}'):
+            status = read()
+            if status[0]:
+                config[f'velocity_pid{motor}'] = tuple(
+                    round(gain * __PID_SCALE__) for gain in status[1:4]) + (status[4],)
+
+    if wanted('main_voltages'):
+        status = rc.ReadMinMaxMainVoltages()
+        if status[0]:
+            config['main_voltages'] = (status[1], status[2])
+
+    for motor, read in ((1, rc.ReadM1MaxCurrent), (2, rc.ReadM2MaxCurrent)):
+        if wanted(f'max_current{motor}'):
+            status = read()
+            if status[0]:
+                config[f'max_current{motor}'] = status[1]
+
+    if wanted('encoder_mode1', 'encoder_mode2'):
+        status = rc.ReadEncoderModes()
+        if status[0]:
+            config['encoder_mode1'] = status[1]
+            config['encoder_mode2'] = status[2]
+    return config
+
+
+def _write_pid(set_pid):
+    def write(rc, value):
+        p, i, d, qpps = value
+        return set_pid(rc, p / __PID_SCALE__, i / __PID_SCALE__, d / __PID_SCALE__, qpps)
+    return write
+
+
+# How to write each setting, given the raw value
+WRITERS = {
+    'velocity_pid1': _write_pid(lambda rc, *args: rc.SetM1VelocityPID(*args)),
+    'velocity_pid2': _write_pid(lambda rc, *args: rc.SetM2VelocityPID(*args)),
+    'main_voltages': lambda rc, value: rc.SetMainVoltages(*value),
+    'max_current1': lambda rc, value: rc.SetM1MaxCurrent(value),
+    'max_current2': lambda rc, value: rc.SetM2MaxCurrent(value),
+    'encoder_mode1': lambda rc, value: rc.SetM1EncoderMode(value),
+    'encoder_mode2': lambda rc, value: rc.SetM2EncoderMode(value),
+    'default_accel1': lambda rc, value: rc.SetM1DefaultAccel(value),
+    'default_accel2': lambda rc, value: rc.SetM2DefaultAccel(value),
+}
+
+
+def reconcile(rc, profile, commit=False, unsaved=()):
+    """
+    Bring the controller in line with profile in one transaction on the
+    I/O thread and return a report of what was read and written
+
+    Inputs
+    ------
+    rc : RoboclawWorker
+        Serialized access to the controller
+    profile : ControllerProfile
+        The desired configuration
+    commit : bool
+        Save the settings to NVM with WriteNVM if anything was changed
+    unsaved : iterable
+        Settings changed by an earlier uncommitted reconcile, which also
+        call for a WriteNVM when commit is set
+
+    Settings that cannot be read back (the default accelerations) are
+    written every time, but do not by themselves trigger a WriteNVM.
+    """
+    return rc.run(_reconcile, profile, commit, set(unsaved))
+
+
+def _reconcile(rc, profile, commit, unsaved):
+    logger = logging.getLogger('expres_agitator')
+    start = time.perf_counter()
+    desired = profile.desired()
+    live = read_config(rc, desired)
+    if 'main_voltages' in desired:
+        # Keep the cutoff the profile leaves unmanaged
+        current = live.get('main_voltages', (None, None))
+        wanted = desired['main_voltages']
+        desired['main_voltages'] = tuple(
+            have if want is None else want for want, have in zip(wanted, current))
+        if None in desired['main_voltages']:
+            del desired['main_voltages'] # Unknown other cutoff; don't guess
+
+    changed = []
+    failed = []
+    unverified = []
+    for name, value in desired.items():
+        if name in live and live[name] == value:
+            continue
+        if not WRITERS[name](rc, value):
+            failed.append(name)
+        elif name in live:
+            changed.append(name)
+        else:
+            unverified.append(name)
+    if changed:
+        logger.info(f'Controller settings updated: {", ".join(changed)}')
+    if failed:
+        logger.error(f'Could not write controller settings: {", ".join(failed)}')
+
+    committed = False
+    if commit and (changed or unsaved) and not failed:
+        committed = bool(rc.WriteNVM())
+        if committed:
+            logger.info('Controller settings saved to NVM')
+        else:
+            logger.error('WriteNVM failed; settings will not survive a power cycle')
+
+    return {'changed': changed,
+            'unchanged': sorted(set(desired) - set(changed) - set(failed) - set(unverified)),
+            'unverified': unverified,
+            'failed': failed,
+            'committed': committed,
+            'seconds': time.perf_counter() - start}
@@ -0,0 +1,109 @@
+"""
+    EXPRES Fiber Agitator Exposure Statistics module
+
+    Summarizes the telemetry polled during one agitated exposure (motor
+    currents and speeds, battery voltage and controller temperature) as
+    count, mean, variance, minimum and maximum. Each value is folded into
+    a running accumulator as it is polled, using Welford's update for the
+    mean and variance, so no samples are stored and the summary costs the
+    same for a ten second exposure as for a one hour one.
+"""
+import math
+import time
+from threading import Lock
+
+
+# Telemetry register each summarized value is read with
+SUMMARIZED = {
+    'current1': 'currents',
+    'current2': 'currents',
+    'speed1': 'speed1',
+    'speed2': 'speed2',
+    'battery_voltage': 'battery_voltage',
+    'temperature': 'temperature',
+}
+
+
+class RunningStats(object):
+    """Count, mean, variance, minimum and maximum of a stream of values"""
+    __slots__ = ('count', 'mean', '_m2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0 # Sum of squared differences from the mean
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def variance(self):
+        """Sample variance, or None with fewer than two values"""
+        return self._m2 / (self.count - 1) if self.count > 1 else None
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0, 'mean': None, 'variance': None, 'min': None, 'max': None}
+        return {'count': self.count, 'mean': self.mean, 'variance': self.variance,
+                'min': self.min, 'max': self.max}
+
+
+class ExposureStats(object):
+    """Running telemetry statistics over one exposure
+
+    Public Methods
+    --------------
+    begin():
+        Discard the previous exposure and start accumulating
+    listener(snapshot):
+        TelemetryPoller listener adding the values read by each poll
+    finish():
+        Stop accumulating
+    summary():
+        Return the statistics of the current or last exposure
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = {}
+        self._started = None
+        self._finished = None
+
+    @property
+    def active(self):
+        return self._started is not None and self._finished is None
+
+    def begin(self):
+        with self._lock:
+            self._stats = {name: RunningStats() for name in SUMMARIZED}
+            self._started = time.monotonic()
+            self._finished = None
+
+    def listener(self, snapshot):
+        """Add every summarized value that this poll actually read"""
+        if not self.active:
+            return
+        polled = snapshot.get('polled', ())
+        with self._lock:
+            for name, register in SUMMARIZED.items():
+                if register in polled and snapshot.get(name) is not None:
+                    self._stats[name].add(snapshot[name])
+
+    def finish(self):
+        with self._lock:
+            if self.active:
+                self._finished = time.monotonic()
+
+    def summary(self):
+        """Return {value: {count, mean, variance, min, max}}, or None before the first exposure"""
+        with self._lock:
+            if self._started is None:
+                return None
+            return {name: stats.summary() for name, stats in self._stats.items()}
@@ -6,11 +6,19 @@
     for fiber agitation. Can also be run as a script to simply control the
     fiber agitator from a terminal.
 """
-import numpy as np
+import math
 import time
-from threading import Thread, Event
-import logging, logging.handlers
+from threading import Thread, Event, Lock, RLock
+import logging
 from roboclaw import Roboclaw
+from roboclaw_io import RoboclawBus
+from roboclaw_baud import negotiate
+from telemetry import TelemetryPoller
+from rotation import RotationTracker
+from exposure_stats import ExposureStats
+from controller_profile import ControllerProfile, reconcile
+from agitator_logging import setup_logging
+from tracing import span, traced
 
 
 __DEFAULT_PORT__ = 'COM12'
@@ -21,6 +29,35 @@ __DEFAULT_RETRIES__ = 3
 __DEFAULT_INTER_BYTE_TIMEOUT__ = 1.0
 
 
+def open_bus(comport=__DEFAULT_PORT__, addr=__DEFAULT_ADDR__, capture=None,
+             baud=None, addrs=None):
+    """
+    Open a serial port to the Roboclaw controllers and return the bus that
+    serializes all I/O on it. Controllers multi-dropped on the port share
+    the bus; pass it to each Agitator along with that controller's address.
+    If capture is a path, all traffic on the port is recorded there (see
+    serial_capture).
+
+    The port is opened at the rate the controller at addr answers at,
+    trying __DEFAULT_BAUD_RATE__ first. If baud is given, every controller
+    at addrs (default: addr) is moved to that rate and it is saved to NVM,
+    staying at the detected rate if that fails (see roboclaw_baud).
+    """
+    rc = Roboclaw(comport=comport,
+            rate=__DEFAULT_BAUD_RATE__,
+            addr=addr,
+            timeout=__DEFAULT_TIMEOUT__,
+            retries=__DEFAULT_RETRIES__,
+            inter_byte_timeout=__DEFAULT_INTER_BYTE_TIMEOUT__,
+            capture=capture)
+    try:
+        negotiate(rc, baud, addrs)
+    except Exception:
+        rc.Close()
+        raise
+    return RoboclawBus(rc, name=f'roboclaw-io-{comport}')
+
+
 class Agitator(object):
     """Class for controlling the EXPRES fiber agitator
 
@@ -28,6 +65,19 @@ class Agitator(object):
     ------
     comport : str
         The hardware COM Port for the Roboclaw motor controller
+    addr : int
+        The packet serial address of the Roboclaw on that port
+    bus : RoboclawBus
+        An already open bus to share with other agitators on the same
+        port (see open_bus); comport is ignored when a bus is given
+    profile : ControllerProfile
+        Configuration the controller should hold; only settings that differ
+        from it are written at startup
+    capture : str
+        Record the serial traffic to this file (only when no bus is given)
+    baud : int
+        Move the controller to this baud rate when opening the port (only
+        when no bus is given); see open_bus
 
     Public Methods
     --------------
@@ -36,64 +86,85 @@ class Agitator(object):
     start_agitation(exp_time, rot1, rot2):
         Unthreaded agitation
     stop():
-        Stop either threaded or unthreaded agitation
-    stop_agitation():
+        Stop either threaded or unthreaded agitation and return the
+        exposure summary
+    request_stop():
+        Signal threaded agitation to stop without waiting for it
+    stop_agitation(verbose, force):
         Hard-stop agitation but will not close thread
+    resync():
+        Resend both motor setpoints, whether or not they look current
+    apply_profile(commit):
+        Write any settings that differ from the profile, optionally to NVM
+    status():
+        Return the cached telemetry and agitation state in one dictionary
+    telemetry_usage():
+        Report the serial link time used by telemetry polling
+    setpoint_stats():
+        Count the motor commands sent and suppressed as redundant
+    link_stats():
+        Report serial port losses, reconnects and recovery times
+    rotation_report():
+        Compare the rotations delivered in the last exposure to those requested
+    exposure_summary():
+        Return the rotation report and telemetry statistics of the last exposure
+    close():
+        Stop agitation and telemetry and close the serial port
     """
 
-    def __init__(self, comport=__DEFAULT_PORT__):
-        self._rc = Roboclaw(comport=comport,
-                rate=__DEFAULT_BAUD_RATE__,
-                addr=__DEFAULT_ADDR__,
-                timeout=__DEFAULT_TIMEOUT__,
-                retries=__DEFAULT_RETRIES__,
-                inter_byte_timeout=__DEFAULT_INTER_BYTE_TIMEOUT__)
-
-        self.QPPS = 9600
-        self.ACCEL = 1800
-
-        # Create a logger for the agitator
-        self.logger = logging.getLogger('expres_agitator')
-        self.logger.setLevel(logging.DEBUG)
-
-        # Create file handler to log all messages
-        try:
-            fh = logging.handlers.TimedRotatingFileHandler(
-                'C:/Users/admin/agitator_logs/agitator.log',
-                when='D',
-                interval=1,
-                utc=True,
-                backupCount=10)
-        except FileNotFoundError:
-            fh = logging.handlers.TimedRotatingFileHandler(
-                'agitator.log',
-                when='D',
-                interval=1,
-                utc=True,
-                backupCount=10)
-        fh.setLevel(logging.DEBUG)
-
-        # Create console handler to log info messages
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-
-        # create formatter and add it to the handlers
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        fh.setFormatter(formatter)
-        ch.setFormatter(formatter)
-
-        # add the handlers to the logger
-        self.logger.addHandler(fh)
-        self.logger.addHandler(ch)
+    def __init__(self, comport=__DEFAULT_PORT__, addr=__DEFAULT_ADDR__, bus=None,
+                 profile=None, capture=None, baud=None):
+        # All controller I/O goes through a single thread per serial port so
+        # that RPC handlers, the agitation thread and telemetry never
+        # interleave, even between controllers sharing the port
+        self._owns_bus = bus is None
+        self.bus = open_bus(comport, addr, capture, baud) if bus is None else bus
+        self.addr = addr
+        self._rc = self.bus.worker(addr)
+        self.telemetry = TelemetryPoller(self._rc)
+
+        self.profile = ControllerProfile() if profile is None else profile
+        self.QPPS = self.profile.qpps
+        self.ACCEL = self.profile.accel
+
+        # Counts delivered rotations from the encoder readings telemetry
+        # already polls during agitation
+        self.rotations = RotationTracker(self.QPPS)
+        self.telemetry.add_listener(self.rotations.listener)
+        self.exposure_stats = ExposureStats()
+        self.telemetry.add_listener(self.exposure_stats.listener)
+
+        # Reapply the configuration and setpoints when the bus reopens a
+        # port it lost (e.g. a USB-serial adapter reset)
+        self.bus.add_reconnect_listener(self._on_reconnect)
+
+        # Shared logger; the first Agitator installs the queue-based
+        # pipeline so that logging never blocks the control threads
+        self.logger = setup_logging()
 
         self.thread = None # In case stop() is called before a thread is created
         self.stop_event = Event() # Used for stopping threads
+        self.closed = False
+        self._lock = RLock() # Keeps concurrent start()/stop() calls from racing
+
+        # Write-through cache of the last (accel, speed) each motor
+        # acknowledged; None until known, so the first command is sent
+        self._setpoints = {1: None, 2: None}
+        self._setpoint_lock = Lock()
+        self._setpoint_counts = {'sent': 0, 'suppressed': 0, 'failed': 0}
 
-        # here set any RoboClaw params
-        status = self._rc.SetM1VelocityPID( 1, 0, 0, self.QPPS)
-        status = self._rc.SetM2VelocityPID( 1, 0, 0, self.QPPS)
+        # Only write the RoboClaw params that differ from the profile
+        self._unsaved = set() # Settings changed but not yet saved to NVM
+        self.apply_profile()
 
-        self.stop_agitation() # Just to make sure
+        # Just to make sure, but skip the writes if the motors are at rest
+        self._freq = 0
+        self._voltage1 = self._voltage2 = 0
+        speeds = self._rc.run(lambda rc: (rc.ReadSpeedM1(), rc.ReadSpeedM2()))
+        if any(not status[0] or status[1] for status in speeds):
+            self.stop_agitation(force=True)
+        else:
+            self._setpoints = {1: (self.ACCEL, 0), 2: (self.ACCEL, 0)}
 
     def __del__(self):
         """
@@ -101,9 +172,28 @@ class Agitator(object):
         agitator is stopped. Unfortunately, these actions cannot be logged
         because the logger closes by the time __del__ is called...
         """
+        if self.closed:
+            return
         self.stop(verbose=False)
         self.stop_agitation(verbose=False)
 
+    def close(self):
+        """Stop any agitation and telemetry polling, then close the serial port"""
+        if self.closed:
+            return
+        self.telemetry.stop()
+        self.stop()
+        self.request_stop() # A thread that had not yet set its voltages
+        if self.thread is not None:
+            self.thread.join()
+        self.stop_agitation()
+        self.bus.remove_reconnect_listener(self._on_reconnect)
+        self._rc.close()
+        if self._owns_bus:
+            self.bus.close()
+        self.closed = True
+
+    @traced()
     def threaded_agitation(self, exp_time, timeout, **kwargs):
         """Threadable function allowing stop event"""
         self.logger.info(f'Starting agitator thread for {exp_time}s exposure with {timeout}s timeout')
@@ -112,42 +202,80 @@ class Agitator(object):
         t = 0
         start_time = time.time()
         while not self.stop_event.is_set() and t < timeout:
-            time.sleep(1)
+            self.stop_event.wait(1) # Returns early when stop() is called
             t = time.time() - start_time
             # self.logger.info(f'{round(t, 1)}/{timeout}s for {exp_time}s exposure. I1: {self.current1}, I2: {self.current2}')
             self.logger.info(f'{round(t, 1)}/{timeout}s for {exp_time}s exposure')
 
         self.stop_agitation()
 
+    @traced()
     def start(self, exp_time=60.0, timeout=None, **kwargs):
         """
         Start a thread that starts agitation and stops if a stop event is
         called or if the timeout is reached
         """
-        self.stop() # To close any previously opened threads
+        with self._lock:
+            self.stop() # To close any previously opened threads
 
-        if timeout is None: # Allow for some overlap time
-            timeout = exp_time + 10.0
+            if timeout is None: # Allow for some overlap time
+                timeout = exp_time + 10.0
 
-        self.thread = Thread(target=self.threaded_agitation,
-                             args=(exp_time, timeout),
-                             kwargs=kwargs)
-        self.thread.start()
+            with span('spawn agitation thread'):
+                self.thread = Thread(target=self.threaded_agitation,
+                                     args=(exp_time, timeout),
+                                     kwargs=kwargs)
+                self.thread.start()
 
+    @traced()
     def stop(self, verbose=True):
-        """Stop the agitation thread if it is running"""
-        if self.thread is not None and self.thread.is_alive():
-            while self.voltage1 > 0 or self.voltage2 > 0:
+        """
+        Stop the agitation thread if it is running and return the summary
+        of the last exposure (see exposure_summary)
+        """
+        with self._lock:
+            if self.thread is not None and self.thread.is_alive():
+                while self.voltage1 > 0 or self.voltage2 > 0:
+                    if verbose:
+                        self.logger.info('Attempting to stop threaded agitation')
+                    self.stop_event.set()
+                    self.thread.join(2)
+            if self.voltage1 > 0 or self.voltage2 > 0:
+                # As a backup in case something went wrong
                 if verbose:
-                    self.logger.info('Attempting to stop threaded agitation')
-                self.stop_event.set()
-                self.thread.join(2)
-        if self.voltage1 > 0 or self.voltage2 > 0:
-            # As a backup in case something went wrong
-            if verbose:
-                self.logger.error('Something went wrong when trying to stop threaded agitation. Forcing agitator to stop.')
-            self.stop_agitation()
+                    self.logger.error('Something went wrong when trying to stop threaded agitation. Forcing agitator to stop.')
+                self.stop_agitation()
+        return self.exposure_summary()
+
+    def request_stop(self):
+        """Ask the agitation thread to stop without waiting for it"""
+        if self.thread is not None and self.thread.is_alive():
+            self.stop_event.set()
+
+    def join(self, timeout=None):
+        """Wait for the agitation thread, if any, to finish"""
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    @property
+    def agitating(self):
+        """True while an agitation thread is running"""
+        return self.thread is not None and self.thread.is_alive()
 
+    def apply_profile(self, commit=False):
+        """
+        Read the controller configuration once and write only the settings
+        that differ from self.profile; with commit, save changes to NVM
+        """
+        report = reconcile(self._rc, self.profile, commit, self._unsaved)
+        if report['committed']:
+            self._unsaved.clear()
+        else:
+            self._unsaved.update(report['changed'])
+        self.logger.debug(f'Controller profile applied: {report}')
+        return report
+
+    @traced()
     def start_agitation(self, exp_time=60.0, rot=None):
         """Set the motor voltages for the given number of rotations in exp_time"""
         if exp_time < 0:
@@ -176,21 +304,156 @@ class Agitator(object):
         self._freq = freq1
 
         self.logger.info(f'Starting agitation at approximately {self._freq} Hz')
-        self.set_voltage1(Motor1.calc_voltage(self.battery_voltage, freq1))
-        self.set_voltage2(Motor2.calc_voltage(self.battery_voltage, freq2))
-
-    def stop_agitation(self, verbose=True):
-        """Set both motor voltages to 0"""
+        enc = self._read_encoders() # Rotations are counted from here
+        battery_voltage = self.battery_voltage # One read for both motors
+        self._set_motor(1, Motor1.calc_voltage(battery_voltage, freq1), battery_voltage)
+        self._set_motor(2, Motor2.calc_voltage(battery_voltage, freq2), battery_voltage)
+
+        # Without a configured conversion, assume the commanded speed gives
+        # the requested frequency
+        configured = (self.profile.counts_per_rotation1, self.profile.counts_per_rotation2)
+        commanded = tuple(abs(self._setpoints[motor][1]) / freq
+                          if self._setpoints[motor] else None
+                          for motor, freq in ((1, freq1), (2, freq2)))
+        self.rotations.begin((rot, 0.9*rot), exp_time,
+                             [c or s for c, s in zip(configured, commanded)],
+                             enc, calibrated=all(configured))
+        self.exposure_stats.begin()
+        self.telemetry.set_active(True) # Poll currents and speeds faster
+
+    @traced()
+    def stop_agitation(self, verbose=True, force=False):
+        """
+        Set both motor voltages to 0. Motors already commanded to 0 are
+        not sent the command again unless force is set.
+        """
         if verbose:
             self.logger.info('Stopping agitation')
-        self.set_voltage(0)
+        # Wanted even if the port is lost now; resync sends it once it is back
+        self._voltage1 = self._voltage2 = 0
+        if self.rotations.active:
+            try:
+                enc = self._read_encoders()
+            except OSError as err: # The count up to the last poll still stands
+                self.logger.warning(f'Could not read final encoder counts: {err}')
+                enc = None
+            self.rotations.finish(enc)
+            self.logger.info(f'Rotations: {self.rotations.report()}')
+        if self.exposure_stats.active:
+            self.exposure_stats.finish()
+            self.logger.debug(f'Exposure telemetry: {self.exposure_stats.summary()}')
+        self.set_voltage(0, force)
         self._freq = 0
+        self.telemetry.set_active(False)
         self.stop_event.clear() # Allow for future agitation events
 
-    def set_voltage(self, voltage):
+    def set_voltage(self, voltage, force=False):
         """Set both motor voltages to the given voltage"""
-        self.set_voltage1(voltage)
-        self.set_voltage2(voltage)
+        self.set_voltage1(voltage, force)
+        self.set_voltage2(voltage, force)
+
+    def resync(self):
+        """
+        Resend the current setpoint of both motors, e.g. after the
+        controller was power cycled or commanded by something else
+        """
+        self.logger.info('Resending motor setpoints')
+        with self._setpoint_lock:
+            self._setpoints = {1: None, 2: None}
+        self.set_voltage1(self._voltage1, force=True)
+        self.set_voltage2(self._voltage2, force=True)
+
+    def link_stats(self):
+        """
+        Return the state of the serial link: port losses, reconnects and
+        recovery times (see roboclaw_io.RoboclawBus.link_stats)
+        """
+        return self.bus.link_stats()
+
+    def _on_reconnect(self):
+        """
+        Called by the bus once a lost port is open again. The controller may
+        have been power cycled with the adapter, so the profile is reapplied
+        and the last requested setpoints are resent.
+        """
+        if self.closed:
+            return
+        self.logger.warning(f'Serial link to Roboclaw {hex(self.addr)} restored; '
+                            f'reapplying profile and setpoints')
+        self.apply_profile()
+        self.resync()
+
+    def rotation_report(self):
+        """
+        Return the rotations each motor delivered in the current or last
+        exposure against those requested (see rotation.RotationTracker),
+        or None before the first exposure
+        """
+        return self.rotations.report()
+
+    def exposure_summary(self):
+        """
+        Return the rotation report and the running statistics of the
+        currents, speeds, battery voltage and temperature polled during the
+        current or last exposure (see exposure_stats), or None before the
+        first exposure
+        """
+        rotations = self.rotations.report()
+        if rotations is None:
+            return None
+        return {'rotations': rotations, 'telemetry': self.exposure_stats.summary()}
+
+    def _read_encoders(self):
+        """Read both encoders in one transaction; None if either read fails"""
+        status1, status2 = self._rc.run(lambda rc: (rc.ReadEncM1(), rc.ReadEncM2()))
+        if status1[0] and status2[0]:
+            return status1[1], status2[1]
+        return None
+
+    def setpoint_stats(self):
+        """
+        Return how many motor speed commands were sent, suppressed because
+        the controller already held that setpoint, and not acknowledged
+        """
+        with self._setpoint_lock:
+            return dict(self._setpoint_counts)
+
+    def _set_motor(self, motor, voltage, battery_voltage=None, force=False):
+        """
+        Command a motor to voltage, skipping the SpeedAccel when the last
+        acknowledged setpoint is the same. Returns the voltage after
+        clamping to the battery voltage.
+        """
+        if voltage == 0:
+            speed = 0 # No battery read needed to stop
+        else:
+            if battery_voltage is None:
+                battery_voltage = self.battery_voltage
+            if abs(voltage) > battery_voltage:
+                voltage = math.copysign(battery_voltage, voltage)
+            speed = int(0.5 * self.QPPS * voltage / battery_voltage)
+        setpoint = (self.ACCEL, speed)
+
+        with self._setpoint_lock:
+            if not force and self._setpoints[motor] == setpoint:
+                self._setpoint_counts['suppressed'] += 1
+            else:
+                # Recorded first, so that resync after a lost port resends
+                # what was asked for even if this command never arrived
+                setattr(self, f'_voltage{motor}', voltage)
+                self._setpoint_counts['sent'] += 1
+                self._setpoints[motor] = None
+                try:
+                    acked = getattr(self._rc, f'SpeedAccelM{motor}')(self.ACCEL, speed)
+                except Exception:
+                    self._setpoint_counts['failed'] += 1
+                    raise
+                if not acked:
+                    self._setpoint_counts['failed'] += 1
+                # Unacknowledged commands leave the controller state unknown
+                self._setpoints[motor] = setpoint if acked else None
+            setattr(self, f'_voltage{motor}', voltage)
+        return voltage
 
     # Getter for the frequency
 
@@ -198,6 +461,37 @@ class Agitator(object):
         self.logger.info('Requesting frequency')
         return self._freq
 
+    @property
+    def freq(self):
+        """The commanded frequency, read without logging"""
+        return self._freq
+
+    @property
+    def crc_errors(self):
+        """Replies from the controller that failed their CRC check"""
+        return self._rc.crc_errors
+
+    @traced()
+    def status(self):
+        """
+        Return every commonly polled value in one dictionary, taken from a
+        single telemetry snapshot
+        """
+        snapshot = self.telemetry.snapshot()
+        if not snapshot:
+            self.telemetry.poll()
+            snapshot = self.telemetry.snapshot()
+        snapshot['age'] = time.time() - snapshot['time']
+        snapshot['freq'] = self._freq
+        snapshot['voltage1'] = self._voltage1
+        snapshot['voltage2'] = self._voltage2
+        snapshot['agitating'] = self.agitating
+        return snapshot
+
+    def telemetry_usage(self):
+        """Return how much of the serial link telemetry polling uses"""
+        return self.telemetry.usage()
+
     def read_enc( self):
         self.logger.info( 'Reading encoders')
         status1 = self._rc.ReadEncM1()
@@ -207,8 +501,13 @@ class Agitator(object):
 
     def zero_enc( self):
         self.logger.info( 'Setting encoder counts to zero')
+        if self.rotations.active: # Count up to the reset before losing the counts
+            enc = self._read_encoders()
+            if enc is not None:
+                self.rotations.update(*enc)
         status1 = self._rc.SetEncM1( 0)
         status2 = self._rc.SetEncM2( 0)
+        self.rotations.rebase((0 if status1 else None, 0 if status2 else None))
         self.logger.info( f'Zero: {status1} {status2}')
 
     # Getters and setters for the motor voltages
@@ -216,39 +515,26 @@ class Agitator(object):
     def get_voltage1(self):
         return self._voltage1
 
-    def set_voltage1(self, voltage):
-        battery_voltage = self.battery_voltage
-        if abs(voltage) > battery_voltage:
-            voltage = np.sign(voltage) * battery_voltage
-        #
+    @traced()
+    def set_voltage1(self, voltage, force=False):
         #if voltage >= 0:
         #    self._rc.ForwardM1(int(voltage/battery_voltage*127))
         #else:
         #    self._rc.BackwardM1(int(-voltage/battery_voltage*127))
-
-        self._rc.SpeedAccelM1( self.ACCEL,
-                               int( 0.5 * self.QPPS * voltage / battery_voltage))
-
-        self._voltage1 = voltage
+        self._set_motor(1, voltage, force=force)
 
     voltage1 = property(get_voltage1, set_voltage1)
 
     def get_voltage2(self):
         return self._voltage2
 
-    def set_voltage2(self, voltage):
-        battery_voltage = self.battery_voltage
-        if abs(voltage) > battery_voltage:
-            voltage = np.sign(voltage) * battery_voltage
+    @traced()
+    def set_voltage2(self, voltage, force=False):
         #if voltage >= 0:
         #    self._rc.ForwardM2(int(voltage/battery_voltage*127))
         #else:
         #    self._rc.BackwardM2(int(-voltage/battery_voltage*127))
-
-        self._rc.SpeedAccelM2( self.ACCEL,
-                               int( 0.5 * self.QPPS * voltage / battery_voltage))
-
-        self._voltage2 = voltage
+        self._set_motor(2, voltage, force=force)
 
     voltage2 = property(get_voltage2, set_voltage2)
 
@@ -270,6 +556,7 @@ class Agitator(object):
 
     # Getter for the motor controller power source voltage
 
+    @traced()
     def get_battery_voltage(self):
         voltage = self._rc.ReadMainBatteryVoltage()[1] / 10
         # Check to make sure the voltage is correct
@@ -295,7 +582,7 @@ class Agitator(object):
         return self._rc.ReadM1MaxCurrent()[1]/100
 
     def set_max_current1(self, current):
-        self._rc.SetM1MaxCurrent(current)
+        self._rc.SetM1MaxCurrent(int(current*100))
 
     max_current1 = property(get_max_current1, set_max_current1)
 
@@ -303,10 +590,66 @@ class Agitator(object):
         return self._rc.ReadM2MaxCurrent()[1]/100
 
     def set_max_current2(self, current):
-        self._rc.SetM2MaxCurrent(current)
+        self._rc.SetM2MaxCurrent(int(current*100))
 
     max_current2 = property(get_max_current2, set_max_current2)
 
+class AgitatorGroup(object):
+    """Start and stop several agitators together
+
+    Each agitator keeps its own thread and controller, so agitators on
+    different serial ports run their commands in parallel; agitators that
+    share a port have their commands interleaved fairly by its bus.
+
+    Inputs
+    ------
+    agitators : dict
+        Agitator objects keyed by name
+
+    Public Methods
+    --------------
+    start(exp_time, timeout, **kwargs):
+        Start threaded agitation on every agitator
+    stop():
+        Stop every agitator, waiting for all of them at once, and return
+        their exposure summaries keyed by name
+    exposure_summary():
+        Return each agitator's last exposure summary keyed by name
+    status():
+        Return each agitator's status keyed by name
+    """
+
+    def __init__(self, agitators):
+        self.agitators = dict(agitators)
+        self.logger = logging.getLogger('expres_agitator')
+
+    @traced()
+    def start(self, exp_time=60.0, timeout=None, **kwargs):
+        """Start every agitator, launching the threads back to back"""
+        self.stop() # Clear out earlier exposures first so the starts line up
+        for agitator in self.agitators.values():
+            agitator.start(exp_time, timeout, **kwargs)
+
+    @traced()
+    def stop(self):
+        """
+        Signal every agitation thread first and then wait for them, so the
+        total time is that of the slowest agitator rather than the sum
+        """
+        for agitator in self.agitators.values():
+            agitator.request_stop()
+        for agitator in self.agitators.values():
+            agitator.join()
+        return {name: agitator.stop() # Backup stop in case a thread left a motor running
+                for name, agitator in self.agitators.items()}
+
+    def status(self):
+        return {name: agitator.status() for name, agitator in self.agitators.items()}
+
+    def exposure_summary(self):
+        return {name: agitator.exposure_summary() for name, agitator in self.agitators.items()}
+
+
 class Motor:
     """
     Class that determines a voltage for a motor given the slope and intercept
@@ -319,6 +662,7 @@ class Motor:
     min_voltage = 5.0
 
     @classmethod
+    @traced()
     def calc_voltage(cls, battery_voltage, freq=0.5):
         """Calculate the voltage for the motor given a number of rotations per second"""
         if freq > cls.max_freq:
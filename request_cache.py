@@ -0,0 +1,155 @@
+"""
+    EXPRES Fiber Agitator Request Deduplication module
+
+    Two ways of not doing the same work twice in the RPC layer.
+
+    RequestCache remembers the outcome of calls that carry a client-supplied
+    request ID, so a client that timed out and retries a mutating call such
+    as start() gets the original result back instead of restarting the
+    agitation. A retry that arrives while the original is still running
+    waits for it. Only successful outcomes are kept once a call finishes,
+    so a call that failed can be retried for real. The cache holds a bounded
+    number of IDs for a bounded time.
+
+    SingleFlight coalesces identical reads that are in flight at the same
+    time: the first caller does the work and every caller that arrives
+    before it finishes shares its result, so a burst of read_enc calls
+    costs one trip to the controller.
+"""
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+
+__DEFAULT_MAX_IDS__ = 1024 # request IDs remembered
+__DEFAULT_TTL__ = 600.0 # seconds a finished request ID is remembered
+
+
+class RequestCache(object):
+    """Bounded cache of call outcomes keyed by client request ID
+
+    Inputs
+    ------
+    max_ids : int
+        Most request IDs remembered; the oldest are forgotten first
+    ttl : float
+        Seconds a finished call is remembered
+
+    Public Methods
+    --------------
+    run(request_id, method, params, func):
+        Return func(), or the outcome of the earlier call with this ID
+    stats():
+        Count calls executed, replayed from the cache and joined in flight
+    """
+
+    def __init__(self, max_ids=__DEFAULT_MAX_IDS__, ttl=__DEFAULT_TTL__):
+        self.max_ids = max_ids
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries = OrderedDict() # request ID: (method, params, future, finished)
+        self._counts = {'executed': 0, 'replayed': 0, 'joined': 0, 'mismatched': 0}
+
+    def run(self, request_id, method, params, func):
+        """
+        Run func() once per request_id. A repeat of a finished call returns
+        its result without running anything; a repeat of a running call
+        waits for it.
+
+        Raises
+        ------
+        ValueError
+            If request_id was already used for a different method or params
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._entries.get(request_id)
+            if entry is not None:
+                if (entry[0], entry[1]) != (method, params):
+                    self._counts['mismatched'] += 1
+                    raise ValueError(f'Request ID {request_id!r} was already used '
+                                     f'for {entry[0]}{tuple(entry[1])!r}')
+                self._counts['replayed' if entry[3] else 'joined'] += 1
+                future = entry[2]
+                owner = False
+            else:
+                future = Future()
+                self._entries[request_id] = (method, params, future, None)
+                while len(self._entries) > self.max_ids:
+                    self._entries.popitem(last=False)
+                self._counts['executed'] += 1
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as err:
+            with self._lock:
+                # Forget failures, so the client's retry runs the call again
+                if self._entries.get(request_id, (None,) * 3)[2] is future:
+                    del self._entries[request_id]
+            future.set_exception(err)
+            raise
+        with self._lock:
+            if self._entries.get(request_id, (None,) * 3)[2] is future:
+                self._entries[request_id] = (method, params, future, time.monotonic())
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, cached=len(self._entries))
+
+    def _expire(self, now):
+        stale = [key for key, entry in self._entries.items()
+                 if entry[3] is not None and now - entry[3] > self.ttl]
+        for key in stale:
+            del self._entries[key]
+
+
+class SingleFlight(object):
+    """Share the result of a call among identical calls made while it runs
+
+    Public Methods
+    --------------
+    run(key, func):
+        Return func(), or the result of the identical call already running
+    stats():
+        Count calls executed and coalesced onto one already running
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flights = {}
+        self._counts = {'executed': 0, 'coalesced': 0}
+
+    def run(self, key, func):
+        with self._lock:
+            future = self._flights.get(key)
+            owner = future is None
+            if owner:
+                future = self._flights[key] = Future()
+                self._counts['executed'] += 1
+            else:
+                self._counts['coalesced'] += 1
+        if not owner:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as err:
+            with self._lock:
+                del self._flights[key]
+            future.set_exception(err)
+            raise
+        # Callers arriving from now on start a fresh read
+        with self._lock:
+            del self._flights[key]
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
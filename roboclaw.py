@@ -1,7 +1,8 @@
+import copy
 import random
-import serial
 import time
 import sys
+import tracing
 PY_VERSION = sys.version_info.major
 
 class Roboclaw:
@@ -12,7 +13,7 @@ class Roboclaw:
     """
 
     def __init__(self, comport, rate=38400, addr=0x80, timeout=3,
-            inter_byte_timeout=0.1, retries=3):
+            inter_byte_timeout=0.1, retries=3, capture=None):
         self.comport = comport
         self.rate = rate
         self._addr = addr
@@ -21,6 +22,11 @@ class Roboclaw:
         self._retries = int(retries)
         self._crc = 0
         self._open = False
+        self.capture = capture # Path to record serial traffic to, if any
+        # Running counters for monitoring; see roboclaw_io.RoboclawWorker
+        self.last_cmd = None
+        self.commands_sent = 0
+        self.crc_errors = 0
         self.Open()
 
     def __del__(self):
@@ -133,6 +139,9 @@ class Roboclaw:
                 self._crc = self._crc << 1
 
     def _sendcommand(self,command):
+        tracing.instant('send', cat='serial', cmd=command) # One per attempt
+        self.last_cmd = command
+        self.commands_sent += 1
         self._crc_clear()
         self._writebyte(self._addr)
         self._writebyte(command)
@@ -141,6 +150,8 @@ class Roboclaw:
         data = self._comport.read(2)
         if len(data) == 2:
             crc = (data[0]<<8 | data[1])
+            if crc != self._crc&0xFFFF:
+                self.crc_errors += 1
             return (1,crc)
         return (0,0)
 
@@ -1003,10 +1014,10 @@ class Roboclaw:
         return self._read2(self.Cmd.GETCONFIG)
 
     def SetM1MaxCurrent(self,maxim):
-        return self._write44(self.Cmd.SETM1MAXCURRENT,max,0)
+        return self._write44(self.Cmd.SETM1MAXCURRENT,maxim,0)
 
     def SetM2MaxCurrent(self,maxim):
-        return self._write44(self.Cmd.SETM2MAXCURRENT,max,0)
+        return self._write44(self.Cmd.SETM2MAXCURRENT,maxim,0)
 
     def ReadM1MaxCurrent(self):
         data = self._read_n(self.Cmd.GETM1MAXCURRENT,2)
@@ -1027,10 +1038,68 @@ class Roboclaw:
         return self._read1(self.Cmd.GETPWMMODE)
 
     def Open(self):
-        self._comport = serial.Serial(port=self.comport,
-                baudrate=self.rate, timeout=self.timeout,
-                inter_byte_timeout=self.inter_byte_timeout)
+        if str(self.comport).startswith('sim://'):
+            from roboclaw_sim import SimulatedSerial
+            self._comport = SimulatedSerial(self.comport,
+                    baudrate=self.rate, timeout=self.timeout)
+        elif str(self.comport).startswith('replay://'):
+            from serial_capture import ReplaySerial
+            self._comport = ReplaySerial(self.comport,
+                    baudrate=self.rate, timeout=self.timeout)
+        else:
+            import serial # Deferred so that importing this module stays cheap
+            self._comport = serial.Serial(port=self.comport,
+                    baudrate=self.rate, timeout=self.timeout,
+                    inter_byte_timeout=self.inter_byte_timeout)
+        if self.capture:
+            from serial_capture import CaptureTap
+            self._comport = CaptureTap(self._comport, self.capture,
+                    {'addr': self._addr, 'retries': self._retries})
         self._open = True
 
     def Close(self):
         self._comport.close()
+        self._open = False
+
+    def reopen(self):
+        """
+        Replace a lost port handle with a freshly opened one, e.g. after a
+        USB-serial adapter reset. A capture in progress carries on in the
+        same file.
+        """
+        tap = self._comport if self.capture else None
+        try:
+            (tap._port if tap is not None else self._comport).close()
+        except Exception:
+            pass # The old handle is already dead
+        capture, self.capture = self.capture, None
+        try:
+            self.Open()
+        finally:
+            self.capture = capture
+        if tap is not None:
+            tap._port = self._comport
+            self._comport = tap
+
+    def set_rate(self, rate):
+        """
+        Change the baud rate of the open port; the controller's own rate is
+        changed with SetConfig (see roboclaw_baud)
+        """
+        self.rate = rate
+        self._comport.baudrate = rate
+
+    def at_address(self, addr):
+        """
+        Return a Roboclaw for another controller multi-dropped on this
+        port. It shares the open port, which stays owned (and closed) by
+        this object, and keeps its own packet CRC and counters.
+        """
+        other = copy.copy(self)
+        other._addr = addr
+        other._crc = 0
+        other._open = False
+        other.last_cmd = None
+        other.commands_sent = 0
+        other.crc_errors = 0
+        return other
@@ -0,0 +1,186 @@
+"""
+    Roboclaw Baud Rate Negotiation
+
+    Finds the packet serial baud rate a Roboclaw is listening at and can
+    move it to a faster one. At 38400 baud every byte on the wire costs
+    about 260 us, so a status read of a few registers spends most of its
+    time in transit; at 115200 and above the same read takes a third of
+    that or less.
+
+    The rate is held in bits 5-7 of the controller config (GetConfig and
+    SetConfig). An upgrade writes the new rate with SetConfig, switches the
+    port and checks that every controller answers there, and only then
+    saves it with WriteNVM. If any controller does not answer, the old
+    config is written back and the port returns to the old rate; since
+    nothing was saved, a power cycle also restores the old rate.
+
+    Over USB the port rate does not limit the link, so negotiation is only
+    worthwhile for controllers on a TTL serial port; it is harmless either
+    way.
+"""
+import logging
+
+
+__PROBE_TIMEOUT__ = 0.1 # seconds; a GetConfig reply takes 17 ms even at 2400 baud
+__PROBE_RETRIES__ = 1
+
+# Packet serial baud rate and its value in the config register
+BAUD_RATES = {
+    2400: 0x0000,
+    9600: 0x0020,
+    19200: 0x0040,
+    38400: 0x0060,
+    57600: 0x0080,
+    115200: 0x00A0,
+    230400: 0x00C0,
+    460800: 0x00E0,
+}
+BAUD_MASK = 0x00E0
+
+
+def config_rate(config):
+    """The baud rate selected by a config register value"""
+    bits = config & BAUD_MASK
+    return next(rate for rate, value in BAUD_RATES.items() if value == bits)
+
+
+def with_rate(config, rate):
+    """Return config with its baud rate bits set to rate"""
+    if rate not in BAUD_RATES:
+        raise ValueError(f'{rate} is not a Roboclaw packet serial baud rate; '
+                         f'choose one of {sorted(BAUD_RATES)}')
+    return (config & ~BAUD_MASK) | BAUD_RATES[rate]
+
+
+class _Probing(object):
+    """Shorten the port timeout and retries of rc while probing"""
+
+    def __init__(self, rc):
+        self.rc = rc
+
+    def __enter__(self):
+        self._saved = (self.rc._comport.timeout, self.rc._retries)
+        self.rc._comport.timeout = __PROBE_TIMEOUT__
+        self.rc._retries = __PROBE_RETRIES__
+        return self.rc
+
+    def __exit__(self, exc_type, exc, tb):
+        self.rc._comport.timeout, self.rc._retries = self._saved
+        return False
+
+
+def _controllers(rc, addrs):
+    return [rc if addr == rc._addr else rc.at_address(addr)
+            for addr in (addrs or (rc._addr,))]
+
+
+def probe(rc, rate=None):
+    """
+    Switch the port to rate (default: its current rate) and return the
+    controller's config if it answers there, else None
+    """
+    if rate is not None:
+        rc.set_rate(rate)
+    with _Probing(rc):
+        rc._comport.flushInput()
+        status = rc.GetConfig()
+    return status[1] if status[0] else None
+
+
+def detect(rc, rates=None):
+    """
+    Find the rate the controller answers at, trying the port's current rate
+    first and then the others from the fastest down. The port is left at
+    the rate found. Returns (rate, config).
+
+    Raises
+    ------
+    RuntimeError
+        If the controller does not answer at any rate
+    """
+    start = rc.rate
+    rates = sorted(BAUD_RATES if rates is None else rates, reverse=True)
+    for rate in [start] + [rate for rate in rates if rate != start]:
+        config = probe(rc, rate)
+        if config is not None:
+            return rate, config
+    rc.set_rate(start)
+    raise RuntimeError(f'Roboclaw {hex(rc._addr)} on {rc.comport} did not answer '
+                       f'at any of {sorted(set(rates) | {start})} baud')
+
+
+def negotiate(rc, target=None, addrs=None, persist=True):
+    """
+    Detect the controllers' rate and, if target is given and differs,
+    move every controller at addrs on the port to target. Returns the
+    rate the port is left at, which is the old rate if the upgrade failed.
+
+    Inputs
+    ------
+    rc : Roboclaw
+        Open connection to the port; its address is the one detected
+    target : int
+        Baud rate to move to, or None to only detect
+    addrs : list
+        Addresses of every controller multi-dropped on the port (they
+        must all share one rate); defaults to rc's address
+    persist : bool
+        Save the new rate with WriteNVM once every controller answers at
+        it. WriteNVM saves all of a controller's current settings, not
+        only the rate.
+    """
+    logger = logging.getLogger('expres_agitator')
+    rate, config = detect(rc)
+    if target is None or target == rate:
+        return rate
+    with_rate(config, target) # Validates target before anything is written
+
+    controllers = _controllers(rc, addrs)
+    configs = {}
+    for each in controllers:
+        status = each.GetConfig()
+        if not status[0]:
+            logger.warning(f'Could not read the config of Roboclaw {hex(each._addr)}; '
+                           f'staying at {rate} baud')
+            return rate
+        configs[each._addr] = status[1]
+
+    # The reply to SetConfig still comes at the old rate
+    switched = [each for each in controllers
+                if each.SetConfig(with_rate(configs[each._addr], target))]
+    missing = [each for each in controllers if probe(each, target) is None]
+    failed = [hex(each._addr) for each in controllers
+              if each not in switched or each in missing]
+    if not failed:
+        if persist:
+            for each in controllers:
+                if not each.WriteNVM():
+                    logger.warning(f'Roboclaw {hex(each._addr)} did not confirm WriteNVM; '
+                                   f'it will return to {rate} baud when power cycled')
+        _sync_rate(rc, controllers, target)
+        logger.info(f'Moved {rc.comport} from {rate} to {target} baud')
+        return target
+
+    # Fall back: restore every controller that did switch, then the port
+    for each in controllers:
+        if each not in missing:
+            with _Probing(each):
+                each.SetConfig(configs[each._addr])
+    rc.set_rate(rate)
+    _sync_rate(rc, controllers, rate)
+    lost = [hex(each._addr) for each in controllers if probe(each) is None]
+    if lost:
+        logger.error(f'Roboclaw {", ".join(lost)} on {rc.comport} stopped answering '
+                     f'after a failed move to {target} baud; power cycle to restore '
+                     f'{rate} baud')
+    else:
+        logger.warning(f'Could not move {rc.comport} to {target} baud '
+                       f'({", ".join(failed)} did not switch); '
+                       f'staying at {rate} baud')
+    return rate
+
+
+def _sync_rate(rc, controllers, rate):
+    """Controllers from at_address share the port but keep their own rate attribute"""
+    for each in [rc] + controllers:
+        each.rate = rate
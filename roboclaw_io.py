@@ -0,0 +1,424 @@
+"""
+    Serialized Roboclaw I/O
+
+    Provides a bus that owns one serial port and runs every command for it
+    on a single I/O thread, so concurrent callers (RPC handlers, the
+    agitation thread and the telemetry poller) can never interleave packets
+    on the serial line. Each controller on a port is driven through its own
+    RoboclawWorker; when several controllers are multi-dropped on one port
+    the bus serves their queues round-robin, so a busy controller cannot
+    starve the others. Controllers on separate ports get separate buses
+    whose I/O threads run in parallel.
+
+    A worker can also time every command it runs and record round trips,
+    retries and failures per Roboclaw.Cmd into a metrics registry, and
+    records a tracing span per command while tracing is enabled.
+
+    If the port itself fails (a USB-serial adapter reset makes pyserial
+    raise SerialException), the bus marks the link down and reopens the
+    port from its I/O thread with bounded exponential backoff. While the
+    link is down, commands fail at once with ConnectionError instead of
+    each waiting out its timeouts and retries. Once the port is back,
+    reconnect listeners (each Agitator registers one) are called on their
+    own thread to reapply configuration and setpoints.
+
+    Commands queued inside a deadline() block carry its deadline; any still
+    waiting for the I/O thread when it passes is failed with
+    DeadlineExceeded instead of being sent, so stale work never reaches the
+    controller after a stall.
+"""
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock, Thread, Condition, current_thread
+from concurrent.futures import Future
+
+import tracing
+from roboclaw import Roboclaw
+
+
+__RECONNECT_MIN__ = 0.05 # seconds before the first attempt to reopen a lost port
+__RECONNECT_MAX__ = 2.0 # longest wait between attempts
+
+# Monotonic time after which commands queued by this context are dropped
+_deadline = ContextVar('roboclaw_deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """A command was dropped because its deadline passed before it could run"""
+
+
+@contextmanager
+def deadline(when):
+    """
+    Drop commands queued inside this block (from this thread or task) that
+    are still waiting at monotonic time when; None means no deadline
+    """
+    token = _deadline.set(when)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+CMD_NAMES = {value: name for name, value in vars(Roboclaw.Cmd).items()
+             if not name.startswith('_')}
+
+
+def _succeeded(result):
+    """Roboclaw reads return (status, ...) tuples and writes return bools"""
+    if isinstance(result, (tuple, list)):
+        return bool(result[0])
+    return bool(result)
+
+
+class RoboclawBus(object):
+    """One I/O thread for one serial port, shared fairly by its controllers
+
+    Inputs
+    ------
+    rc : Roboclaw
+        The open connection that owns the serial port
+    name : str
+        Name of the I/O thread
+
+    Public Methods
+    --------------
+    worker(addr, stats):
+        Return a RoboclawWorker for the controller at addr on this port
+    add_reconnect_listener(callback), remove_reconnect_listener(callback):
+        Call callback() after the port was lost and reopened
+    link_stats():
+        Count port losses and reconnects and report recovery times
+    close():
+        Finish queued commands, stop the I/O thread and close the port
+    """
+
+    def __init__(self, rc, name='roboclaw-io'):
+        self.rc = rc
+        self.logger = logging.getLogger('expres_agitator')
+        self._cond = Condition()
+        self._queues = [] # One deque per worker, served round-robin
+        self._next = 0
+        self._closing = False
+        self._controllers = [rc] # Share the port handle, so all move to a reopened one
+        self._listeners = []
+
+        # Link state, only changed on the I/O thread
+        self._lost = None # monotonic time the port was lost, while it is down
+        self._next_attempt = 0.0
+        self._backoff = __RECONNECT_MIN__
+        self._stats_lock = Lock()
+        self._link = {'up': True, 'losses': 0, 'reconnects': 0, 'attempts': 0,
+                      'failed_fast': 0, 'last_error': None,
+                      'last_recovery_s': None, 'max_recovery_s': None,
+                      'downtime_s': 0.0}
+
+        self._thread = Thread(target=self._serve, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def on_io_thread(self):
+        return current_thread() is self._thread
+
+    @property
+    def running(self):
+        return self._thread.is_alive() and not self._closing
+
+    def worker(self, addr=None, stats=None):
+        """Return a worker for the controller at addr (default: rc's address)"""
+        rc = self.rc if addr in (None, self.rc._addr) else self.rc.at_address(addr)
+        if rc is not self.rc:
+            self._controllers.append(rc)
+        return RoboclawWorker(rc, stats=stats, bus=self)
+
+    def add_reconnect_listener(self, callback):
+        """
+        Call callback() on a separate thread each time the port comes back
+        after being lost; it can use the workers like any other caller
+        """
+        self._listeners = self._listeners + [callback]
+
+    def remove_reconnect_listener(self, callback):
+        self._listeners = [cb for cb in self._listeners if cb != callback]
+
+    def link_stats(self):
+        """
+        Return whether the link is up, how often it was lost and
+        reconnected, how many commands failed fast while it was down, and
+        the recovery times (from the loss to the reopened port)
+        """
+        with self._stats_lock:
+            stats = dict(self._link)
+        if self._lost is not None:
+            stats['down_for_s'] = time.monotonic() - self._lost
+        return stats
+
+    def close(self):
+        """Finish any queued commands, stop the I/O thread and close the port"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if not self.on_io_thread:
+            self._thread.join()
+        if self.rc._open:
+            self.rc.Close()
+
+    def _attach(self):
+        commands = deque()
+        with self._cond:
+            self._queues.append(commands)
+        return commands
+
+    def _detach(self, commands):
+        with self._cond:
+            if commands in self._queues:
+                self._queues.remove(commands)
+
+    def _put(self, commands, item):
+        with self._cond:
+            if not self.running:
+                raise RuntimeError('Roboclaw I/O thread is not running')
+            commands.append(item)
+            self._cond.notify()
+
+    def _take(self):
+        """
+        Pop the next item, visiting each worker's queue in turn. While the
+        link is down, returns False when the next reconnect attempt is due.
+        """
+        with self._cond:
+            while True:
+                count = len(self._queues)
+                for offset in range(count):
+                    index = (self._next + offset) % count
+                    if self._queues[index]:
+                        self._next = index + 1
+                        return self._queues[index].popleft()
+                if self._closing:
+                    return None
+                if self._lost is None:
+                    self._cond.wait()
+                else:
+                    delay = self._next_attempt - time.monotonic()
+                    if delay <= 0:
+                        return False
+                    self._cond.wait(delay)
+
+    def _serve(self):
+        while True:
+            item = self._take()
+            if item is None:
+                break
+            if item is False:
+                self._reconnect()
+                continue
+            future, func, args, kwargs, expires = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            if expires is not None and time.monotonic() > expires:
+                future.set_exception(DeadlineExceeded(
+                    f'Dropped after waiting {time.monotonic() - expires:.3f}s '
+                    f'past its deadline for the serial port'))
+                continue
+            if self._lost is not None and not self._reconnect():
+                with self._stats_lock:
+                    self._link['failed_fast'] += 1
+                future.set_exception(ConnectionError(
+                    f'Serial port {self.rc.comport} is lost; reconnecting'))
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except OSError as err: # SerialException too: the port itself failed
+                self._port_lost(err)
+                future.set_exception(err)
+            except BaseException as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+    def _port_lost(self, err):
+        if self._lost is not None:
+            return
+        self._lost = time.monotonic()
+        self._backoff = __RECONNECT_MIN__
+        self._next_attempt = self._lost + self._backoff
+        with self._stats_lock:
+            self._link.update(up=False, last_error=f'{type(err).__name__}: {err}')
+            self._link['losses'] += 1
+        self.logger.error(f'Lost serial port {self.rc.comport}: {err}; reconnecting')
+
+    def _reconnect(self):
+        """
+        Try to reopen the lost port if an attempt is due; returns True if
+        the link is up. Runs on the I/O thread.
+        """
+        now = time.monotonic()
+        if now < self._next_attempt:
+            return False
+        with self._stats_lock:
+            self._link['attempts'] += 1
+        try:
+            self.rc.reopen()
+        except OSError as err:
+            self._backoff = min(2 * self._backoff, __RECONNECT_MAX__)
+            self._next_attempt = time.monotonic() + self._backoff
+            with self._stats_lock:
+                self._link['last_error'] = f'{type(err).__name__}: {err}'
+            return False
+        for rc in self._controllers:
+            rc._comport = self.rc._comport
+        recovery = time.monotonic() - self._lost
+        self._lost = None
+        with self._stats_lock:
+            link = self._link
+            link.update(up=True, last_recovery_s=recovery,
+                        max_recovery_s=max(recovery, link['max_recovery_s'] or 0.0))
+            link['reconnects'] += 1
+            link['downtime_s'] += recovery
+        self.logger.warning(f'Reopened serial port {self.rc.comport} after {recovery:.3f}s')
+        if self._listeners:
+            Thread(target=self._notify_reconnected, name='roboclaw-reconnect',
+                   daemon=True).start()
+        return True
+
+    def _notify_reconnected(self):
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception as err:
+                self.logger.error(f'Reconnect listener {callback} failed: {err}')
+
+
+class RoboclawWorker(object):
+    """Proxy that serializes all calls to a Roboclaw on its bus's I/O thread
+
+    Inputs
+    ------
+    rc : Roboclaw
+        The controller whose methods will be called
+    name : str
+        Name of the I/O thread when the worker creates its own bus
+    stats : MetricsRegistry
+        Optional registry for per-command serial statistics
+    bus : RoboclawBus
+        Shared bus for rc's serial port; if omitted the worker creates and
+        owns a private one
+
+    Attribute access returns a callable that queues the named Roboclaw
+    method and blocks until it has run, so the worker is a drop-in
+    replacement for the Roboclaw object itself.
+
+    Public Methods
+    --------------
+    call(name, *args):
+        Run a Roboclaw method on the I/O thread and wait for the result
+    submit(name, *args):
+        Queue a Roboclaw method and return a Future
+    run(func, *args):
+        Run func(roboclaw, *args) on the I/O thread as one transaction
+    close():
+        Finish queued commands and detach from the bus, closing the bus and
+        port as well if the worker owns them
+    """
+
+    def __init__(self, rc, name='roboclaw-io', stats=None, bus=None):
+        self._rc = rc
+        self.stats = stats
+        self._owns_bus = bus is None
+        self.bus = RoboclawBus(rc, name) if bus is None else bus
+        self._commands = self.bus._attach()
+
+    def __getattr__(self, name):
+        attr = getattr(self._rc, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return call
+
+    def submit(self, name, *args, **kwargs):
+        """Queue the named Roboclaw method and return a Future for it"""
+        return self._submit(self._timed(getattr(self._rc, name)), args, kwargs)
+
+    def call(self, name, *args, **kwargs):
+        """Run the named Roboclaw method on the I/O thread and return its result"""
+        if self.bus.on_io_thread:
+            return self._timed(getattr(self._rc, name))(*args, **kwargs)
+        with tracing.span(f'wait {name}', cat='io'): # Queueing plus the command itself
+            return self.submit(name, *args, **kwargs).result()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run func(roboclaw, *args, **kwargs) on the I/O thread. Nothing else
+        touches the serial port until func returns, so several commands can
+        be grouped into a single transaction.
+        """
+        rc = self._rc if self._untimed() else _TimedRoboclaw(self)
+        if self.bus.on_io_thread:
+            return func(rc, *args, **kwargs)
+        return self._submit(func, (rc,) + args, kwargs).result()
+
+    def close(self):
+        """Finish this worker's queued commands and detach from the bus"""
+        if self._owns_bus:
+            self.bus.close()
+            return
+        if self.bus.running and not self.bus.on_io_thread:
+            self._submit(lambda: None, (), {}).result()
+        self.bus._detach(self._commands)
+
+    def _untimed(self):
+        return self.stats is None and not tracing.enabled()
+
+    def _timed(self, method):
+        """
+        Wrap a Roboclaw method so that each call is recorded in stats and
+        as a tracing span
+        """
+        if self._untimed():
+            return method
+
+        def timed(*args, **kwargs):
+            stats = self.stats
+            sent = self._rc.commands_sent
+            ok = False
+            with tracing.span(method.__name__, cat='serial') as span:
+                start = time.perf_counter()
+                try:
+                    result = method(*args, **kwargs)
+                    ok = _succeeded(result)
+                    return result
+                finally:
+                    elapsed = time.perf_counter() - start
+                    attempts = self._rc.commands_sent - sent
+                    span.set(addr=hex(self._rc._addr), attempts=attempts, ok=ok)
+                    if attempts and stats is not None:
+                        cmd = CMD_NAMES.get(self._rc.last_cmd, str(self._rc.last_cmd))
+                        stats.observe('agitator_serial_seconds', elapsed, cmd=cmd)
+                        if attempts > 1:
+                            stats.inc('agitator_serial_retries_total', attempts - 1, cmd=cmd)
+                        if not ok:
+                            stats.inc('agitator_serial_failures_total', cmd=cmd)
+        return timed
+
+    def _submit(self, func, args, kwargs):
+        future = Future()
+        self.bus._put(self._commands, (future, func, args, kwargs, _deadline.get()))
+        return future
+
+
+class _TimedRoboclaw(object):
+    """Roboclaw stand-in handed to run() callbacks when stats are enabled"""
+
+    def __init__(self, worker):
+        self._worker = worker
+
+    def __getattr__(self, name):
+        attr = getattr(self._worker._rc, name)
+        if callable(attr):
+            return self._worker._timed(attr)
+        return attr
@@ -0,0 +1,401 @@
+"""
+    Simulated Roboclaw module
+
+    Provides a serial-port stand-in that speaks the Roboclaw packet serial
+    protocol, so the agitator stack can be run and benchmarked without
+    hardware. Open it through Roboclaw with a comport of the form
+
+        sim://<bus>?addr=0x80,0x81&realtime=1&crc_error_rate=0.0&baud=38400
+
+    Controllers live in a module registry keyed by bus name, so reopening
+    the same bus finds the same controller state. With realtime enabled
+    (the default) every byte costs 10 bit-times at the port baud rate, as
+    it would on the wire. Each controller listens at the baud rate in its
+    config register (baud sets it when the bus is created) and ignores
+    bytes sent at any other rate; SetConfig changes it after replying.
+
+    unplug(name) makes a bus behave like a USB-serial adapter that was
+    pulled out: open ports raise SerialException and new ones cannot be
+    opened. After plug(name) the bus can be opened again, but ports opened
+    before the unplug stay dead, as a re-enumerated device would.
+"""
+import time
+import random
+from threading import Lock
+from urllib.parse import urlsplit, parse_qs
+
+from roboclaw_baud import config_rate, with_rate
+
+
+__DEFAULT_ADDR__ = 0x80
+__DEFAULT_BATTERY__ = 240 # tenths of a volt
+__DEFAULT_TEMP__ = 250 # tenths of a degree C
+
+
+def crc16(data, crc=0):
+    """CCITT CRC used by the Roboclaw packet serial protocol"""
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+
+def _long(val):
+    return (val & 0xFFFFFFFF).to_bytes(4, 'big')
+
+
+def _word(val):
+    return (val & 0xFFFF).to_bytes(2, 'big')
+
+
+def _slong(data):
+    return int.from_bytes(data, 'big', signed=True)
+
+
+# Number of argument bytes that follow each write command
+WRITE_ARGS = {
+    0: 1, 1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 1, 8: 1, 9: 1, 10: 1,
+    11: 1, 12: 1, 13: 1, 20: 0, 22: 4, 23: 4, 26: 1, 27: 1, 28: 16, 29: 16,
+    32: 2, 33: 2, 34: 4, 35: 4, 36: 4, 37: 8, 38: 8, 39: 8, 40: 12, 41: 9,
+    42: 9, 43: 17, 44: 13, 45: 13, 46: 21, 50: 16, 51: 29, 52: 6, 53: 6,
+    54: 12, 57: 4, 58: 4, 61: 28, 62: 28, 65: 17, 66: 17, 67: 33, 68: 4,
+    69: 4, 74: 3, 76: 2, 80: 0, 92: 1, 93: 1, 94: 4, 95: 0, 98: 2, 133: 8,
+    134: 8, 148: 1,
+}
+
+
+class SimulatedMotor(object):
+    """Velocity-controlled motor with a trapezoidal speed ramp"""
+
+    def __init__(self):
+        self.encoder = 0
+        self.speed = 0.0
+        self.target = 0
+        self.accel = 0
+        self.default_accel = 0
+        self.pid = (0, 0, 0, 0) # d, p, i, qpps as written
+        self.max_current = 0
+        self.encoder_mode = 0
+        self.pos_pid = bytes(28)
+
+    def advance(self, dt):
+        start = self.speed
+        step = self.accel * dt if self.accel else abs(self.target - start)
+        if self.target > start:
+            self.speed = min(self.target, start + step)
+        else:
+            self.speed = max(self.target, start - step)
+        self.encoder += 0.5 * (start + self.speed) * dt
+
+    @property
+    def current(self):
+        """Motor current in units of 10 mA"""
+        qpps = self.pid[3] or 9600
+        return int(5 + 80 * abs(self.speed) / qpps)
+
+
+class SimulatedController(object):
+    """State of one Roboclaw at a packet serial address"""
+
+    def __init__(self, addr=__DEFAULT_ADDR__, baudrate=38400):
+        self.addr = addr
+        self.motors = (SimulatedMotor(), SimulatedMotor())
+        self.battery = __DEFAULT_BATTERY__
+        self.temperature = __DEFAULT_TEMP__
+        self.main_voltages = (60, 340)
+        self.logic_voltages = (60, 340)
+        self.config = with_rate(0x0063 | ((addr - 0x80) << 8), baudrate)
+        self.nvm = None
+        self.nvm_writes = 0
+        self.pwm_mode = 1
+        self.error = 0
+        self._last = time.monotonic()
+
+    @property
+    def baudrate(self):
+        return config_rate(self.config)
+
+    def advance(self):
+        now = time.monotonic()
+        for motor in self.motors:
+            motor.advance(now - self._last)
+        self._last = now
+
+    def write(self, cmd, args):
+        """Apply a write command; returns False for unsupported commands"""
+        m = self.motors
+        if cmd in (22, 23):
+            m[cmd - 22].encoder = _slong(args)
+        elif cmd == 20:
+            m[0].encoder = m[1].encoder = 0
+        elif cmd in (28, 29):
+            m[cmd - 28].pid = tuple(int.from_bytes(args[i:i+4], 'big')
+                                    for i in range(0, 16, 4))
+        elif cmd in (35, 36):
+            m[cmd - 35].target = _slong(args)
+            m[cmd - 35].accel = m[cmd - 35].default_accel
+        elif cmd in (38, 39):
+            motor = m[cmd - 38]
+            motor.accel = int.from_bytes(args[:4], 'big')
+            motor.target = _slong(args[4:8])
+        elif cmd == 40:
+            accel = int.from_bytes(args[:4], 'big')
+            for motor, offset in zip(m, (4, 8)):
+                motor.accel = accel
+                motor.target = _slong(args[offset:offset+4])
+        elif cmd == 57:
+            self.main_voltages = (int.from_bytes(args[:2], 'big'),
+                                  int.from_bytes(args[2:], 'big'))
+        elif cmd == 58:
+            self.logic_voltages = (int.from_bytes(args[:2], 'big'),
+                                   int.from_bytes(args[2:], 'big'))
+        elif cmd in (61, 62):
+            m[cmd - 61].pos_pid = bytes(args)
+        elif cmd in (68, 69):
+            m[cmd - 68].default_accel = int.from_bytes(args, 'big')
+        elif cmd in (92, 93):
+            m[cmd - 92].encoder_mode = args[0]
+        elif cmd == 94:
+            self.nvm = self._settings()
+            self.nvm_writes += 1
+        elif cmd == 95:
+            if self.nvm is not None:
+                self._restore(self.nvm)
+        elif cmd == 98:
+            self.config = int.from_bytes(args, 'big')
+        elif cmd in (133, 134):
+            m[cmd - 133].max_current = int.from_bytes(args[:4], 'big')
+        elif cmd == 148:
+            self.pwm_mode = args[0]
+        elif cmd not in WRITE_ARGS:
+            return False
+        return True
+
+    def read(self, cmd):
+        """Return the reply payload for a read command, or None"""
+        m = self.motors
+        if cmd in (16, 17):
+            motor = m[cmd - 16]
+            return _long(int(motor.encoder)) + bytes([0x80 if motor.speed < 0 else 0])
+        elif cmd in (18, 19, 30, 31):
+            motor = m[(cmd - 18) % 2 if cmd < 30 else cmd - 30]
+            return _long(int(motor.speed)) + bytes([motor.speed < 0])
+        elif cmd == 21:
+            return b'USB Roboclaw 2x7a v4.1.34 (simulated)\n\x00'
+        elif cmd == 24:
+            return _word(self.battery)
+        elif cmd == 25:
+            return _word(50)
+        elif cmd == 47:
+            return bytes([0x80, 0x80])
+        elif cmd == 48:
+            return bytes(4)
+        elif cmd == 49:
+            return _word(m[0].current) + _word(m[1].current)
+        elif cmd in (55, 56):
+            d, p, i, qpps = m[cmd - 55].pid
+            return _long(p) + _long(i) + _long(d) + _long(qpps)
+        elif cmd == 59:
+            return _word(self.main_voltages[0]) + _word(self.main_voltages[1])
+        elif cmd == 60:
+            return _word(self.logic_voltages[0]) + _word(self.logic_voltages[1])
+        elif cmd in (63, 64):
+            return m[cmd - 63].pos_pid
+        elif cmd == 75:
+            return bytes(3)
+        elif cmd == 77:
+            return bytes(2)
+        elif cmd in (82, 83):
+            return _word(self.temperature)
+        elif cmd == 90:
+            return _word(self.error)
+        elif cmd == 91:
+            return bytes([m[0].encoder_mode, m[1].encoder_mode])
+        elif cmd == 99:
+            return _word(self.config)
+        elif cmd in (135, 136):
+            return _long(m[cmd - 135].max_current) + _long(0)
+        elif cmd == 149:
+            return bytes([self.pwm_mode])
+        return None
+
+    def _settings(self):
+        return (self.config, self.main_voltages, self.logic_voltages,
+                [(mo.pid, mo.max_current, mo.encoder_mode, mo.default_accel)
+                 for mo in self.motors])
+
+    def _restore(self, settings):
+        self.config, self.main_voltages, self.logic_voltages, motors = settings
+        for motor, (pid, max_current, mode, accel) in zip(self.motors, motors):
+            motor.pid = pid
+            motor.max_current = max_current
+            motor.encoder_mode = mode
+            motor.default_accel = accel
+
+
+class SimulatedBus(object):
+    """A serial bus with one or more controllers multi-dropped on it"""
+
+    def __init__(self, name, addrs=(__DEFAULT_ADDR__,), baudrate=38400):
+        self.name = name
+        self.controllers = {addr: SimulatedController(addr, baudrate) for addr in addrs}
+        self.lock = Lock()
+        self.plugged = True
+        self.generation = 0 # Incremented by every unplug
+
+
+_BUSES = {}
+_BUSES_LOCK = Lock()
+
+
+def get_bus(name='', addrs=(__DEFAULT_ADDR__,), baudrate=38400):
+    """Return the simulated bus with the given name, creating it if needed"""
+    with _BUSES_LOCK:
+        if name not in _BUSES:
+            _BUSES[name] = SimulatedBus(name, addrs, baudrate)
+        return _BUSES[name]
+
+
+def unplug(name=''):
+    """Simulate pulling the adapter of a bus; its open ports die"""
+    bus = get_bus(name)
+    with bus.lock:
+        bus.plugged = False
+        bus.generation += 1
+
+
+def plug(name=''):
+    """Simulate plugging the adapter back in; the bus can be opened again"""
+    bus = get_bus(name)
+    with bus.lock:
+        bus.plugged = True
+
+
+def reset():
+    """Forget every simulated bus and controller"""
+    with _BUSES_LOCK:
+        _BUSES.clear()
+
+
+class SimulatedSerial(object):
+    """Minimal pyserial-compatible port connected to a SimulatedBus
+
+    Inputs
+    ------
+    url : str
+        sim://<bus>?addr=...&realtime=...&crc_error_rate=...&baud=...
+    baudrate : int
+        Port baud rate used for wire timing
+    timeout : float
+        Read timeout in seconds when no reply is pending
+    """
+
+    def __init__(self, url, baudrate=38400, timeout=1.0, **kwargs):
+        parts = urlsplit(url)
+        options = parse_qs(parts.query)
+        addrs = tuple(int(addr, 0) for addr in
+                      options.get('addr', ['0x80'])[0].split(','))
+        self.bus = get_bus(parts.netloc, addrs,
+                           int(options.get('baud', ['38400'])[0]))
+        if not self.bus.plugged:
+            import serial
+            raise serial.SerialException(f'could not open port {url}: device not present')
+        self._generation = self.bus.generation
+        self.realtime = options.get('realtime', ['1'])[0] not in ('0', 'false')
+        self.crc_error_rate = float(options.get('crc_error_rate', ['0'])[0])
+        self.port = url
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+
+        self._rx = bytearray()
+        self._tx = bytearray()
+        self._line_free = time.monotonic() # when the wire is next idle
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def _wire(self, nbytes):
+        """Account for nbytes on the wire and return when they arrive"""
+        if not self.realtime:
+            return 0.0
+        now = time.monotonic()
+        self._line_free = max(now, self._line_free) + nbytes * 10.0 / self.baudrate
+        return self._line_free
+
+    def write(self, data):
+        self._check_open()
+        self._wire(len(data))
+        self._tx.extend(data)
+        self._process()
+        return len(data)
+
+    def read(self, size=1):
+        self._check_open()
+        if len(self._rx) < size and self.timeout:
+            # Nothing more is coming; a real port would block until timeout
+            if self.realtime:
+                time.sleep(self.timeout)
+        if self.realtime:
+            delay = self._line_free - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def flushInput(self):
+        self._rx.clear()
+
+    reset_input_buffer = flushInput
+
+    def close(self):
+        self.is_open = False
+
+    def _check_open(self):
+        if not self.is_open:
+            import serial
+            raise serial.SerialException('Attempting to use a port that is not open')
+        if self._generation != self.bus.generation:
+            import serial
+            raise serial.SerialException('device reports readiness to read but returned '
+                                         'no data (device disconnected?)')
+
+    def _reply(self, payload, crc=None):
+        if crc is not None:
+            if self.crc_error_rate and random.random() < self.crc_error_rate:
+                crc ^= 0x0001
+            payload = payload + _word(crc)
+        self._wire(len(payload))
+        self._rx.extend(payload)
+
+    def _process(self):
+        """Consume every complete packet in the transmit buffer"""
+        while len(self._tx) >= 2:
+            addr, cmd = self._tx[0], self._tx[1]
+            with self.bus.lock:
+                controller = self.bus.controllers.get(addr)
+                if controller is None or self.baudrate != controller.baudrate:
+                    # Nobody answers; drop a byte and try to resynchronize
+                    del self._tx[:1]
+                    continue
+                controller.advance()
+                if cmd in WRITE_ARGS:
+                    length = 2 + WRITE_ARGS[cmd] + 2
+                    if len(self._tx) < length:
+                        return
+                    packet = bytes(self._tx[:length])
+                    del self._tx[:length]
+                    if crc16(packet[:-2]) == int.from_bytes(packet[-2:], 'big'):
+                        controller.write(cmd, packet[2:-2])
+                        self._reply(b'\xff')
+                else:
+                    del self._tx[:2]
+                    payload = controller.read(cmd)
+                    if payload is not None:
+                        self._reply(payload, crc16(bytes([addr, cmd]) + payload))
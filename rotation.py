@@ -0,0 +1,203 @@
+"""
+    EXPRES Fiber Agitator Rotation module
+
+    Counts the rotations each motor actually makes during an exposure from
+    successive encoder readings, so the delivered agitation can be checked
+    against the rotations requested from start_agitation. Only running
+    totals and the previous reading are kept, so memory use does not grow
+    with the length of the exposure.
+
+    Encoder counts are 32-bit and wrap around; the difference between two
+    readings is taken modulo 2**32, so a wrap costs nothing. A reading that
+    jumps further than the motor could have turned since the last one (an
+    encoder reset with SetEncM1/SetEncM2, or a controller restart) is
+    counted as a reset: the counts since the reset are kept and the jump is
+    dropped.
+"""
+import time
+from threading import Lock
+
+
+__WRAP__ = 2**32
+__SLACK_COUNTS__ = 64 # extra counts allowed per reading before a jump is a reset
+__FREQ_INTERVAL__ = 0.2 # shortest time in seconds a frequency is measured over
+
+
+def wrapped_delta(new, old):
+    """Signed difference between two 32-bit encoder counts"""
+    return (new - old + __WRAP__ // 2) % __WRAP__ - __WRAP__ // 2
+
+
+class _MotorCount(object):
+    """Running encoder totals for one motor"""
+    __slots__ = ('last', 'last_time', 'counts', 'freq', 'samples', 'resets',
+                 '_window_counts', '_window_start')
+
+    def __init__(self):
+        self.last = None
+        self.last_time = None
+        self.counts = 0
+        self.freq = 0.0 # counts per second over the latest interval
+        self.samples = 0
+        self.resets = 0
+        self._window_counts = 0
+        self._window_start = None
+
+    def update(self, value, now, max_rate):
+        if self.last is not None:
+            dt = max(0.0, now - self.last_time)
+            delta = wrapped_delta(value, self.last)
+            if abs(delta) > max_rate * dt + __SLACK_COUNTS__:
+                # Reset since the last reading; only the counts after it are real
+                since = wrapped_delta(value, 0)
+                delta = since if abs(since) <= max_rate * dt + __SLACK_COUNTS__ else 0
+                self.resets += 1
+            self.counts += delta
+            self._window_counts += delta
+            # Readings close together would make a noisy frequency
+            if now - self._window_start >= __FREQ_INTERVAL__:
+                self.freq = self._window_counts / (now - self._window_start)
+                self._window_counts = 0
+                self._window_start = now
+        else:
+            self._window_counts = 0
+            self._window_start = now
+        self.last = value
+        self.last_time = now
+        self.samples += 1
+
+
+class RotationTracker(object):
+    """Rotation accounting for both agitator motors over one exposure
+
+    Inputs
+    ------
+    max_rate : float
+        Fastest possible encoder rate in counts per second (the QPPS); a
+        larger jump between readings is treated as an encoder reset
+
+    Public Methods
+    --------------
+    begin(requested, exp_time, counts_per_rotation, enc):
+        Start counting a new exposure from the given encoder readings
+    update(enc1, enc2, now):
+        Add one pair of encoder readings
+    listener(snapshot):
+        TelemetryPoller listener that feeds polled encoder readings to update
+    rebase(enc):
+        Continue from new encoder values after they were set on purpose
+    finish(enc):
+        Stop counting, optionally after one last pair of readings
+    report():
+        Return delivered and requested rotations for the exposure
+    """
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self._lock = Lock()
+        self._motors = (_MotorCount(), _MotorCount())
+        self._requested = (0.0, 0.0)
+        self._exp_time = 0.0
+        self._counts_per_rotation = (None, None)
+        self._calibrated = False
+        self._started = None
+        self._finished = None
+
+    @property
+    def active(self):
+        return self._started is not None and self._finished is None
+
+    def begin(self, requested, exp_time, counts_per_rotation, enc=None, calibrated=True):
+        """
+        Start a new exposure: requested is (rotations of motor 1, of motor
+        2) over exp_time seconds, and counts_per_rotation converts encoder
+        counts to rotations for each motor. calibrated is False when the
+        conversion was inferred from the commanded speed rather than
+        configured.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._motors = (_MotorCount(), _MotorCount())
+            self._requested = tuple(requested)
+            self._exp_time = exp_time
+            self._counts_per_rotation = tuple(counts_per_rotation)
+            self._calibrated = calibrated
+            self._started = now
+            self._finished = None
+            if enc is not None:
+                self._update(enc, now)
+
+    def update(self, enc1, enc2, now=None):
+        """Add the encoder readings taken at monotonic time now"""
+        with self._lock:
+            if self.active:
+                self._update((enc1, enc2), time.monotonic() if now is None else now)
+
+    def listener(self, snapshot):
+        """Feed the encoders from each telemetry poll that read both of them"""
+        polled = snapshot.get('polled', ())
+        if self.active and 'enc1' in polled and 'enc2' in polled:
+            self.update(snapshot['enc1'], snapshot['enc2'])
+
+    def rebase(self, enc=None):
+        """
+        Continue counting from the encoder values enc after the encoders
+        were set deliberately (e.g. zeroed); if enc is None, the next
+        reading becomes the reference instead
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not self.active:
+                return
+            for index, motor in enumerate(self._motors):
+                motor.last = None if enc is None else enc[index]
+                motor.last_time = now
+                if motor._window_start is None:
+                    motor._window_start = now
+
+    def finish(self, enc=None):
+        """Stop counting, after adding the final readings enc if given"""
+        now = time.monotonic()
+        with self._lock:
+            if not self.active:
+                return
+            if enc is not None:
+                self._update(enc, now)
+            self._finished = now
+
+    def report(self):
+        """
+        Return the delivered and requested rotations per motor, or None
+        before the first exposure. Expected rotations are what the requested
+        rate would have delivered in the time actually spent agitating.
+        """
+        with self._lock:
+            if self._started is None:
+                return None
+            elapsed = (self._finished or time.monotonic()) - self._started
+            report = {'elapsed': elapsed,
+                      'exp_time': self._exp_time,
+                      'finished': self._finished is not None,
+                      'calibrated': self._calibrated}
+            for index, motor in enumerate(self._motors, start=1):
+                requested = self._requested[index - 1]
+                per_rotation = self._counts_per_rotation[index - 1]
+                delivered = motor.counts / per_rotation if per_rotation else None
+                if self._exp_time:
+                    expected = requested * min(1.0, elapsed / self._exp_time)
+                else:
+                    expected = 0.0
+                report[f'motor{index}'] = {
+                    'counts': motor.counts,
+                    'requested': requested,
+                    'expected': expected,
+                    'delivered': delivered,
+                    'ratio': delivered / expected if delivered is not None and expected else None,
+                    'freq': motor.freq / per_rotation if per_rotation else None,
+                    'samples': motor.samples,
+                    'resets': motor.resets}
+            return report
+
+    def _update(self, enc, now):
+        for motor, value in zip(self._motors, enc):
+            motor.update(value, now, self.max_rate)
@@ -0,0 +1,254 @@
+"""
+    Roboclaw Serial Capture and Replay
+
+    Provides a tap that records every byte exchanged with a Roboclaw to a
+    compact binary capture file, and a replay port that feeds such a
+    capture back to Roboclaw (and so to an Agitator) in place of the real
+    serial port, so field incidents can be reproduced and timed offline.
+
+    Capture format: the magic b'RCAP', a version byte, a little-endian
+    uint32 length and that many bytes of JSON metadata, then one record per
+    frame: float64 seconds since the capture started (when the last byte of
+    a sent frame was written, or the first byte of a received frame was
+    read), a direction byte (0 = sent to the controller, 1 = received from
+    it), a uint16 length and the frame bytes. Roboclaw reads and writes one
+    byte at a time, so the tap coalesces consecutive bytes in one direction
+    into a single frame; a command and its reply are then two records.
+
+    To record, pass capture='file.rcap' to Roboclaw (or --capture to the
+    server). To replay, open the Roboclaw on 'replay://file.rcap?speed=1',
+    where speed scales the recorded reply latencies (speed=0 replies at
+    once) and strict=1 raises ReplayMismatch when the bytes sent differ
+    from the capture.
+
+    To inspect a capture, execute from the containing folder:
+    python serial_capture.py file.rcap
+"""
+import io
+import json
+import time
+import struct
+from urllib.parse import urlsplit, parse_qs
+
+
+MAGIC = b'RCAP'
+VERSION = 1
+TX = 0
+RX = 1
+
+_HEADER = struct.Struct('<I')
+_FRAME = struct.Struct('<dBH')
+_MAX_FRAME = 0xFFFF
+
+
+class ReplayMismatch(Exception):
+    """The bytes sent during a strict replay differ from the capture"""
+
+
+class CaptureTap(object):
+    """Serial port wrapper that records all traffic to a capture file
+
+    Inputs
+    ------
+    port : serial.Serial
+        The open port (or any object with read, write and flushInput)
+    path : str
+        Capture file to create
+    metadata : dict
+        Extra JSON-serializable values stored in the file header
+    """
+
+    def __init__(self, port, path, metadata=None):
+        self._port = port
+        self.path = path
+        self.frames = 0
+        info = {'port': getattr(port, 'port', None),
+                'baudrate': getattr(port, 'baudrate', None),
+                'started': time.time()}
+        info.update(metadata or {})
+        header = json.dumps(info).encode('utf-8')
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + bytes([VERSION]) + _HEADER.pack(len(header)) + header)
+        self._start = time.perf_counter()
+        self._direction = None
+        self._stamp = 0.0
+        self._pending = bytearray()
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def __setattr__(self, name, value):
+        if name in ('baudrate', 'timeout'): # Port settings changed while open
+            setattr(self._port, name, value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def write(self, data):
+        self._record(TX, data)
+        return self._port.write(data)
+
+    def read(self, size=1):
+        data = self._port.read(size)
+        if data:
+            self._record(RX, data)
+        return data
+
+    def close(self):
+        try:
+            self._port.close()
+        finally:
+            self._flush()
+            self._file.close()
+
+    def _record(self, direction, data):
+        if direction != self._direction or len(self._pending) + len(data) > _MAX_FRAME:
+            self._flush()
+            self._direction = direction
+            self._stamp = time.perf_counter() - self._start
+        elif direction == TX:
+            self._stamp = time.perf_counter() - self._start
+        self._pending.extend(data)
+
+    def _flush(self):
+        if self._pending:
+            self._file.write(_FRAME.pack(self._stamp, self._direction, len(self._pending)))
+            self._file.write(self._pending)
+            self._pending = bytearray()
+            self.frames += 1
+
+
+def read_capture(path):
+    """Return (metadata, frames) where frames is a list of (time, direction, bytes)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != MAGIC or data[4] != VERSION:
+        raise ValueError(f'{path} is not a version {VERSION} Roboclaw capture')
+    (length,) = _HEADER.unpack_from(data, 5)
+    offset = 5 + _HEADER.size
+    metadata = json.loads(data[offset:offset + length])
+    offset += length
+    frames = []
+    while offset < len(data):
+        stamp, direction, size = _FRAME.unpack_from(data, offset)
+        offset += _FRAME.size
+        frames.append((stamp, direction, bytes(data[offset:offset + size])))
+        offset += size
+    return metadata, frames
+
+
+class ReplaySerial(object):
+    """pyserial-compatible port that plays a capture back to Roboclaw
+
+    Inputs
+    ------
+    url : str
+        replay://<path>?speed=...&strict=...
+    timeout : float
+        Accepted for compatibility; replies are never waited for longer
+        than the capture says
+
+    Each write consumes the matching number of recorded transmit bytes,
+    and reads return the reply bytes recorded after them, available once
+    the recorded latency divided by speed has passed. Bytes sent that
+    differ from the capture are counted in mismatches.
+    """
+
+    def __init__(self, url, baudrate=38400, timeout=1.0, **kwargs):
+        parts = urlsplit(url)
+        options = parse_qs(parts.query)
+        self.path = parts.netloc + parts.path
+        self.speed = float(options.get('speed', ['1'])[0])
+        self.strict = options.get('strict', ['0'])[0] not in ('0', 'false')
+        self.port = url
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self.metadata, frames = read_capture(self.path)
+        self.mismatches = 0
+
+        self._frames = frames
+        self._index = 0 # Next frame to consume
+        self._tx = b'' # Rest of the transmit frame being matched
+        self._rx = io.BytesIO()
+        self._anchor = (0.0, 0.0) # (recorded, local) time of the last transmit frame
+
+    @property
+    def in_waiting(self):
+        return len(self._rx.getbuffer()) - self._rx.tell()
+
+    @property
+    def finished(self):
+        return self._index >= len(self._frames) and not self._tx
+
+    def write(self, data):
+        self._check_open()
+        data = bytes(data)
+        sent = data
+        while sent:
+            if not self._tx:
+                self._next_transmit()
+                if not self._tx:
+                    break # Past the end of the capture
+            expected, self._tx = self._tx[:len(sent)], self._tx[len(sent):]
+            if not self._tx:
+                self._anchor = (self._anchor[0], time.perf_counter())
+            if expected != sent[:len(expected)]:
+                self.mismatches += 1
+                if self.strict:
+                    raise ReplayMismatch(f'Sent {sent[:len(expected)].hex()} where the '
+                                         f'capture has {expected.hex()} (frame {self._index})')
+            sent = sent[len(expected):]
+        return len(data)
+
+    def read(self, size=1):
+        self._check_open()
+        if not self._tx:
+            self._collect_replies()
+        return self._rx.read(size)
+
+    def flushInput(self):
+        pass # The capture only holds the bytes Roboclaw actually read
+
+    reset_input_buffer = flushInput
+
+    def close(self):
+        self.is_open = False
+
+    def _check_open(self):
+        if not self.is_open:
+            import serial
+            raise serial.SerialException('Attempting to use a port that is not open')
+
+    def _next_transmit(self):
+        """Skip to the next transmit frame, dropping replies nobody read"""
+        while self._index < len(self._frames):
+            stamp, direction, data = self._frames[self._index]
+            self._index += 1
+            if direction == TX:
+                self._tx = data
+                self._anchor = (stamp, None) # Local time is set once it is all sent
+                self._rx = io.BytesIO()
+                return
+
+    def _collect_replies(self):
+        """Make the reply frames after the current transmit frame readable"""
+        pending = self._rx.read()
+        while self._index < len(self._frames) and self._frames[self._index][1] == RX:
+            stamp, _, data = self._frames[self._index]
+            self._index += 1
+            if self.speed > 0:
+                delay = (self._anchor[1] + (stamp - self._anchor[0]) / self.speed
+                         - time.perf_counter())
+                if delay > 0:
+                    time.sleep(delay)
+            pending += data
+        self._rx = io.BytesIO(pending)
+
+
+if __name__ == '__main__':
+    import sys
+
+    metadata, frames = read_capture(sys.argv[1])
+    print(json.dumps(metadata))
+    for stamp, direction, data in frames:
+        print('{:12.6f} {} {}'.format(stamp, 'TX' if direction == TX else 'RX', data.hex(' ')))
@@ -1,97 +1,301 @@
+"""
+    EXPRES Fiber Agitator Socket Client module
+
+    Provides clients for the length-prefixed JSON protocol served by
+    socket_server. Messages up to 9999 bytes carry the original 4 digit
+    ASCII length header; longer messages use a 4 byte big-endian length
+    whose first byte is zero, which can never be mistaken for ASCII.
+
+    Each request carries an "id" that the server echoes in its reply, so
+    replies can be matched to requests when several are in flight on one
+    connection.
+"""
+import json
+import queue
 import socket
+import logging
+import itertools
+from threading import Lock
+
+
+__HEADER_SIZE__ = 4
+__MAX_ASCII_LENGTH__ = 9999
+__MAX_LENGTH__ = 0xFFFFFF
+__DEFAULT_TIMEOUT__ = 5.0
+__DEFAULT_POOL_SIZE__ = 4
+
+
+class ProtocolError(Exception):
+    """Raised when a message cannot be framed or parsed"""
+
+
+def encode_message(obj):
+    """Serialize obj to JSON and frame it with a length header"""
+    data = json.dumps(obj).encode('utf-8')
+    if len(data) <= __MAX_ASCII_LENGTH__:
+        header = '{length:4d}'.format(length=len(data)).encode('ascii')
+    elif len(data) <= __MAX_LENGTH__:
+        header = len(data).to_bytes(__HEADER_SIZE__, 'big')
+    else:
+        raise ProtocolError(f'Message of {len(data)} bytes is too long to send')
+    return header + data
+
+
+def parse_header(header):
+    """Return the message length encoded in a 4 byte header"""
+    if header[0] == 0:
+        return int.from_bytes(header, 'big')
+    try:
+        return int(header.decode('ascii'))
+    except ValueError:
+        raise ProtocolError(f'Invalid message header {header!r}')
+
+
+def recv_exact(sock, size):
+    """Read exactly size bytes, looping over short reads"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by server')
+        data.extend(chunk)
+    return bytes(data)
+
+
+def recv_message(sock):
+    """Read one framed JSON message from a blocking socket"""
+    length = parse_header(recv_exact(sock, __HEADER_SIZE__))
+    try:
+        return json.loads(recv_exact(sock, length))
+    except ValueError as err:
+        raise ProtocolError(f'Invalid JSON message: {err}')
+
+
+class Connection(object):
+    """
+    A persistent connection to a socket server. Replies that do not belong
+    to the requests being waited for are discarded.
+    """
+
+    def __init__(self, host, port, timeout=__DEFAULT_TIMEOUT__):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.used = False # True once a request has gone out on this connection
+
+    def send(self, messages):
+        self.sock.sendall(b''.join(encode_message(msg) for msg in messages))
+        self.used = True
+
+    def receive(self, ids):
+        """Wait for the replies to the given request ids"""
+        ids = set(ids)
+        replies = {}
+        while ids:
+            reply = recv_message(self.sock)
+            if reply.get('id') in ids:
+                ids.remove(reply['id'])
+                replies[reply['id']] = reply
+        return replies
+
+    def close(self):
+        self.sock.close()
 
-class SocketClient:
+
+class SocketClient(object):
     """
     Parent class that contains methods to communicate through a socket
-    """    
+
+    Inputs
+    ------
+    host, port : str, int
+        Address of the socket server
+    timeout : float
+        Seconds to wait when connecting or for a reply
+    pool_size : int
+        Number of idle connections kept open for reuse
+
+    Connections are pooled per instance, so several threads can use one
+    client at once, each on its own connection, and separate instances
+    never share state.
+    """
     name = 'Unknown Server'
-    module = ExpresModule
-    connected = False
-    host = None
-    port = None
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, timeout=__DEFAULT_TIMEOUT__,
+                 pool_size=__DEFAULT_POOL_SIZE__):
         self.setHost(host)
         self.setPort(port)
+        self.timeout = timeout
+        self.logger = logging.getLogger('expres_agitator')
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._ids = itertools.count(1)
+        self._ids_lock = Lock()
+
+    def setHost(self, host):
+        self.host = host
+
+    def setPort(self, port):
+        self.port = port
 
-    @classmethod
-    def setHost(cls, host):
-        cls.host = host
+    @property
+    def connected(self):
+        return not self._pool.empty()
 
-    @classmethod
-    def setPort(cls, port):
-        cls.port = port
-    
-    @classmethod
-    def connect(cls):
+    def connect(self):
+        """Open a new connection, returning None if the server is unreachable"""
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((cls.host, cls.port))
-            cls.connected = True
-            return sock
+            return Connection(self.host, self.port, self.timeout)
         except OSError as msg:
-            module.logger.error('Cannot connect to {}: {}'.format(cls.name, msg))
-            cls.connected = False
+            self.logger.error('Cannot connect to {}: {}'.format(self.name, msg))
             return None
 
-    @classmethod
-    def disconnect(cls, a_socket):
-        a_socket.close()
-        cls.connected = False
-
-    @classmethod
-    def sendMessage(cls, msg):
-        # send size of message in 4 bytes
-        sz = '{length:4d}'.format(length=len(msg))
-        sock = cls.connect()
-        if sock is not None:
-            sock.send(sz.encode('utf-8'))
-            sock.send(msg.encode('utf-8'))
-            cls.disconnect(sock)
-        else:
-            module.logger.error('{} connection error while sending'.format(cls.name))
-
-    @classmethod
-    def sendRecvMessg(cls, msg):
-        # send size of message in 4 bytes, 
-        sz = '{length:4d}'.format(length=len(msg))
-        sock = cls.connect()
-        if cls.connected:
-            sock.send(sz.encode('utf-8'))
-            sock.send(msg.encode('utf-8'))
-            resp = sock.recv(4).decode()
-            resp = sock.recv(int(resp)).decode()
-            cls.disconnect(sock)
-            return resp
+    def disconnect(self):
+        """Close every pooled connection"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _exchange(self, messages):
+        """
+        Send messages on one connection and return their replies in order.
+        A pooled connection the server has since closed is replaced and the
+        exchange tried once more; that is only safe because every message
+        waits for its reply, which shows whether the server got it.
+        """
+        for attempt in range(2):
+            conn = self._acquire()
+            if conn is None:
+                return None
+            reused = conn.used
+            try:
+                conn.send(messages)
+                replies = conn.receive(msg['id'] for msg in messages)
+            except (OSError, ProtocolError) as err:
+                conn.close()
+                if reused and attempt == 0 and isinstance(err, ConnectionError):
+                    # The server closed idle connections, so the rest of
+                    # the pool is stale too; retry on a fresh connection
+                    self.disconnect()
+                    continue
+                self.logger.error('{} connection error: {}'.format(self.name, err))
+                return None
+            self._release(conn)
+            return [replies.get(msg['id']) for msg in messages]
+
+    def _prepare(self, msg):
+        if isinstance(msg, str):
+            msg = json.loads(msg)
         else:
-            module.logger.error('{} connection error while receiving'.format(cls.name))
-            return {'error': 'cannot connect to {}'.format(cls.name)}
+            msg = dict(msg)
+        with self._ids_lock:
+            msg['id'] = next(self._ids)
+        return msg
+
+    def sendMessage(self, msg):
+        """
+        Send a message and wait until the server acknowledges it with its
+        reply, which is returned
+
+        Raises
+        ------
+        ConnectionError
+            If the message could not be delivered or was not answered
+        """
+        replies = self._exchange([self._prepare(msg)])
+        if replies is None:
+            raise ConnectionError('{} did not acknowledge {}'.format(
+                self.name, msg.get('method') if isinstance(msg, dict) else msg))
+        return replies[0]
+
+    def sendRecvMessg(self, msg):
+        """Send a message and return the server's reply"""
+        replies = self._exchange([self._prepare(msg)])
+        if replies is None:
+            self.logger.error('{} connection error while receiving'.format(self.name))
+            return {'error': 'cannot connect to {}'.format(self.name)}
+        return replies[0]
+
+    def pipeline(self, msgs):
+        """
+        Send several messages back to back on one connection, then collect
+        the replies, returned in the same order as msgs
+        """
+        replies = self._exchange([self._prepare(msg) for msg in msgs])
+        if replies is None:
+            return [{'error': 'cannot connect to {}'.format(self.name)}] * len(msgs)
+        return replies
+
+    def preparePayload(self, method, params=None):
+        return {'method': method,
+                'params': params or {}}
 
-    def preparePayload(self, method, params):
-        msg = {'method': method,
-               'params': params}
-        return json.dumps(msg)  
 
 class AgitatorSocketClient(SocketClient):
     """
     Class containing the client to communicate with the agitator server
     """
     name = 'Agitator'
-    module = Agitator
 
-    def __init__(self, host, port):
-        super().__init__(host, port)
+    def __init__(self, host, port, **kwargs):
+        super().__init__(host, port, **kwargs)
 
     def startAgitation(self, exp_time):
-        msg = self.preparePayload('start-agitation', {'exp_time': exp_time})
+        """Start agitation; raises if the server does not acknowledge it"""
+        return self._command(self.preparePayload('start-agitation', {'exp_time': exp_time}),
+                             'start agitation')
+
+    def stopAgitation(self, exp_time=None):
+        """Stop agitation; raises if the server does not acknowledge it"""
+        return self._command(self.preparePayload('stop-agitation'), 'stop agitation')
+
+    def _command(self, msg, action):
         try:
-            self.sendMessage(msg)
+            reply = self.sendMessage(msg)
         except Exception as err:
-            module.logger.error('Unable to start agitation: {}'.format(err))
+            self.logger.error('Unable to {}: {}'.format(action, err))
+            raise
+        if 'error' in reply:
+            self.logger.error('Unable to {}: {}'.format(action, reply['error']))
+            raise RuntimeError('{} refused to {}: {}'.format(self.name, action, reply['error']))
+        return reply.get('result')
 
-    def stopAgitation(self, exp_time):
-        msg = self.preparePayload('stop-agitation')
+    def status(self):
+        return self.sendRecvMessg(self.preparePayload('status'))
+
+    def subscribe(self, fields=None, rate=1.0):
+        """
+        Generator yielding telemetry dictionaries pushed by the server at up
+        to rate Hz. Uses its own connection, which is closed when the
+        generator is closed.
+        """
+        conn = self.connect()
+        if conn is None:
+            return
         try:
-            self.sendMessage(msg)
-        except Exception as err:
-            module.logger.error('Unable to stop agitation: {}'.format(err))
\ No newline at end of file
+            request = self._prepare(self.preparePayload('subscribe',
+                                    {'fields': fields, 'rate': rate}))
+            conn.send([request])
+            reply = conn.receive([request['id']])[request['id']]
+            if 'error' in reply:
+                raise ProtocolError(reply['error'])
+            conn.sock.settimeout(None) # Wait as long as it takes for pushes
+            while True:
+                msg = recv_message(conn.sock)
+                if 'telemetry' in msg:
+                    yield msg['telemetry']
+        finally:
+            conn.close()
@@ -1,20 +1,306 @@
-import socket
+"""
+    EXPRES Fiber Agitator Socket Server module
+
+    Provides an asyncio server for the length-prefixed JSON protocol spoken
+    by socket_client.AgitatorSocketClient. Every message is a 4 byte length
+    header (see socket_client.encode_message) followed by a JSON object
+    {"method": ..., "params": {...}, "id": ...}, and every request is
+    answered with a message of the same form holding either
+    {"result": ...} or {"error": ...} and the request's id.
+
+    Connections are persistent: a client may send any number of requests,
+    including several before reading the replies, which are returned in
+    request order. Many clients can be connected at once. This is a lower
+    overhead alternative to the XMLRPC server in agitator_server.
+
+    AgitatorSocketServer also serves a telemetry stream: after a
+    "subscribe" request with {"fields": [...], "rate": <Hz>} the connection
+    receives {"subscription": <id>, "telemetry": {...}} messages fanned out
+    from the agitator's single telemetry poller, so watchers add no load on
+    the controller.
+"""
 import json
+import time
+import asyncio
+import logging
+from threading import Thread
+
+from socket_client import ProtocolError, encode_message, parse_header
+
+
+__DEFAULT_HOST__ = 'expres2.lowell.edu'
+__DEFAULT_PORT__ = 5002
+__DEFAULT_COMPORT__ = 'COM12'
+__HEADER_SIZE__ = 4
+__MAX_STREAM_BACKLOG__ = 65536 # bytes queued for a slow subscriber before frames are dropped
 
-class SocketServer:
-    host = None
-    port = None
+
+async def read_message(reader):
+    """Read one framed message; returns None on a clean end of stream"""
+    try:
+        header = await reader.readexactly(__HEADER_SIZE__)
+    except asyncio.IncompleteReadError as err:
+        if err.partial:
+            raise ProtocolError('Connection closed inside a message header')
+        return None
+    length = parse_header(header)
+    try:
+        return json.loads(await reader.readexactly(length))
+    except ValueError as err:
+        raise ProtocolError(f'Invalid JSON message: {err}')
+
+
+class SocketServer(object):
+    """
+    Parent class for an asyncio length-prefixed JSON server. Subclasses
+    provide dispatch(method, params), which is run in a worker thread so
+    blocking calls never stall the event loop.
+    """
+    name = 'Socket Server'
 
     def __init__(self, host, port):
         self.set_host(host)
         self.set_port(port)
+        self.logger = logging.getLogger('expres_agitator')
+        self._loop = None
+        self._server = None
+        self._writers = set()
+        self._error = None
+
+    def set_host(self, host):
+        self.host = host
+
+    def set_port(self, port):
+        self.port = port
+
+    def dispatch(self, method, params):
+        raise NotImplementedError
+
+    async def respond(self, request, writer):
+        """Answer one request; subclasses may handle some methods inline"""
+        return await self._respond(request)
+
+    async def _respond(self, request):
+        if not isinstance(request, dict) or 'method' not in request:
+            return {'error': 'Request must be an object with a method'}
+        params = request.get('params') or {}
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(None, self.dispatch,
+                                                request['method'], params)
+        except Exception as err:
+            reply = {'error': '{}: {}'.format(type(err).__name__, err)}
+        else:
+            reply = {'result': result}
+        if 'id' in request:
+            reply['id'] = request['id']
+        return reply
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        self.logger.debug(f'{self.name} connection from {peer}')
+        self._writers.add(writer)
+        try:
+            while True:
+                request = await read_message(reader)
+                if request is None:
+                    break
+                writer.write(encode_message(await self.respond(request, writer)))
+                await writer.drain()
+        except ProtocolError as err:
+            self.logger.warning(f'{self.name} dropping {peer}: {err}')
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def serve(self):
+        """Serve until stop() is called"""
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._server = await asyncio.start_server(self.handle_connection,
+                                                      self.host, self.port)
+        except Exception:
+            self.closing()
+            raise
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.logger.info(f'Opening {self.name} on {self.host}:{self.port}')
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self.closing()
+
+    def closing(self):
+        """Called on the event loop once the server has stopped"""
 
     def run(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind((self.host, self.port))
-
-        while True: 
-            sock.listen(1)
-            conn, addr = sock.accept()
-            print('Connection from: {}'.format(addr))
-            serve_data(conn)
\ No newline at end of file
+        """Serve on the current thread until stop() is called"""
+        asyncio.run(self.serve())
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception as err:
+            self._error = err
+            self.logger.error(f'{self.name} on {self.host}:{self.port} failed: {err}')
+
+    def start(self):
+        """
+        Serve on a background thread; returns once the socket is bound
+
+        Raises
+        ------
+        OSError
+            If the socket could not be bound, or whatever else stopped the
+            server before it was listening
+        """
+        self._error = None
+        thread = Thread(target=self._run, name='agitator-socket-server',
+                        daemon=True)
+        thread.start()
+        while self._server is None and thread.is_alive():
+            thread.join(0.01)
+        if self._error is not None:
+            raise self._error
+        return thread
+
+    def stop(self):
+        """Stop serving; safe to call from any thread"""
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+
+
+class Subscription(object):
+    """A client's request for telemetry fields at a maximum rate"""
+
+    def __init__(self, sub_id, writer, fields=None, rate=1.0):
+        self.id = sub_id
+        self.writer = writer
+        self.fields = fields
+        self.interval = 1 / rate if rate else 0.0
+        self.last = 0.0
+        self.dropped = 0
+
+    def offer(self, snapshot, now):
+        """Send the snapshot if the rate allows and the client is keeping up"""
+        if now - self.last < self.interval:
+            return
+        if self.writer.transport.get_write_buffer_size() > __MAX_STREAM_BACKLOG__:
+            self.dropped += 1
+            return
+        self.last = now
+        if self.fields:
+            data = {key: snapshot[key] for key in self.fields if key in snapshot}
+            data['seq'] = snapshot['seq']
+            data['time'] = snapshot['time']
+        else:
+            data = snapshot
+        self.writer.write(encode_message({'subscription': self.id,
+                                          'telemetry': data}))
+
+
+class AgitatorSocketServer(SocketServer):
+    """
+    Socket server that dispatches requests to an Agitator object
+
+    Inputs
+    ------
+    host, port : str, int
+        Address to listen on
+    agitator : Agitator
+        The agitator to control
+    """
+    name = 'Agitator Socket Server'
+
+    def __init__(self, host, port, agitator):
+        super().__init__(host, port)
+        self.agitator = agitator
+        self.methods = {
+            'start-agitation': self.agitator.start,
+            'stop-agitation': self.agitator.stop,
+            'status': self.agitator.status,
+            'get-freq': self.agitator.get_freq,
+            'read-enc': self.agitator.read_enc,
+        }
+        self.subscriptions = {}
+        self._sub_ids = 0
+        self.agitator.telemetry.add_listener(self._on_telemetry)
+
+    def dispatch(self, method, params):
+        if method not in self.methods:
+            raise KeyError(f'Unknown method {method}')
+        return self.methods[method](**params)
+
+    async def respond(self, request, writer):
+        method = request.get('method') if isinstance(request, dict) else None
+        if method == 'subscribe':
+            reply = self._subscribe(writer, **(request.get('params') or {}))
+        elif method == 'unsubscribe':
+            reply = self._unsubscribe(writer)
+        else:
+            return await self._respond(request)
+        if 'id' in request:
+            reply['id'] = request['id']
+        return reply
+
+    def _subscribe(self, writer, fields=None, rate=1.0):
+        if fields is not None and not isinstance(fields, list):
+            return {'error': 'fields must be a list of telemetry names'}
+        if not isinstance(rate, (int, float)) or rate < 0:
+            return {'error': 'rate must be a non-negative number of Hz'}
+        self._sub_ids += 1
+        self.subscriptions[writer] = Subscription(self._sub_ids, writer,
+                                                  fields, rate)
+        return {'result': {'subscription': self._sub_ids}}
+
+    def _unsubscribe(self, writer):
+        subscription = self.subscriptions.pop(writer, None)
+        return {'result': subscription.id if subscription else None}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            await super().handle_connection(reader, writer)
+        finally:
+            self.subscriptions.pop(writer, None)
+
+    def _on_telemetry(self, snapshot):
+        """Runs on the telemetry thread; hands the snapshot to the event loop"""
+        if self.subscriptions and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._publish, snapshot)
+
+    def _publish(self, snapshot):
+        now = time.monotonic()
+        for subscription in list(self.subscriptions.values()):
+            subscription.offer(snapshot, now)
+
+    def closing(self):
+        self.agitator.telemetry.remove_listener(self._on_telemetry)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from expres_agitator import Agitator
+
+    parser = ArgumentParser(description='Start a socket server for the agitator')
+    parser.add_argument('--host', default=__DEFAULT_HOST__)
+    parser.add_argument('-p', '--port', type=int, default=__DEFAULT_PORT__)
+    parser.add_argument('-c', '--comport', default=__DEFAULT_COMPORT__)
+    args = parser.parse_args()
+
+    agitator = Agitator(args.comport)
+    agitator.telemetry.start()
+    try:
+        AgitatorSocketServer(args.host, args.port, agitator).run()
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt received. Closing server and exiting...')
+    finally:
+        agitator.close()
@@ -0,0 +1,308 @@
+"""
+    EXPRES Fiber Agitator Telemetry module
+
+    Provides a poller that reads the commonly requested Roboclaw registers
+    and keeps the latest values in a cached snapshot, so status queries
+    never have to wait behind hardware I/O.
+
+    The serial link is the scarcest resource (at 38400 baud it carries
+    3840 bytes per second), so registers are polled on a schedule by class:
+    currents, speeds and encoders are fast, battery voltage, temperature
+    and the error status are slow, and configuration is read rarely. Each
+    class polls faster while the agitator is running and backs off while it
+    is idle, and if the schedule would use more than the byte budget every
+    interval is stretched until it fits. Registers that are due at the same
+    time are read in one serial transaction.
+"""
+import time
+import logging
+from collections import deque
+from threading import Thread, Event, Lock
+
+
+__DEFAULT_BUDGET__ = 400 # bytes per second of link time for polling
+__USAGE_WINDOW__ = 10.0 # seconds of polls used to measure link usage
+
+# Seconds between polls of each class as (while agitating, while idle)
+POLL_CLASSES = {
+    'fast': (0.25, 1.0),
+    'slow': (2.0, 10.0),
+    'rare': (60.0, 300.0),
+}
+
+
+def _read_battery(rc, values):
+    status = rc.ReadMainBatteryVoltage()
+    if status[0]:
+        values['battery_voltage'] = status[1] / 10
+    return status[0]
+
+
+def _read_currents(rc, values):
+    status = rc.ReadCurrents()
+    if status[0]:
+        values['current1'] = status[1] / 100
+        values['current2'] = status[2] / 100
+    return status[0]
+
+
+def _read_encoder(motor):
+    def read(rc, values):
+        status = getattr(rc, f'ReadEncM{motor}')()
+        if status[0]:
+            values[f'enc{motor}'] = status[1]
+            values[f'enc{motor}_status'] = status[2]
+        return status[0]
+    return read
+
+
+def _read_speed(motor):
+    def read(rc, values):
+        status = getattr(rc, f'ReadSpeedM{motor}')()
+        if status[0]:
+            values[f'speed{motor}'] = status[1]
+        return status[0]
+    return read
+
+
+def _read_temperature(rc, values):
+    status = rc.ReadTemp()
+    if status[0]:
+        values['temperature'] = status[1] / 10
+    return status[0]
+
+
+def _read_error(rc, values):
+    status = rc.ReadError()
+    if status[0]:
+        values['error'] = status[1]
+    return status[0]
+
+
+def _read_config(rc, values):
+    status = rc.GetConfig()
+    if status[0]:
+        values['config'] = status[1]
+    return status[0]
+
+
+def _read_pid(motor):
+    def read(rc, values):
+        status = getattr(rc, f'ReadM{motor}VelocityPID')()
+        if status[0]:
+            values[f'velocity_pid{motor}'] = tuple(status[1:5])
+        return status[0]
+    return read
+
+
+# (name, poll class, bytes on the wire per read, reader). Each read is a
+# 2 byte command; the replies carry their values, status bytes and a CRC.
+# A reader stores what it read in values and returns whether the read worked.
+REGISTERS = (
+    ('currents', 'fast', 2 + 6, _read_currents),
+    ('enc1', 'fast', 2 + 7, _read_encoder(1)),
+    ('enc2', 'fast', 2 + 7, _read_encoder(2)),
+    ('speed1', 'fast', 2 + 7, _read_speed(1)),
+    ('speed2', 'fast', 2 + 7, _read_speed(2)),
+    ('battery_voltage', 'slow', 2 + 4, _read_battery),
+    ('temperature', 'slow', 2 + 4, _read_temperature),
+    ('error', 'slow', 2 + 4, _read_error),
+    ('config', 'rare', 2 + 4, _read_config),
+    ('velocity_pid1', 'rare', 2 + 18, _read_pid(1)),
+    ('velocity_pid2', 'rare', 2 + 18, _read_pid(2)),
+)
+
+
+class TelemetryPoller(object):
+    """Background poller holding the latest controller telemetry
+
+    Inputs
+    ------
+    rc : RoboclawWorker
+        Serialized access to the Roboclaw motor controller
+    budget : float
+        Bytes per second of serial link time the schedule may use
+    classes : dict
+        Poll intervals per class, as in POLL_CLASSES
+
+    Public Methods
+    --------------
+    start():
+        Start the polling thread
+    stop():
+        Stop the polling thread
+    poll():
+        Read every register once and update the snapshot
+    snapshot():
+        Return a copy of the latest telemetry (empty before the first poll)
+    set_active(active):
+        Switch between the agitating and idle schedules
+    usage():
+        Report the planned and measured use of the serial link
+    add_listener(callback):
+        Call callback(snapshot) from the polling thread after every poll
+    remove_listener(callback):
+        Stop calling a previously added listener
+    """
+
+    def __init__(self, rc, budget=__DEFAULT_BUDGET__, classes=None):
+        self._rc = rc
+        self.budget = budget
+        self.classes = dict(POLL_CLASSES if classes is None else classes)
+        self.logger = logging.getLogger('expres_agitator')
+        self.errors = 0
+        self.active = False
+
+        self._snapshot = {}
+        self._seq = 0
+        self._lock = Lock()
+        self._listeners = []
+        self._due = {}
+        self._reads = {name: 0 for name, _, _, _ in REGISTERS}
+        self._traffic = deque() # (monotonic time, bytes) of recent polls
+        self._first_poll = None
+        self._wake = Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Start the polling thread if it is not already running"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running = True
+        self._wake.clear()
+        self._thread = Thread(target=self._serve, name='agitator-telemetry',
+                              daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the polling thread and wait for it to finish"""
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def snapshot(self):
+        """Return a copy of the latest telemetry values"""
+        with self._lock:
+            return dict(self._snapshot)
+
+    def set_active(self, active):
+        """
+        Use the faster agitating schedule (or the idle one); registers that
+        would now be overdue are polled right away
+        """
+        active = bool(active)
+        if active == self.active:
+            return
+        self.active = active
+        now = time.monotonic()
+        for name, cls, _, _ in REGISTERS:
+            self._due[name] = min(self._due.get(name, now), now + self.interval(cls))
+        self._wake.set()
+
+    def interval(self, cls):
+        """Seconds between polls of a class under the current mode and budget"""
+        return self.classes[cls][0 if self.active else 1] * self._scale()
+
+    def usage(self):
+        """Return the planned and measured polling load on the serial link"""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            window = min(__USAGE_WINDOW__, now - (self._first_poll or now))
+            measured = sum(size for _, size in self._traffic) / window if window else 0.0
+            reads = dict(self._reads)
+        capacity = self._rc.rate / 10 # 8N1 framing: 10 bits per byte
+        return {'mode': 'agitating' if self.active else 'idle',
+                'budget_bytes_per_s': self.budget,
+                'demand_bytes_per_s': self._demand(),
+                'planned_bytes_per_s': self._demand() / self._scale(),
+                'measured_bytes_per_s': measured,
+                'link_bytes_per_s': capacity,
+                'link_utilization': measured / capacity,
+                'scale': self._scale(),
+                'reads': reads}
+
+    def add_listener(self, callback):
+        """
+        Register callback(snapshot) to be called after every poll. Listeners
+        share the one poll, so adding them adds no controller traffic; they
+        run on the polling thread and must return quickly. Their snapshot
+        also lists the registers this poll read successfully under
+        'polled'.
+        """
+        with self._lock:
+            self._listeners = self._listeners + [callback]
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners = [cb for cb in self._listeners if cb != callback]
+
+    def poll(self, names=None):
+        """Read the named registers (default: all) in one transaction and cache them"""
+        registers = [reg for reg in REGISTERS if names is None or reg[0] in names]
+        values, read = self._rc.run(self._read_registers, registers)
+        now = time.monotonic()
+        with self._lock:
+            if self._first_poll is None:
+                self._first_poll = now
+            self._seq += 1
+            self._snapshot.update(values)
+            self._snapshot['seq'] = self._seq
+            self._snapshot['time'] = time.time()
+            snapshot = dict(self._snapshot)
+            snapshot['polled'] = read
+            listeners = self._listeners
+            for name, _, size, _ in registers:
+                self._reads[name] += 1
+            self._traffic.append((now, sum(size for _, _, size, _ in registers)))
+            self._trim(now)
+        for callback in listeners:
+            try:
+                callback(snapshot)
+            except Exception as err:
+                self.logger.warning(f'Telemetry listener {callback} failed: {err}')
+        return values
+
+    def _read_registers(self, rc, registers):
+        """
+        Runs on the I/O thread; skips any register whose read failed and
+        returns the values with the names of the registers that were read
+        """
+        values = {}
+        read = [name for name, _, _, reader in registers if reader(rc, values)]
+        return values, read
+
+    def _demand(self):
+        """Bytes per second the unscaled schedule of the current mode needs"""
+        column = 0 if self.active else 1
+        return sum(size / self.classes[cls][column] for _, cls, size, _ in REGISTERS)
+
+    def _scale(self):
+        """Factor stretching every interval so the schedule fits the budget"""
+        return max(1.0, self._demand() / self.budget)
+
+    def _trim(self, now):
+        while self._traffic and self._traffic[0][0] < now - __USAGE_WINDOW__:
+            self._traffic.popleft()
+
+    def _serve(self):
+        now = time.monotonic()
+        for name, _, _, _ in REGISTERS:
+            self._due.setdefault(name, now)
+        while self._running:
+            now = time.monotonic()
+            due = [name for name, _, _, _ in REGISTERS if self._due[name] <= now]
+            if due:
+                try:
+                    self.poll(due)
+                except Exception as err:
+                    self.errors += 1
+                    self.logger.warning(f'Telemetry poll failed: {err}')
+                for name, cls, _, _ in REGISTERS:
+                    if name in due:
+                        self._due[name] = now + self.interval(cls)
+            self._wake.wait(max(0.0, min(self._due.values()) - time.monotonic()))
+            self._wake.clear()
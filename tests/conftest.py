@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('EXPRES_AGITATOR_LOG',
+                      os.path.join(tempfile.gettempdir(), 'agitator-tests.log'))
+
+
+@pytest.fixture(autouse=True)
+def fresh_simulator():
+    """Every test starts with new simulated controllers"""
+    import roboclaw_sim
+    roboclaw_sim.reset()
+    yield
+    roboclaw_sim.reset()
@@ -0,0 +1,106 @@
+import time
+from threading import Thread
+
+import pytest
+
+from admission import AdmissionControl, Overloaded, TokenBucket, is_control
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(10, burst=2)
+    assert bucket.wait(2) == 0
+    bucket.tokens -= 2
+    assert bucket.wait() == pytest.approx(0.1)
+    bucket.refill(bucket.updated + 0.1)
+    assert bucket.wait() == 0
+    assert bucket.wait(5) == pytest.approx(0.1) # Only needs a full bucket
+
+
+@pytest.mark.parametrize('rate, burst', [(0, None), (-1, None), (10, 0)])
+def test_limits_must_be_positive(rate, burst):
+    with pytest.raises(ValueError, match='positive'):
+        TokenBucket(rate, burst)
+    with pytest.raises(ValueError, match='positive'):
+        AdmissionControl(client_rate=rate, client_burst=burst)
+    with pytest.raises(ValueError, match='positive'):
+        AdmissionControl(method_limits={'status': (rate, burst)})
+
+
+def test_client_over_its_rate_is_refused_with_retry_after():
+    admission = AdmissionControl(client_rate=10, client_burst=2)
+    admission.admit('10.0.0.1', ['status'])
+    admission.admit('10.0.0.1', ['status'])
+    with pytest.raises(Overloaded) as refused:
+        admission.admit('10.0.0.1', ['status'])
+    assert 0 < refused.value.retry_after <= 0.1
+    admission.admit('10.0.0.2', ['status']) # Other clients have their own bucket
+    stats = admission.stats()
+    assert stats['client_rate'] == 1
+    assert stats['shed_by_client'] == {'10.0.0.1': 1}
+
+
+def test_method_limits_are_shared_and_all_or_nothing():
+    admission = AdmissionControl(method_limits={'read_enc': (1, 1)})
+    admission.admit('a', ['read_enc'])
+    with pytest.raises(Overloaded):
+        admission.admit('b', ['blue.read_enc'])
+    with pytest.raises(Overloaded):
+        admission.admit('b', ['status', 'read_enc'])
+    assert admission.stats()['method_rate'] == 2
+
+
+def test_control_methods_are_never_limited():
+    admission = AdmissionControl(client_rate=1, client_burst=1,
+                                 method_limits={'stop': (1, 1)})
+    for _ in range(10):
+        admission.admit('a', ['stop', 'blue.stop_agitation'])
+    assert admission.stats()['control'] == 10
+    assert is_control('blue.stop') and not is_control('status')
+
+
+def test_gate_sheds_when_its_queue_is_full():
+    admission = AdmissionControl(max_active=1, max_queue=0)
+    with admission.gate('read_enc'):
+        with pytest.raises(Overloaded):
+            with admission.gate('read_enc'):
+                pass
+        with admission.gate('stop'): # Control calls pass straight through
+            pass
+    assert admission.stats()['queue_full'] == 1
+
+
+def test_gate_sheds_calls_that_wait_too_long():
+    admission = AdmissionControl(max_active=1, max_queue=1, queue_timeout=0.05)
+    errors = []
+
+    def wait_for_gate():
+        try:
+            with admission.gate('read_enc'):
+                pass
+        except Overloaded as err:
+            errors.append(err)
+    with admission.gate('read_enc'):
+        waiter = Thread(target=wait_for_gate)
+        waiter.start()
+        waiter.join(5)
+    assert len(errors) == 1
+    stats = admission.stats()
+    assert stats['queue_timeout'] == 1
+    assert (stats['active'], stats['queued']) == (0, 0)
+
+
+def test_gate_admits_a_queued_call_when_a_slot_frees():
+    admission = AdmissionControl(max_active=1, max_queue=1, queue_timeout=5)
+    entered = []
+
+    def wait_for_gate():
+        with admission.gate('read_enc'):
+            entered.append(time.monotonic())
+    with admission.gate('read_enc'):
+        waiter = Thread(target=wait_for_gate)
+        waiter.start()
+        time.sleep(0.05)
+        assert admission.stats()['queued'] == 1
+        assert not entered
+    waiter.join(5)
+    assert len(entered) == 1
@@ -0,0 +1,95 @@
+import time
+from threading import Thread
+
+import pytest
+
+import agitator_process
+from agitator_process import BLOCK_SIZE, AgitatorProcess, TelemetryBlock, _COUNTER
+
+
+def test_block_reads_back_what_was_published():
+    block = TelemetryBlock(bytearray(2 * BLOCK_SIZE), BLOCK_SIZE)
+    assert block.read() == {}
+    block.publish({'seq': 3, 'time': 1.5, 'enc1': 2**31 + 7, 'current1': None,
+                   'agitating': True, 'velocity_pid1': (1.0, 0.5, 0.0, 44000)})
+    values = block.read()
+    assert values['seq'] == 3 and values['enc1'] == 2**31 + 7
+    assert 'current1' not in values
+    assert values['agitating'] is True
+    assert values['velocity_pid1'] == (1.0, 0.5, 0.0, 44000)
+    assert 'velocity_pid2' not in values
+
+
+def test_block_read_waits_out_a_publication_in_progress():
+    buf = bytearray(BLOCK_SIZE)
+    block = TelemetryBlock(buf, 0)
+    block.publish({'seq': 1})
+    (count,) = _COUNTER.unpack_from(buf, 0)
+    _COUNTER.pack_into(buf, 0, count + 1) # A writer is midway through
+
+    def finish():
+        time.sleep(0.05)
+        values = bytearray(BLOCK_SIZE)
+        TelemetryBlock(values, 0).publish({'seq': 2})
+        buf[_COUNTER.size:] = values[_COUNTER.size:]
+        _COUNTER.pack_into(buf, 0, count + 2)
+    writer = Thread(target=finish)
+    writer.start()
+    start = time.monotonic()
+    assert block.read()['seq'] == 2
+    assert time.monotonic() - start >= 0.04
+    writer.join()
+
+
+def test_block_read_gives_up_on_a_dead_writer(monkeypatch):
+    monkeypatch.setattr(agitator_process, '__READ_TIMEOUT__', 0.05)
+    buf = bytearray(BLOCK_SIZE)
+    _COUNTER.pack_into(buf, 0, 1) # The writer died midway
+    with pytest.raises(RuntimeError, match='exited'):
+        TelemetryBlock(buf, 0, lambda: False).read()
+    with pytest.raises(TimeoutError):
+        TelemetryBlock(buf, 0, lambda: True).read()
+
+
+@pytest.fixture(scope='module')
+def process():
+    process = AgitatorProcess('sim://process?realtime=0', [('agitator', 0x80)])
+    yield process
+    process.close()
+
+
+def wait_for_poll(agitator):
+    deadline = time.monotonic() + 10
+    while not agitator.status().get('velocity_pid1') and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def test_remote_status_matches_agitator_status(process):
+    agitator = process.agitator('agitator')
+    wait_for_poll(agitator)
+    remote = agitator.status()
+    local = process.call('agitator', 'status')
+    assert set(remote) == set(local)
+    assert remote['velocity_pid1'] == pytest.approx(local['velocity_pid1'])
+
+
+def test_metrics_counters_come_from_shared_memory(process, monkeypatch):
+    agitator = process.agitator('agitator')
+    agitator.start(60.0)
+    agitator.stop()
+    time.sleep(0.5) # Let the publisher catch up
+    expected = (process.call('agitator', 'link_stats'),
+                process.call('agitator', 'setpoint_stats'),
+                process.call('agitator', 'telemetry_usage'))
+    assert expected[1]['sent']
+
+    def no_call(*args, **kwargs):
+        raise AssertionError(f'Unexpected call to the I/O process: {args}')
+    monkeypatch.setattr(process, 'call', no_call)
+    assert agitator.link_stats() == expected[0]
+    assert agitator.setpoint_stats() == expected[1]
+    assert agitator.crc_errors == 0
+    usage = agitator.telemetry.usage()
+    assert usage['mode'] == expected[2]['mode']
+    assert usage['planned_bytes_per_s'] == pytest.approx(expected[2]['planned_bytes_per_s'])
+    assert 0 < usage['link_utilization'] < 1
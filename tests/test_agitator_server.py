@@ -0,0 +1,175 @@
+import time
+import xmlrpc.client
+from threading import Event, Thread
+
+import pytest
+
+import roboclaw_sim
+from agitator_client import AgitatorProxy, _tag_request
+from agitator_server import AgitatorServer, CACHED_METHODS, parse_method_limit
+from roboclaw_io import deadline as io_deadline
+
+
+@pytest.fixture
+def server():
+    server = AgitatorServer('127.0.0.1', 0, comport='sim://server?realtime=0',
+                            allow_none=True, logRequests=False)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    assert server.wait_ready(10)
+    yield server
+    server.stop(wait=True, timeout=10)
+    thread.join(10)
+
+
+def proxy(server):
+    return AgitatorProxy('127.0.0.1', server.server_address[1], allow_none=True)
+
+
+def test_cached_battery_voltage_falls_through_on_bad_reading():
+    reader = CACHED_METHODS['get_battery_voltage']
+    assert reader({'battery_voltage': 23.9}) == 23.9
+    assert reader({'battery_voltage': 0.0}) is None
+    assert reader({}) is None
+
+
+def test_shutdown_stops_motors_before_idle_connections_time_out(server):
+    proxy(server).start(60.0)
+    idle = [proxy(server) for _ in range(8)]
+    for client in idle:
+        client.status() # Leaves a keep-alive connection open
+    motors = roboclaw_sim.get_bus('server').controllers[0x80].motors
+    assert all(motor.target for motor in motors)
+
+    start = time.perf_counter()
+    assert server.stop(wait=True, timeout=10)
+    assert time.perf_counter() - start < 1.5
+    assert all(motor.target == 0 for motor in motors)
+    assert not server.agitator.agitating
+
+
+def test_idle_keepalive_connections_do_not_hold_workers(server):
+    idle = [proxy(server) for _ in range(2 * server._pool._max_workers)]
+    for client in idle:
+        client.status() # Leaves a keep-alive connection open
+
+    start = time.perf_counter()
+    proxy(server).start(60.0)
+    assert time.perf_counter() - start < 0.5
+    assert server.agitator.agitating
+    for client in idle: # Parked connections still answer
+        assert client.status()['agitating']
+
+
+def test_idle_keepalive_connections_are_closed(server, monkeypatch):
+    monkeypatch.setattr('agitator_server.__KEEPALIVE_TIMEOUT__', 0.2)
+    client = proxy(server)
+    client.status()
+    deadline = time.monotonic() + 5
+    while server._parked and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not server._parked
+    assert client.status() # Reconnects
+
+
+def test_prefixed_reads_are_retried():
+    assert _tag_request('blue.status', (), 2, False) == ((), 2)
+    assert _tag_request('red.read_enc', (), 2, False) == ((), 2)
+    assert _tag_request('system.listMethods', (), 2, False) == ((), 2)
+    assert _tag_request('blue.start', (60.0,), 2, False) == ((60.0,), 0)
+
+
+def test_proxy_allows_none_by_default(server):
+    client = AgitatorProxy('127.0.0.1', server.server_address[1])
+    assert client.exposure_summary() is None
+
+
+def test_late_stop_still_stops_the_motors(server):
+    client = proxy(server)
+    client.start(60.0)
+    with pytest.raises(xmlrpc.client.Fault, match='DeadlineExceeded'):
+        client.status({'_deadline': time.time() - 10})
+    client.stop(True, {'_deadline': time.time() - 10, '_max_age': 0.0})
+    motors = roboclaw_sim.get_bus('server').controllers[0x80].motors
+    assert all(motor.target == 0 for motor in motors)
+    assert not server.agitator.agitating
+
+
+def test_late_start_does_not_start_the_motors(server):
+    client = proxy(server)
+    dropped = server.deadline_stats()['dispatch']
+    with pytest.raises(xmlrpc.client.Fault, match='DeadlineExceeded'):
+        client.start(60.0, {'_deadline': time.time() - 10})
+    motors = roboclaw_sim.get_bus('server').controllers[0x80].motors
+    assert all(motor.target == 0 for motor in motors)
+    assert not server.agitator.agitating
+    assert server.deadline_stats()['dispatch'] == dropped + 1
+
+
+def test_stop_ignores_an_outer_serial_deadline(server):
+    server.agitator.start(60.0)
+    with io_deadline(time.monotonic() - 1):
+        server._call('stop', (), {'_max_age': 0.0}, time.monotonic() - 1)
+    motors = roboclaw_sim.get_bus('server').controllers[0x80].motors
+    assert all(motor.target == 0 for motor in motors)
+
+
+def test_window_sets_a_missing_timeout(server):
+    exp_time, timeout = server._fit_window('start', (60.0,), {'_exposure_start': time.time() - 10})
+    assert exp_time == pytest.approx(50.0, abs=0.5)
+    assert timeout == pytest.approx(exp_time)
+    exp_time, timeout = server._fit_window('start', (60.0, 30.0),
+                                           {'_exposure_start': time.time() - 10})
+    assert timeout == pytest.approx(20.0, abs=0.5)
+
+
+def test_only_serial_calls_pass_the_gate(server):
+    server.admission.max_active = server.admission.max_queue = 0 # Shed every gated call
+    client = proxy(server)
+    assert client.get_freq() == 0
+    assert client.get_voltage1() == 0
+    assert client.exposure_summary() is None
+    client.start(60.0)
+    with pytest.raises(xmlrpc.client.Fault, match='Too many controller calls'):
+        client.get_max_voltage()
+
+
+def test_control_calls_skip_the_queue_and_the_pending_limit():
+    server = AgitatorServer('127.0.0.1', 0, comport='sim://busy?realtime=0', max_workers=1,
+                            max_pending=1, allow_none=True, logRequests=False)
+    release = Event()
+    server.register_function(lambda: release.wait(10), 'block')
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    assert server.wait_ready(10)
+    busy = []
+    try:
+        proxy(server).start(60.0)
+        busy.append(Thread(target=proxy(server).block, daemon=True))
+        busy[0].start() # Holds the only worker
+        time.sleep(0.2)
+        busy.append(Thread(target=proxy(server).status, daemon=True))
+        busy[1].start() # Waits for it
+        time.sleep(0.2)
+        with pytest.raises(xmlrpc.client.ProtocolError, match='503'):
+            proxy(server).status()
+
+        start = time.perf_counter()
+        proxy(server).stop()
+        assert time.perf_counter() - start < 0.5
+        motors = roboclaw_sim.get_bus('busy').controllers[0x80].motors
+        assert all(motor.target == 0 for motor in motors)
+    finally:
+        release.set()
+        for each in busy:
+            each.join(10)
+        server.stop(wait=True, timeout=10)
+        thread.join(10)
+
+
+def test_method_limit_option():
+    assert parse_method_limit('read_enc=5:2') == ('read_enc', (5.0, 2.0))
+    assert parse_method_limit('status=10') == ('status', (10.0, None))
+    for text in ('status', 'status=fast', 'status=0', 'status=5:0'):
+        with pytest.raises(ValueError):
+            parse_method_limit(text)
@@ -0,0 +1,40 @@
+import statistics
+
+import pytest
+
+from exposure_stats import ExposureStats, RunningStats
+
+
+def test_running_stats_match_the_statistics_module():
+    values = [23.9, 24.1, 24.0, 23.7, 24.4]
+    stats = RunningStats()
+    for value in values:
+        stats.add(value)
+    summary = stats.summary()
+    assert summary['count'] == 5
+    assert summary['mean'] == pytest.approx(statistics.mean(values))
+    assert summary['variance'] == pytest.approx(statistics.variance(values))
+    assert (summary['min'], summary['max']) == (23.7, 24.4)
+
+
+def test_running_stats_need_two_values_for_a_variance():
+    stats = RunningStats()
+    assert stats.summary()['mean'] is None
+    stats.add(1.0)
+    assert stats.variance is None
+
+
+def test_exposure_stats_only_add_values_polled_while_active():
+    exposure = ExposureStats()
+    assert exposure.summary() is None
+    exposure.listener({'current1': 1.0, 'polled': ['currents']}) # Not started
+    exposure.begin()
+    exposure.listener({'current1': 1.0, 'current2': 2.0, 'temperature': 30.0,
+                       'polled': ['currents']})
+    exposure.listener({'current1': 3.0, 'current2': 2.0, 'polled': []})
+    exposure.finish()
+    exposure.listener({'current1': 5.0, 'polled': ['currents']}) # Finished
+    summary = exposure.summary()
+    assert summary['current1']['count'] == 1
+    assert summary['current2']['mean'] == 2.0
+    assert summary['temperature']['count'] == 0
@@ -0,0 +1,86 @@
+import time
+from threading import Event, Thread
+
+import pytest
+
+from request_cache import RequestCache, SingleFlight
+
+
+def test_repeated_request_id_replays_the_first_result():
+    cache = RequestCache()
+    calls = []
+    assert cache.run('a', 'start', (60.0,), lambda: calls.append(1) or 'first') == 'first'
+    assert cache.run('a', 'start', (60.0,), lambda: calls.append(1) or 'second') == 'first'
+    assert len(calls) == 1
+    assert cache.stats()['replayed'] == 1
+
+
+def test_request_id_reused_for_another_call_is_refused():
+    cache = RequestCache()
+    cache.run('a', 'start', (60.0,), lambda: None)
+    with pytest.raises(ValueError):
+        cache.run('a', 'start', (30.0,), lambda: None)
+    assert cache.stats()['mismatched'] == 1
+
+
+def test_failed_call_runs_again_on_retry():
+    cache = RequestCache()
+
+    def fail():
+        raise OSError('serial timeout')
+    with pytest.raises(OSError):
+        cache.run('a', 'stop', (), fail)
+    assert cache.run('a', 'stop', (), lambda: 'stopped') == 'stopped'
+    assert cache.stats()['executed'] == 2
+
+
+def test_retry_of_a_running_call_waits_for_it():
+    cache = RequestCache()
+    release = Event()
+    results = []
+    owner = Thread(target=lambda: results.append(
+        cache.run('a', 'start', (), lambda: release.wait(5) and 'done')))
+    owner.start()
+    time.sleep(0.05)
+    retry = Thread(target=lambda: results.append(cache.run('a', 'start', (), lambda: 'again')))
+    retry.start()
+    time.sleep(0.05)
+    release.set()
+    owner.join(5)
+    retry.join(5)
+    assert results == ['done', 'done']
+    assert cache.stats()['joined'] == 1
+
+
+def test_ids_are_forgotten_after_ttl_and_beyond_max_ids():
+    cache = RequestCache(max_ids=2, ttl=0.05)
+    for request_id in 'abc':
+        cache.run(request_id, 'start', (), lambda: request_id)
+    assert cache.stats()['cached'] == 2
+    assert cache.run('a', 'start', (), lambda: 'rerun') == 'rerun' # Evicted
+    time.sleep(0.1)
+    assert cache.run('c', 'start', (), lambda: 'rerun') == 'rerun' # Expired
+
+
+def test_single_flight_shares_one_result():
+    flights = SingleFlight()
+    release = Event()
+    calls = []
+    results = []
+
+    def read():
+        calls.append(1)
+        release.wait(5)
+        return 42
+    threads = [Thread(target=lambda: results.append(flights.run('read_enc', read)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [42] * 4
+    assert len(calls) == 1
+    assert flights.stats() == {'executed': 1, 'coalesced': 3}
+    assert flights.run('read_enc', lambda: 7) == 7 # A fresh read once it finished
@@ -0,0 +1,48 @@
+import pytest
+
+import roboclaw_sim
+from expres_agitator import open_bus
+from roboclaw_baud import config_rate, with_rate
+
+
+def test_config_rate_bits():
+    config = with_rate(0x0163, 115200)
+    assert config_rate(config) == 115200
+    assert config & ~0x00E0 == 0x0103
+    with pytest.raises(ValueError):
+        with_rate(config, 12345)
+
+
+def test_detects_the_controller_rate():
+    bus = open_bus('sim://detect?realtime=0&baud=9600')
+    try:
+        assert bus.rc.rate == 9600
+        assert bus.worker().ReadEncM1()[0]
+    finally:
+        bus.close()
+
+
+def test_moves_every_controller_and_saves_the_rate():
+    bus = open_bus('sim://upgrade?realtime=0&addr=0x80,0x81', baud=115200,
+                   addrs=[0x80, 0x81])
+    try:
+        assert bus.rc.rate == 115200
+        for controller in roboclaw_sim.get_bus('upgrade').controllers.values():
+            assert controller.baudrate == 115200
+            assert controller.nvm_writes == 1
+        assert bus.worker(0x81).ReadEncM1()[0]
+    finally:
+        bus.close()
+
+
+def test_failed_move_stays_at_the_old_rate():
+    # 0x81 is not on the port, so the move cannot be confirmed
+    bus = open_bus('sim://fallback?realtime=0', baud=115200, addrs=[0x80, 0x81])
+    try:
+        assert bus.rc.rate == 38400
+        controller = roboclaw_sim.get_bus('fallback').controllers[0x80]
+        assert controller.baudrate == 38400
+        assert controller.nvm_writes == 0
+        assert bus.worker().ReadEncM1()[0]
+    finally:
+        bus.close()
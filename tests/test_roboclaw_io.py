@@ -0,0 +1,65 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import pytest
+
+import roboclaw_sim
+from expres_agitator import open_bus
+from roboclaw_io import DeadlineExceeded, deadline
+
+
+@pytest.fixture
+def bus():
+    bus = open_bus('sim://io?realtime=0')
+    yield bus
+    bus.close()
+
+
+def test_commands_queued_past_their_deadline_are_dropped(bus):
+    worker = bus.worker()
+    release = Event()
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        stall = pool.submit(worker.run, lambda rc: release.wait(5)) # Holds the I/O thread
+        time.sleep(0.05)
+
+        def read(limit):
+            with deadline(limit):
+                return worker.ReadEncM1()
+        late = pool.submit(read, time.monotonic() + 0.05)
+        patient = pool.submit(read, None)
+        time.sleep(0.1)
+        release.set()
+        assert stall.result(5)
+        with pytest.raises(DeadlineExceeded):
+            late.result(5)
+        assert patient.result(5)[0]
+
+
+def test_deadline_only_applies_inside_its_block(bus):
+    worker = bus.worker()
+    with deadline(time.monotonic() - 1):
+        with deadline(None):
+            assert worker.ReadEncM1()[0]
+        with pytest.raises(DeadlineExceeded):
+            worker.ReadEncM1()
+    assert worker.ReadEncM1()[0]
+
+
+def test_lost_port_fails_fast_and_reconnects(bus):
+    worker = bus.worker()
+    reconnected = Event()
+    bus.add_reconnect_listener(reconnected.set)
+    roboclaw_sim.unplug('io')
+    with pytest.raises(Exception):
+        worker.ReadEncM1() # Finds the port gone
+    with pytest.raises(ConnectionError):
+        worker.ReadEncM1() # Fails at once while it is down
+    assert not bus.link_stats()['up']
+
+    roboclaw_sim.plug('io')
+    assert reconnected.wait(5)
+    stats = bus.link_stats()
+    assert stats['up'] and stats['losses'] == 1 and stats['reconnects'] == 1
+    assert stats['failed_fast'] >= 1
+    assert worker.ReadEncM1()[0]
@@ -0,0 +1,58 @@
+import pytest
+
+from rotation import RotationTracker, wrapped_delta
+
+
+def test_wrapped_delta_crosses_the_32_bit_boundary():
+    assert wrapped_delta(5, 2**32 - 5) == 10
+    assert wrapped_delta(2**32 - 5, 5) == -10
+    assert wrapped_delta(1000, 400) == 600
+
+
+def start(tracker, enc, counts_per_rotation=100):
+    tracker.begin((10.0, 10.0), 60.0, (counts_per_rotation, counts_per_rotation), enc)
+
+
+def test_counts_through_an_encoder_wrap():
+    tracker = RotationTracker(max_rate=10000)
+    start(tracker, (2**32 - 300, 100))
+    tracker.update(200, 600, now=tracker._started + 0.1)
+    tracker.finish()
+    motor1 = tracker.report()['motor1']
+    assert motor1['counts'] == 500
+    assert motor1['resets'] == 0
+    assert tracker.report()['motor2']['counts'] == 500
+
+
+def test_encoder_reset_keeps_only_the_counts_since_it():
+    tracker = RotationTracker(max_rate=1000)
+    start(tracker, (500000, 0))
+    tracker.update(50, 100, now=tracker._started + 0.1) # enc1 was zeroed
+    tracker.finish()
+    report = tracker.report()
+    assert report['motor1']['counts'] == 50
+    assert report['motor1']['resets'] == 1
+    assert report['motor1']['delivered'] == pytest.approx(0.5)
+    assert report['motor2']['resets'] == 0
+
+
+def test_rebase_continues_from_values_set_on_purpose():
+    tracker = RotationTracker(max_rate=1000)
+    start(tracker, (500000, 500000))
+    tracker.update(500050, 500050, now=tracker._started + 0.1)
+    tracker.rebase((0, 0))
+    tracker.update(20, 20)
+    tracker.finish()
+    motor1 = tracker.report()['motor1']
+    assert motor1['counts'] == 70
+    assert motor1['resets'] == 0
+
+
+def test_listener_only_uses_encoders_that_were_read():
+    tracker = RotationTracker(max_rate=10**9)
+    start(tracker, (0, 0))
+    tracker.listener({'enc1': 10, 'enc2': 10, 'polled': ['enc1']})
+    assert tracker.report()['motor1']['samples'] == 1
+    tracker.listener({'enc1': 10, 'enc2': 10, 'polled': ['enc1', 'enc2']})
+    assert tracker.report()['motor1']['counts'] == 10
+    assert RotationTracker(1000).report() is None
@@ -0,0 +1,49 @@
+import pytest
+
+from expres_agitator import open_bus
+from serial_capture import ReplayMismatch, read_capture
+
+
+def exchange(worker):
+    return [worker.SpeedAccelM1(1000, 500), worker.ReadEncM1(),
+            worker.ReadMainBatteryVoltage()]
+
+
+@pytest.fixture
+def capture(tmp_path):
+    path = str(tmp_path / 'session.rcap')
+    bus = open_bus('sim://capture?realtime=0', capture=path)
+    try:
+        replies = exchange(bus.worker())
+    finally:
+        bus.close()
+    return path, replies
+
+
+def test_capture_records_each_command_and_reply(capture):
+    path, _ = capture
+    metadata, frames = read_capture(path)
+    assert metadata['port'] == 'sim://capture?realtime=0'
+    assert [direction for _, direction, _ in frames[-6:]] == [0, 1] * 3
+    assert all(later >= earlier for (earlier, _, _), (later, _, _) in zip(frames, frames[1:]))
+
+
+def test_replay_returns_the_recorded_replies(capture):
+    path, replies = capture
+    bus = open_bus(f'replay://{path}?speed=0&strict=1')
+    try:
+        assert exchange(bus.worker()) == replies
+        assert bus.rc._comport.finished
+        assert bus.rc._comport.mismatches == 0
+    finally:
+        bus.close()
+
+
+def test_strict_replay_raises_on_different_commands(capture):
+    path, _ = capture
+    bus = open_bus(f'replay://{path}?speed=0&strict=1')
+    try:
+        with pytest.raises(ReplayMismatch):
+            bus.worker().SpeedAccelM1(1000, 400)
+    finally:
+        bus.close()
@@ -0,0 +1,77 @@
+import time
+from threading import Thread
+
+import pytest
+
+import roboclaw_sim
+from agitator_server import AgitatorServer
+from expres_agitator import Agitator
+from socket_client import AgitatorSocketClient
+from socket_server import AgitatorSocketServer
+
+
+@pytest.fixture
+def agitator():
+    agitator = Agitator('sim://socket?realtime=0')
+    yield agitator
+    agitator.close()
+
+
+@pytest.fixture
+def server(agitator):
+    server = AgitatorSocketServer('127.0.0.1', 0, agitator)
+    server.thread = server.start()
+    yield server
+    if not server._loop.is_closed():
+        server.stop()
+    server.thread.join(10)
+
+
+def drop_connections(server):
+    """Close every connection from the server side, as a restart would"""
+    server._loop.call_soon_threadsafe(lambda: [writer.close() for writer in list(server._writers)])
+    deadline = time.monotonic() + 5
+    while server._writers and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_stop_reaches_server_after_pooled_connection_is_dropped(server, agitator):
+    client = AgitatorSocketClient('127.0.0.1', server.port, timeout=5)
+    client.startAgitation(60.0)
+    assert client.connected
+    drop_connections(server)
+
+    client.stopAgitation()
+    motors = roboclaw_sim.get_bus('socket').controllers[0x80].motors
+    assert all(motor.target == 0 for motor in motors)
+    assert not agitator.agitating
+
+
+def test_unacknowledged_stop_raises(server, agitator):
+    client = AgitatorSocketClient('127.0.0.1', server.port, timeout=1)
+    client.startAgitation(60.0)
+    server.stop()
+    server.thread.join(10)
+    with pytest.raises(ConnectionError):
+        client.stopAgitation()
+
+
+def test_start_raises_when_port_is_taken(server, agitator):
+    with pytest.raises(OSError):
+        AgitatorSocketServer('127.0.0.1', server.port, agitator).start()
+
+
+def test_agitator_server_reports_stream_port_bind_failure(server):
+    rpc = AgitatorServer('127.0.0.1', 0, comport='sim://stream?realtime=0',
+                         stream_port=server.port, logRequests=False)
+    thread = Thread(target=rpc.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert not rpc.wait_ready(1)
+        health = rpc.health()
+        assert health['state'] == 'error'
+        assert 'in use' in health['error'].lower()
+        assert rpc.stream_server is None
+    finally:
+        assert rpc.stop(wait=True, timeout=10)
+        thread.join(10)
@@ -0,0 +1,29 @@
+from telemetry import REGISTERS, TelemetryPoller
+
+
+class FlakyRoboclaw(object):
+    """Answers every read with zeros, except those named in failing"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+
+    def run(self, func, *args):
+        return func(self, *args)
+
+    def __getattr__(self, command):
+        if command in self.failing:
+            return lambda: (False, 0)
+        return lambda: (True,) + (0,) * 4
+
+
+def test_polled_lists_only_registers_that_were_read():
+    poller = TelemetryPoller(FlakyRoboclaw(failing={'ReadTemp', 'ReadEncM2'}))
+    snapshots = []
+    poller.add_listener(snapshots.append)
+    poller.poll()
+
+    names = [name for name, _, _, _ in REGISTERS]
+    assert snapshots[0]['polled'] == [name for name in names
+                                      if name not in ('temperature', 'enc2')]
+    assert 'temperature' not in poller.snapshot()
+    assert 'enc2' not in poller.snapshot()
@@ -0,0 +1,157 @@
+"""
+    EXPRES Fiber Agitator Tracing module
+
+    Lightweight span tracing for following one request through the RPC
+    server, the Agitator and each Roboclaw command on the serial line.
+    Tracing is off by default; while off, span() returns a shared no-op
+    context manager and traced functions only pay for one global check.
+
+    When enabled, finished spans are kept in a bounded in-memory buffer and
+    can be exported as Chrome trace-event JSON, which chrome://tracing and
+    https://ui.perfetto.dev show as a flame chart per thread.
+
+    Usage:
+    tracing.enable()
+    with tracing.span('move', motor=1):
+        ...
+    tracing.export_chrome('trace.json')
+"""
+import os
+import json
+import time
+import threading
+from collections import deque
+from functools import wraps
+
+
+__DEFAULT_MAX_EVENTS__ = 100000
+
+_tracer = None
+
+
+class _NullSpan(object):
+    """Shared stand-in returned by span() while tracing is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    """A timed region; extra args can be attached until it ends"""
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add({'name': self.name, 'cat': self.cat, 'ph': 'X',
+                         'ts': self.start * 1e6, 'dur': (end - self.start) * 1e6,
+                         'pid': self.tracer.pid, 'tid': threading.get_ident(),
+                         'args': self.args})
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class Tracer(object):
+    """Bounded buffer of trace events; the oldest are dropped when full"""
+
+    def __init__(self, max_events=__DEFAULT_MAX_EVENTS__):
+        self.pid = os.getpid()
+        self.events = deque(maxlen=max_events)
+        self.threads = {}
+
+    def add(self, event):
+        tid = event['tid']
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        self.events.append(event)
+
+    def chrome_events(self):
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                  'args': {'name': name}} for tid, name in list(self.threads.items())]
+        return names + list(self.events)
+
+
+def enable(max_events=__DEFAULT_MAX_EVENTS__):
+    """Start collecting spans, discarding any collected earlier"""
+    global _tracer
+    _tracer = Tracer(max_events)
+
+
+def disable():
+    """Stop collecting spans and return the tracer that collected them"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, cat='agitator', **args):
+    """Return a context manager timing the enclosed block as one span"""
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return Span(tracer, name, cat, args)
+
+
+def instant(name, cat='agitator', **args):
+    """Record a point-in-time event, such as a retry"""
+    tracer = _tracer
+    if tracer is not None:
+        tracer.add({'name': name, 'cat': cat, 'ph': 'i', 's': 't',
+                    'ts': time.perf_counter() * 1e6, 'pid': tracer.pid,
+                    'tid': threading.get_ident(), 'args': args})
+
+
+def traced(name=None, cat='agitator'):
+    """Decorator recording each call of the function as a span"""
+    def decorate(func):
+        label = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            with Span(tracer, label, cat, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def export_chrome(path=None, tracer=None):
+    """
+    Return the collected spans as a Chrome trace-event JSON string, also
+    writing it to path if given
+    """
+    tracer = tracer or _tracer
+    events = tracer.chrome_events() if tracer is not None else []
+    text = json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(text)
+    return text